@@ -0,0 +1,201 @@
+import argparse
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+from dotenv import load_dotenv
+from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+
+from connections import mongo_client
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+#Archiving of removed books
+#remove_selection_from_mongo only sets book_shelf to -1 (and stamps removed_at). This module moves books
+#that have been removed for a while into "<collection>_archive", so the live collection only holds what
+#people actually browse. or_filter_mongo reads the archive only when book_shelf -1 is asked for.
+#
+#The live lookup indexes are partial indexes over book_shelf > -1, so removed books do not bloat them.
+#
+#Run by hand:      python archive.py --days 30
+#or in the app:    ARCHIVE_AFTER_DAYS=30 and ARCHIVE_INTERVAL=3600 (seconds) in the .env file
+
+load_dotenv(".env")
+ARCHIVE_SUFFIX = "_archive"
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "0"))  # 0 = no background archiving
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_LOCK_FILE = "archive.lock"
+_lock_file = None  # held open by the process that runs the archiver
+
+LIVE_FILTER = {"book_shelf": {"$gt": -1}}
+LIVE_INDEXES = [
+    [("book_shelf", 1)],
+    [("ISBN_canonical", 1)],  # what ISBN searches use, see isbn.py
+    [("ISBN_13", 1)],
+    [("ISBN_10", 1)],
+    [("ID", 1)],
+    # normalized keys from search_keys.py, used by the "prefix", "exact" and "words" searches
+    [("search_title", 1)],
+    [("search_authors", 1)],
+    [("search_title_tokens", 1)],
+    [("search_authors_tokens", 1)],
+]
+
+# Identifier lookups on archived books (shelf membership of search results, see shelf_membership.py)
+ARCHIVE_INDEXES = [
+    [("ISBN_canonical", 1)],
+    [("ISBN_13", 1)],
+    [("ISBN_10", 1)],
+    [("ID", 1)],
+]
+
+_indexed = set()  # (uri, db, collection) that already got their indexes in this process
+
+
+def archive_collection_name(collection_name):
+    return collection_name + ARCHIVE_SUFFIX
+
+
+def ensure_live_indexes(collection, mongo_uri=None):
+    """Creates the partial indexes for live books (and the one the archiver needs), once per process."""
+    key = (mongo_uri, collection.database.name, collection.name)
+    if key in _indexed:
+        return
+
+    for keys in LIVE_INDEXES:
+        name = "live_" + "_".join(field for field, _ in keys)
+        collection.create_index(keys, name=name, partialFilterExpression=LIVE_FILTER)
+    collection.create_index([("removed_at", 1)], name="removed_at",
+                            partialFilterExpression={"book_shelf": {"$eq": -1}})
+    _indexed.add(key)
+
+
+def ensure_archive_indexes(archive, mongo_uri=None):
+    """Creates the identifier indexes of an archive collection, once per process."""
+    key = (mongo_uri, archive.database.name, archive.name)
+    if key in _indexed:
+        return
+    for keys in ARCHIVE_INDEXES:
+        archive.create_index(keys, name="_".join(field for field, _ in keys))
+    _indexed.add(key)
+
+
+def normalize_stored_shelves(collection):
+    """Converts book_shelf values stored as strings ("1") to integers, so the partial indexes cover them."""
+    result = collection.update_many(
+        {"book_shelf": {"$type": "string"}},
+        [{"$set": {"book_shelf": {"$convert": {"input": "$book_shelf", "to": "int", "onError": "$book_shelf"}}}}],
+    )
+    return result.modified_count
+
+
+def archive_removed_books(mongo_uri=None, db_name="test", collection_name="stored_books",
+                          older_than_days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Moves books removed more than older_than_days ago into the archive collection.
+
+    Books removed before removed_at existed have no timestamp and are archived right away.
+    Each batch is copied first and deleted afterwards, so a crash in between only leaves
+    duplicates that the next run skips (same _id).
+
+    :return: Number of books moved.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(days=older_than_days)
+    query = {"book_shelf": -1, "$or": [{"removed_at": {"$lt": cutoff}}, {"removed_at": {"$exists": False}}]}
+    moved = 0
+
+    with mongo_client(mongo_uri) as client:
+        db = client[db_name]
+        live = db[collection_name]
+        archive = db[archive_collection_name(collection_name)]
+        ensure_archive_indexes(archive, mongo_uri)
+
+        while True:
+            batch = list(live.find(query).limit(batch_size))
+            if not batch:
+                break
+
+            try:
+                archive.insert_many(batch, ordered=False)
+            except BulkWriteError as e:
+                # duplicate _ids are books copied by an earlier, interrupted run
+                if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                    raise
+
+            # only delete what is still removed (a book could have been placed again meanwhile)
+            result = live.delete_many({"_id": {"$in": [doc["_id"] for doc in batch]}, "book_shelf": -1})
+            moved += result.deleted_count
+            if len(batch) < batch_size:
+                break
+
+    return moved
+
+
+def _archiver_lock():
+    """
+    Takes an exclusive lock on ARCHIVE_LOCK_FILE without waiting, so only one of several worker processes
+    archives. The lock is kept until the process exits. Returns True if this process holds it.
+    """
+    global _lock_file
+    if fcntl is None:  # Windows: only the development server, a single process
+        return True
+    if _lock_file is not None:
+        return True
+    lock_file = open(ARCHIVE_LOCK_FILE, "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _lock_file = lock_file
+    return True
+
+
+def start_archiver(mongo_uri, db_name="test", collection_name="stored_books", interval=ARCHIVE_INTERVAL):
+    """Runs archive_removed_books every interval seconds in a daemon thread. Returns its stop event.
+
+    Every worker process starts one; only the one holding the archiver lock actually archives
+    (another takes over when that process exits).
+    """
+    stop_event = threading.Event()
+
+    def loop():
+        while not stop_event.wait(interval):
+            if not _archiver_lock():
+                continue
+            try:
+                moved = archive_removed_books(mongo_uri, db_name, collection_name)
+                if moved:
+                    print(f"📦 {moved} removed book(s) archived.")
+            except Exception as e:
+                print(f"Archiving failed: {e}")
+
+    threading.Thread(target=loop, name="archiver", daemon=True).start()
+    return stop_event
+
+
+if __name__ == "__main__":
+    from functions_flask import get_mongo_uri
+
+    parser = argparse.ArgumentParser(description="Move long-removed books into the archive collection.")
+    parser.add_argument("--days", type=float, default=ARCHIVE_AFTER_DAYS, help="archive books removed longer ago")
+    parser.add_argument("--db", default="test")
+    parser.add_argument("--collection", default="stored_books")
+    parser.add_argument("--indexes-only", action="store_true", help="only create the partial indexes")
+    args = parser.parse_args()
+
+    mongo_uri = get_mongo_uri()
+    with MongoClient(mongo_uri) as client:
+        collection = client[args.db][args.collection]
+        print(f"{normalize_stored_shelves(collection)} string book_shelf value(s) converted to integers.")
+        ensure_live_indexes(collection, mongo_uri)
+        print("Partial indexes for live books are in place.")
+
+    if not args.indexes_only:
+        print(f"{archive_removed_books(mongo_uri, args.db, args.collection, args.days)} book(s) archived.")
@@ -0,0 +1,90 @@
+import math
+from datetime import datetime, timezone
+
+
+#Fixed column schema of a stored book
+#The columns json_to_dataframe produces plus what Mongo adds (_id, description, removed_at).
+#Exports and bulk loads use it instead of letting pandas guess types from whatever the documents hold:
+#older documents have book_shelf as a string, missing values as NaN, Page Count as a float, and so on.
+
+BOOK_SCHEMA = {
+    "_id": "str",
+    "book_shelf": "int",
+    "selection_id": "int",
+    "ID": "str",
+    "Title": "str",
+    "Authors": "str",
+    "Publisher": "str",
+    "Page Count": "int",
+    "Language": "str",
+    "Category": "str",
+    "Thumbnail": "str",
+    "ISBN_13": "str",
+    "ISBN_10": "str",
+    "ISBN_canonical": "str",
+    "description": "str",
+    "removed_at": "datetime",
+}
+BOOK_PROJECTION = {column: 1 for column in BOOK_SCHEMA}
+EXPORT_BATCH_SIZE = 5000
+
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def to_int(value):
+    if _is_missing(value) or isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        return int(value) if value.is_integer() else None
+    try:
+        return int(str(value).strip())
+    except ValueError:
+        return None
+
+
+def to_str(value):
+    if _is_missing(value):
+        return None
+    return value if isinstance(value, str) else str(value)
+
+
+def to_datetime(value):
+    """Mongo returns naive datetimes in UTC."""
+    if not isinstance(value, datetime):
+        return None
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+CONVERTERS = {"int": to_int, "str": to_str, "datetime": to_datetime}
+
+
+def iter_column_batches(cursor, columns=None, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Reads documents from a cursor into typed column lists, batch_size rows at a time.
+
+    Values that do not fit a column's type become None, so every batch has the same schema.
+
+    :param cursor: Mongo cursor (ideally with BOOK_PROJECTION and batch_size set).
+    :param columns: Subset of BOOK_SCHEMA columns, default all.
+    :return: Generator of ({column: list of values}, number of rows).
+    """
+    columns = list(columns or BOOK_SCHEMA)
+    converters = [(column, CONVERTERS[BOOK_SCHEMA[column]]) for column in columns]
+    batch = {column: [] for column in columns}
+    rows = 0
+
+    for doc in cursor:
+        for column, convert in converters:
+            batch[column].append(convert(doc.get(column)))
+        rows += 1
+        if rows == batch_size:
+            yield batch, rows
+            batch = {column: [] for column in columns}
+            rows = 0
+
+    if rows:
+        yield batch, rows
@@ -0,0 +1,131 @@
+import os
+import zlib
+from itertools import chain
+
+from dotenv import load_dotenv
+from flask import request
+
+import metrics
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, without it only gzip is offered
+    brotli = None
+
+
+#Compression of responses (gzip, or brotli when the client accepts it and `pip install brotli` is done)
+#The encoding is negotiated from the Accept-Encoding header. Bodies below COMPRESSION_MIN_SIZE bytes are
+#sent as they are, the gzip header and the extra CPU are not worth it there.
+#
+#Streamed responses (the shelf endpoints, CSV exports) are compressed chunk by chunk while they are sent,
+#only the first COMPRESSION_MIN_SIZE bytes are held back to decide whether to compress at all.
+#Server-Sent Events, files and already compressed formats (Parquet, Arrow, images) are never touched.
+#
+#    app.after_request(compression.compress_response)
+
+load_dotenv(".env")
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))  # bytes
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))            # 1 (fast) - 9 (small)
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "4"))    # 0 (fast) - 11 (small), 4-5 suits dynamic responses
+
+COMPRESSIBLE_MIMETYPES = {"application/json", "text/plain", "text/csv", "text/html"}
+
+
+def available_encodings():
+    """Encodings this process can produce, preferred first (the client's q-values decide, ties go to the first)."""
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+class _BrotliCompressor:
+    """brotli.Compressor with the compress/flush interface of zlib."""
+
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+def new_compressor(encoding):
+    if encoding == "br":
+        return _BrotliCompressor(BROTLI_QUALITY)
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # wbits 31 = gzip header and trailer
+
+
+def compress_chunks(chunks, encoding, source=None):
+    """
+    Compresses an iterable of bytes lazily, yielding output as soon as the compressor releases some.
+
+    :param source: The original response iterable, closed at the end (database cursors, request context).
+    """
+    compressor = new_compressor(encoding)
+    size_in = size_out = 0
+    try:
+        for chunk in chunks:
+            size_in += len(chunk)
+            data = compressor.compress(chunk)
+            if data:
+                size_out += len(data)
+                yield data
+        data = compressor.flush()
+        size_out += len(data)
+        yield data
+    finally:
+        close = getattr(source, "close", None)
+        if close is not None:
+            close()
+        metrics.inc("gb4f_compression_input_bytes_total", size_in, encoding=encoding)
+        metrics.inc("gb4f_compression_output_bytes_total", size_out, encoding=encoding)
+
+
+def _should_compress(response):
+    return (request.method != "HEAD"
+            and 200 <= response.status_code < 300 and response.status_code not in (204, 206)
+            and not response.direct_passthrough
+            and "Content-Encoding" not in response.headers
+            and "Content-Range" not in response.headers
+            and response.mimetype in COMPRESSIBLE_MIMETYPES)
+
+
+def compress_response(response):
+    """after_request hook: compresses the response if the client accepts it and it is large enough."""
+    if not _should_compress(response):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = request.accept_encodings.best_match(available_encodings())
+    if encoding is None:
+        return response
+
+    if not response.is_streamed:
+        data = response.get_data()
+        if len(data) < COMPRESSION_MIN_SIZE:
+            return response
+        response.set_data(b"".join(compress_chunks([data], encoding)))
+        response.headers["Content-Encoding"] = encoding
+        return response
+
+    # Streamed body: look at the first chunks only, a short stream is sent uncompressed
+    source = response.response
+    body = response.iter_encoded()
+    head = []
+    size = 0
+    for chunk in body:
+        head.append(chunk)
+        size += len(chunk)
+        if size >= COMPRESSION_MIN_SIZE:
+            break
+    else:
+        close = getattr(source, "close", None)
+        if close is not None:
+            close()
+        response.set_data(b"".join(head))
+        return response
+
+    response.response = compress_chunks(chain(head, body), encoding, source)
+    response.headers.pop("Content-Length", None)
+    response.headers["Content-Encoding"] = encoding
+    return response
@@ -0,0 +1,61 @@
+import os
+import threading
+from contextlib import contextmanager
+
+import requests
+from pymongo import MongoClient
+
+
+#Connections shared within one process
+#A MongoClient holds a connection pool and background monitor threads, a requests.Session a pool of
+#keep-alive HTTP connections. Both are meant to be created once and used by all threads, but neither
+#survives a fork: a child that keeps using the parent's client shares its sockets.
+#
+#So both are created lazily per process ID. When gunicorn (preload_app) forks its workers, every
+#worker builds its own on first use; reset_after_fork also drops the inherited ones right after the fork.
+
+_clients = {}  # (pid, mongo_uri) -> MongoClient
+_sessions = {}  # pid -> requests.Session
+_lock = threading.Lock()
+
+
+def get_client(mongo_uri=None):
+    """Returns this process' MongoClient for mongo_uri."""
+    key = (os.getpid(), mongo_uri)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = MongoClient(mongo_uri)
+    return client
+
+
+@contextmanager
+def mongo_client(mongo_uri=None):
+    """Drop-in for `with MongoClient(mongo_uri) as client:` that reuses the shared client instead of closing it."""
+    yield get_client(mongo_uri)
+
+
+def http_session():
+    """Returns this process' requests.Session (keep-alive connections to Google Books and Open Library)."""
+    pid = os.getpid()
+    session = _sessions.get(pid)
+    if session is None:
+        with _lock:
+            session = _sessions.get(pid)
+            if session is None:
+                session = _sessions[pid] = requests.Session()
+    return session
+
+
+def reset_after_fork():
+    """Forgets the connections inherited from the parent process (they belong to its sockets)."""
+    global _lock
+    _lock = threading.Lock()  # the parent may have held it while forking
+    _clients.clear()
+    _sessions.clear()
+
+
+if hasattr(os, "register_at_fork"):  # not on Windows, which does not fork anyway
+    os.register_at_fork(after_in_child=reset_after_fork)
@@ -0,0 +1,290 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from bson import ObjectId
+from dotenv import load_dotenv
+
+from connections import mongo_client
+from functions_flask import open_library_API_ISBN_to_description
+from isbn import record_canonical_isbn
+from libraries import mongo_uri_for
+from result_cache import bump_shelf_version
+from shelf_changes import change_stamp
+import metrics
+
+
+#Background description enrichment
+#/search_books can hand the Open Library lookups to this queue instead of doing them inline.
+#Jobs and their tasks live in a small SQLite file, so work that is pending (or was running when the
+#process died) is picked up again after a restart. A pool of worker threads claims one task at a time.
+#
+#A "search" job holds the Google Books rows of one /search_books call, one task per row.
+#A "backfill" job fills the description of books already stored in Mongo, one task per document.
+
+load_dotenv(".env")
+ENRICHMENT_DB = os.getenv("ENRICHMENT_DB", "enrichment_jobs.db")
+ENRICHMENT_WORKERS = int(os.getenv("ENRICHMENT_WORKERS", "2"))
+ENRICHMENT_LEASE = 120  # seconds before a "running" task of a dead worker is handed out again
+ENRICHMENT_MAX_ATTEMPTS = 3
+ENRICHMENT_JOB_TTL = 24 * 3600  # finished jobs are deleted after a day
+NO_DESCRIPTION = "No description available."
+
+_workers = []
+_wake_up = threading.Event()
+
+
+@contextmanager
+def _connect():
+    conn = sqlite3.connect(ENRICHMENT_DB, timeout=30, isolation_level=None)  # autocommit, explicit BEGIN below
+    conn.row_factory = sqlite3.Row
+    try:
+        yield conn
+    finally:
+        conn.close()  # an unfinished transaction is rolled back here
+
+
+def init_queue():
+    """Creates the queue tables if needed."""
+    with _connect() as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                finished_at REAL,
+                rows TEXT,
+                db_name TEXT,
+                collection_name TEXT
+            );
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_id TEXT NOT NULL,
+                row_index INTEGER,
+                mongo_id TEXT,
+                isbn TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                locked_at REAL,
+                description TEXT
+            );
+            CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, task_id);
+            CREATE INDEX IF NOT EXISTS tasks_job ON tasks (job_id);
+        """)
+
+
+def _row_isbn(record):
+    """The canonical ISBN (see isbn.py), else whatever ISBN_13 or ISBN_10 holds."""
+    canonical = record_canonical_isbn(record)
+    if canonical:
+        return canonical
+    for key in ("ISBN_13", "ISBN_10"):
+        value = record.get(key)
+        if isinstance(value, str) and value:
+            return value
+    return None
+
+
+def _create_job(kind, tasks, rows=None, db_name=None, collection_name=None):
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    status = "pending" if tasks else "done"
+
+    with _connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            "INSERT INTO jobs (job_id, kind, status, created_at, finished_at, rows, db_name, collection_name) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, kind, status, now, None if tasks else now,
+             json.dumps(rows) if rows is not None else None, db_name, collection_name),
+        )
+        conn.executemany(
+            "INSERT INTO tasks (job_id, row_index, mongo_id, isbn, status) VALUES (?, ?, ?, ?, 'pending')",
+            [(job_id, row_index, mongo_id, isbn) for row_index, mongo_id, isbn in tasks],
+        )
+        conn.execute("COMMIT")
+
+    _wake_up.set()
+    return job_id
+
+
+def enqueue_search_job(books_df):
+    """Stores the rows of a /search_books result and queues one description lookup per row with an ISBN.
+
+    :param books_df: DataFrame from json_to_dataframe.
+    :return: The job ID.
+    """
+    rows = books_df.to_dict(orient="records")
+    tasks = [(i, None, isbn) for i, isbn in enumerate(_row_isbn(row) for row in rows) if isbn]
+    return _create_job("search", tasks, rows=rows)
+
+
+def enqueue_backfill_job(mongo_uri, db_name="test", collection_name="stored_books", limit=None):
+    """Queues description lookups for stored books that have an ISBN but no description yet.
+
+    :return: The job ID.
+    """
+    query = {
+        "description": {"$exists": False},
+        # empty strings are what json_to_dataframe stores for a missing identifier
+        "$or": [{"ISBN_13": {"$type": "string", "$ne": ""}}, {"ISBN_10": {"$type": "string", "$ne": ""}}],
+    }
+    with mongo_client(mongo_uri) as client:
+        cursor = client[db_name][collection_name].find(query, {"ISBN_13": 1, "ISBN_10": 1})
+        if limit:
+            cursor = cursor.limit(int(limit))
+        docs = [(str(doc["_id"]), _row_isbn(doc)) for doc in cursor]
+    # the tasks table needs an isbn for every row
+    tasks = [(None, book_id, isbn) for book_id, isbn in docs if isbn]
+
+    return _create_job("backfill", tasks, db_name=db_name, collection_name=collection_name)
+
+
+def claim_task():
+    """Hands out the oldest pending task (or one whose worker died) and marks it as running."""
+    now = time.time()
+    with _connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")  # write lock, so two processes never claim the same task
+        task = conn.execute(
+            "SELECT t.*, j.kind, j.db_name, j.collection_name FROM tasks t JOIN jobs j ON j.job_id = t.job_id "
+            "WHERE t.status = 'pending' OR (t.status = 'running' AND t.locked_at < ?) "
+            "ORDER BY t.task_id LIMIT 1",
+            (now - ENRICHMENT_LEASE,),
+        ).fetchone()
+        if task is not None:
+            conn.execute(
+                "UPDATE tasks SET status = 'running', locked_at = ?, attempts = attempts + 1 WHERE task_id = ?",
+                (now, task["task_id"]),
+            )
+        conn.execute("COMMIT")
+    return dict(task) if task is not None else None
+
+
+def finish_task(task_id, job_id, description=None, failed=False):
+    """Stores the result of a task and closes the job once all of its tasks are finished."""
+    with _connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            "UPDATE tasks SET status = ?, description = ? WHERE task_id = ?",
+            ("failed" if failed else "done", description, task_id),
+        )
+        open_tasks = conn.execute(
+            "SELECT COUNT(*) FROM tasks WHERE job_id = ? AND status IN ('pending', 'running')", (job_id,)
+        ).fetchone()[0]
+        if open_tasks == 0:
+            conn.execute("UPDATE jobs SET status = 'done', finished_at = ? WHERE job_id = ?", (time.time(), job_id))
+        conn.execute("COMMIT")
+
+
+def process_task(task, mongo_uri=None):
+    """Looks up the description of one task; backfill tasks also write it to the stored book."""
+    description = open_library_API_ISBN_to_description(task["isbn"])
+
+    if task["kind"] == "backfill" and description != NO_DESCRIPTION:
+        mongo_uri = mongo_uri or mongo_uri_for(task["db_name"], task["collection_name"])
+        with mongo_client(mongo_uri) as client:
+            db = client[task["db_name"]]
+            db[task["collection_name"]].update_one(
+                {"_id": ObjectId(task["mongo_id"])},
+                {"$set": {"description": description, **change_stamp(db, task["collection_name"])}}
+            )
+            bump_shelf_version(db, task["collection_name"], mongo_uri)
+    return description
+
+
+def _worker_loop(stop_event):
+    while not stop_event.is_set():
+        task = claim_task()
+        if task is None:
+            # Nothing to do: sleep until a new job arrives (or poll again, other processes may enqueue too)
+            _wake_up.wait(timeout=5)
+            _wake_up.clear()
+            continue
+
+        try:
+            with metrics.timed("background_enrichment"):
+                description = process_task(task)
+            finish_task(task["task_id"], task["job_id"], description)
+        except Exception as e:
+            print(f"Enrichment task {task['task_id']} failed: {e}")
+            if task["attempts"] + 1 >= ENRICHMENT_MAX_ATTEMPTS:
+                finish_task(task["task_id"], task["job_id"], NO_DESCRIPTION, failed=True)
+            else:
+                with _connect() as conn:
+                    conn.execute("UPDATE tasks SET status = 'pending' WHERE task_id = ?", (task["task_id"],))
+
+
+def start_workers(n_workers=ENRICHMENT_WORKERS):
+    """Starts the background worker threads once per process and returns their stop event."""
+    if _workers and _workers[0][0].is_alive():
+        return _workers[0][1]
+    _workers.clear()  # threads inherited through a fork are dead in the child
+
+    init_queue()
+    purge_finished_jobs()
+    stop_event = threading.Event()
+    for i in range(n_workers):
+        worker = threading.Thread(target=_worker_loop, args=(stop_event,), name=f"enrichment-{i}", daemon=True)
+        worker.start()
+        _workers.append((worker, stop_event))
+    return stop_event
+
+
+def get_job(job_id):
+    """Returns the status of a job and, for search jobs, the rows with all descriptions found so far.
+
+    :return: A dict, or None if the job ID is unknown.
+    """
+    with _connect() as conn:
+        job = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if job is None:
+            return None
+        tasks = conn.execute(
+            "SELECT row_index, mongo_id, status, description FROM tasks WHERE job_id = ?", (job_id,)
+        ).fetchall()
+
+    finished = sum(task["status"] in ("done", "failed") for task in tasks)
+    result = {
+        "job_id": job_id,
+        "kind": job["kind"],
+        "status": job["status"],
+        "tasks_total": len(tasks),
+        "tasks_finished": finished,
+    }
+
+    if job["rows"] is not None:
+        rows = json.loads(job["rows"])
+        for task in tasks:
+            if task["description"] is not None:
+                rows[task["row_index"]]["description"] = task["description"]
+        result["books"] = rows
+
+    return result
+
+
+def job_descriptions(job_id):
+    """Returns {row_index: description} for the finished tasks of a search job."""
+    with _connect() as conn:
+        tasks = conn.execute(
+            "SELECT row_index, description FROM tasks WHERE job_id = ? AND description IS NOT NULL", (job_id,)
+        ).fetchall()
+    return {task["row_index"]: task["description"] for task in tasks}
+
+
+def purge_finished_jobs(max_age=ENRICHMENT_JOB_TTL):
+    """Deletes finished jobs (and their tasks) older than max_age seconds."""
+    cutoff = time.time() - max_age
+    with _connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            "DELETE FROM tasks WHERE job_id IN (SELECT job_id FROM jobs WHERE status = 'done' AND finished_at < ?)",
+            (cutoff,),
+        )
+        conn.execute("DELETE FROM jobs WHERE status = 'done' AND finished_at < ?", (cutoff,))
+        conn.execute("COMMIT")
@@ -0,0 +1,188 @@
+import argparse
+import csv
+import io
+import zlib
+
+from archive import LIVE_FILTER, archive_collection_name
+from book_schema import BOOK_PROJECTION, BOOK_SCHEMA, EXPORT_BATCH_SIZE, iter_column_batches
+from connections import mongo_client
+from functions_flask import normalize_book_shelf
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # only needed for Parquet and Arrow, CSV works without
+    pa = None
+
+
+#Export of the shelf to Parquet, Arrow IPC or CSV
+#Reads the collection with a cursor in batches of EXPORT_BATCH_SIZE and writes every batch as soon as it
+#is read, so memory depends on the batch size and not on the size of the shelf. The columns and types
+#are fixed by book_schema.BOOK_SCHEMA, every export of every shelf has the same schema.
+#
+#    python export_shelf.py books.parquet                     live books
+#    python export_shelf.py removed.arrow --shelf -1          removed books (incl. archive)
+#    python export_shelf.py books.csv.gz                      gzip compressed CSV
+#
+#Arrow files can be memory-mapped by readers (pyarrow.memory_map + pyarrow.ipc.open_file) without copying.
+#Parquet and Arrow need pyarrow (pip install pyarrow).
+
+FORMATS = {
+    # format: (file extension, mimetype, allowed compressions, default compression)
+    "csv": ("csv", "text/csv", (None, "gzip"), None),
+    "parquet": ("parquet", "application/vnd.apache.parquet", (None, "snappy", "gzip", "zstd"), "snappy"),
+    "arrow": ("arrow", "application/vnd.apache.arrow.file", (None, "lz4", "zstd"), None),
+}
+
+
+def arrow_schema():
+    if pa is None:
+        raise ImportError("pyarrow is not installed, use format csv or pip install pyarrow")
+    types = {"int": pa.int64(), "str": pa.string(), "datetime": pa.timestamp("us", tz="UTC")}
+    return pa.schema([(column, types[kind]) for column, kind in BOOK_SCHEMA.items()])
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object that keeps what was written until it is drained (for streaming responses)."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _csv_chunks(batches, compression):
+    compressor = zlib.compressobj(wbits=31) if compression == "gzip" else None  # wbits=31: gzip container
+    text = io.StringIO()
+    writer = csv.writer(text)
+    writer.writerow(BOOK_SCHEMA)
+
+    def encoded():
+        data = text.getvalue().encode("utf-8")
+        text.seek(0)
+        text.truncate()
+        return compressor.compress(data) if compressor else data
+
+    yield encoded()
+    for batch, rows in batches:
+        columns = [batch[column] for column in BOOK_SCHEMA]
+        writer.writerows(["" if value is None else value.isoformat() if hasattr(value, "isoformat") else value
+                          for value in row] for row in zip(*columns))
+        yield encoded()
+    if compressor:
+        yield compressor.flush()
+
+
+def _arrow_chunks(fmt, batches, compression):
+    schema = arrow_schema()
+    sink = _ChunkSink()
+    if fmt == "parquet":
+        writer = pq.ParquetWriter(sink, schema, compression=compression or "none")
+    else:
+        options = pa.ipc.IpcWriteOptions(compression=compression)
+        writer = pa.ipc.new_file(sink, schema, options=options)
+
+    with writer:
+        for batch, rows in batches:
+            record_batch = pa.record_batch([pa.array(batch[field.name], type=field.type) for field in schema],
+                                           schema=schema)
+            if fmt == "parquet":
+                writer.write_batch(record_batch)
+            else:
+                writer.write(record_batch)
+            yield sink.drain()
+    yield sink.drain()  # footer
+
+
+def export_query(book_shelf=None, include_removed=False, collection_name="stored_books"):
+    """Returns (query, collection names) for an export, same shelf semantics as or_filter_mongo."""
+    book_shelf = normalize_book_shelf(book_shelf)
+    if book_shelf == -1:
+        return {"book_shelf": -1}, [collection_name, archive_collection_name(collection_name)]
+    if book_shelf is not None:
+        return {"book_shelf": book_shelf}, [collection_name]
+    if include_removed:
+        return {}, [collection_name, archive_collection_name(collection_name)]
+    return LIVE_FILTER, [collection_name]
+
+
+def export_chunks(fmt, mongo_uri=None, db_name="test", collection_name="stored_books", book_shelf=None,
+                  include_removed=False, compression="default", batch_size=EXPORT_BATCH_SIZE):
+    """
+    Exports books as a stream of bytes chunks, one (or a few) per batch read from Mongo.
+
+    :param fmt: "csv", "parquet" or "arrow".
+    :param book_shelf: Only this shelf (-1 = removed books incl. archive); default all live books.
+    :param include_removed: With no book_shelf, also export removed and archived books.
+    :param compression: See FORMATS; "default" uses the format's default.
+    :return: Generator of bytes.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt}, use one of {', '.join(FORMATS)}")
+    _, _, compressions, default = FORMATS[fmt]
+    compression = default if compression == "default" else compression or None
+    if compression not in compressions:
+        raise ValueError(f"Compression {compression} is not supported for {fmt}")
+    if fmt != "csv":
+        arrow_schema()  # fail before streaming if pyarrow is missing
+
+    query, collection_names = export_query(book_shelf, include_removed, collection_name)
+
+    def batches():
+        with mongo_client(mongo_uri) as client:
+            for name in collection_names:
+                cursor = client[db_name][name].find(query, BOOK_PROJECTION).batch_size(batch_size)
+                yield from iter_column_batches(cursor, batch_size=batch_size)
+
+    if fmt == "csv":
+        return _csv_chunks(batches(), compression)
+    return _arrow_chunks(fmt, batches(), compression)
+
+
+def export_filename(fmt, compression="default"):
+    extension = FORMATS[fmt][0]
+    return f"gb4f_books.{extension}.gz" if fmt == "csv" and compression == "gzip" else f"gb4f_books.{extension}"
+
+
+if __name__ == "__main__":
+    import time
+
+    from functions_flask import get_mongo_uri
+
+    parser = argparse.ArgumentParser(description="Export the shelf to Parquet, Arrow IPC or CSV in batches.")
+    parser.add_argument("output", help="output file, the format is taken from the extension unless --format is given")
+    parser.add_argument("--format", choices=list(FORMATS), default=None)
+    parser.add_argument("--compression", default="default", help="csv: gzip; parquet: snappy/gzip/zstd; arrow: lz4/zstd")
+    parser.add_argument("--shelf", default=None, help="only this shelf, -1 for removed books")
+    parser.add_argument("--include-removed", action="store_true", help="also export removed and archived books")
+    parser.add_argument("--batch-size", type=int, default=EXPORT_BATCH_SIZE)
+    parser.add_argument("--db", default="test")
+    parser.add_argument("--collection", default="stored_books")
+    args = parser.parse_args()
+
+    fmt = args.format or next((name for name, (extension, *_) in FORMATS.items()
+                               if args.output.endswith("." + extension) or args.output.endswith(f".{extension}.gz")), None)
+    if fmt is None:
+        parser.error("cannot tell the format from the file name, use --format")
+    compression = args.compression if args.compression.lower() != "none" else None
+    if fmt == "csv" and compression == "default" and args.output.endswith(".gz"):
+        compression = "gzip"
+
+    started = time.perf_counter()
+    written = 0
+    with open(args.output, "wb") as output:
+        for chunk in export_chunks(fmt, get_mongo_uri(), args.db, args.collection, args.shelf, args.include_removed,
+                                   compression, args.batch_size):
+            output.write(chunk)
+            written += len(chunk)
+    print(f"{written} bytes written to {args.output} in {time.perf_counter() - started:.1f}s")
@@ -1,5 +1,5 @@
 import pandas as pd
-from flask import Flask, request, jsonify, send_from_directory, Response
+from flask import Flask, request, jsonify, send_from_directory, Response, stream_with_context
 import requests
 from requests.exceptions import ConnectionError, Timeout, TooManyRedirects
 import json
@@ -10,12 +10,112 @@ from functions_flask import *
 import os
 from dotenv import load_dotenv
 from bson import ObjectId, errors
+import time
+import metrics
+import profiling
+import enrichment_queue
+import shelf_stats
+import archive
+import fuzzy_search
+import export_shelf
+import search_sessions
+import shelf_changes
+import write_behind
+import compression
+import libraries
 
 #.env contains a uri to connect to the mongo db database 
 load_dotenv(".env")
 
 app = Flask(__name__)
 
+# Search results live in search_sessions (shared by all worker processes), not in module globals
+enrichment_queue.init_queue()
+search_sessions.init_sessions()
+if write_behind.WRITE_BEHIND:
+    write_behind.init_journal()
+
+_services_pid = None
+
+def start_background_services():
+    """Starts the background threads of this process: enrichment workers and the archiver.
+
+    Threads do not survive a fork, so this runs per worker process (gunicorn.conf.py post_fork, or
+    lazily on the first request for the development server), never at import time.
+    """
+    global _services_pid
+    if _services_pid == os.getpid():
+        return
+    _services_pid = os.getpid()
+
+    # Snapshots of this process' metrics for /metrics of the other workers (METRICS_MULTIPROC_DIR)
+    metrics.start_snapshot_writer()
+
+    # Worker threads that fill descriptions for async searches and backfills
+    if enrichment_queue.ENRICHMENT_WORKERS > 0:
+        enrichment_queue.start_workers()
+
+    # Writes journaled selections to Mongo in batches (WRITE_BEHIND=1), each to the cluster of its library
+    if write_behind.WRITE_BEHIND:
+        write_behind.start_flusher()
+
+    # Periodically move long-removed books to the archive collection (off unless ARCHIVE_INTERVAL is set)
+    if archive.ARCHIVE_INTERVAL > 0:
+        for lib in libraries.LIBRARIES.values():
+            archive.start_archiver(lib.mongo_uri, db_name=lib.db_name, collection_name=lib.collection_name)
+
+app.before_request(start_background_services)
+
+# The library (branch) of the request, from the X-Library header, see libraries.py
+app.before_request(libraries.select_library)
+
+@app.before_request
+def start_request_timer():
+    if metrics.METRICS_ENABLED:
+        request.environ["gb4f.start"] = time.perf_counter()
+
+@app.after_request
+def record_request_duration(response):
+    start = request.environ.get("gb4f.start")
+    if start is not None:
+        labels = {"endpoint": request.endpoint or "unknown", "method": request.method,
+                  "status": response.status_code, "library": libraries.current_library().name}
+        if response.is_streamed:
+            # streamed bodies are produced while they are sent, the request ends when the response is closed
+            response.call_on_close(
+                lambda: metrics.observe("gb4f_http_request_duration_seconds", time.perf_counter() - start, **labels))
+        else:
+            metrics.observe("gb4f_http_request_duration_seconds", time.perf_counter() - start, **labels)
+    return response
+
+app.before_request(profiling.start_profile)
+app.after_request(profiling.finish_profile)
+app.teardown_request(profiling.abort_profile)
+
+# Registered last so it runs first: the timing and profiling hooks above see the response as the view built it
+app.after_request(compression.compress_response)
+
+@app.route('/profiles', methods=['GET'])
+def list_profiles():
+    """Lists stored request profiles. Needs the same token as the X-Profile header."""
+    if not profiling.profile_requested():
+        return jsonify({"error": "Missing or wrong profile token"}), 403
+    return jsonify(profiling.list_profiles())
+
+@app.route('/profiles/<path:file_name>', methods=['GET'])
+def download_profile(file_name):
+    """Downloads one profile file (<id>.pstats or <id>.collapsed)."""
+    if not profiling.profile_requested():
+        return jsonify({"error": "Missing or wrong profile token"}), 403
+    return send_from_directory(profiling.PROFILE_DIR, file_name, as_attachment=True)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Exposes the collected timings and counters in the Prometheus text format."""
+    if not metrics.METRICS_ENABLED:
+        return jsonify({"error": "Metrics are disabled, set METRICS_ENABLED=1"}), 404
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
 @app.route('/')
 def home():
     return "Welcome to the Book API! Use /search_books, /select_book, and /get_selected_books."
@@ -26,9 +126,10 @@ def favicon():
 
 @app.route('/search_books', methods=['POST'])
 def search_books():
-    """Receives a JSON query and fetches matching books from Google Books API."""
-    global API_books_df  # Declare it as global
-    
+    """Receives a JSON query and fetches matching books from Google Books API.
+
+    The search_id for /select_book is in the X-Search-Id header (and in the body of async responses).
+    """
     query_params = request.get_json() #this accepts a dict in the API format
     '''
     {
@@ -36,72 +137,217 @@ def search_books():
     "inauthor": "Guido",
     "isbn": "9781449355739"
     "book_shelf": "1"
-} 
+    "async_enrichment": true   <-- optional, return at once and fill descriptions in the background
+    "maxResults": 10           <-- optional (1-40, default 5), also "langRestrict" (default "de", "" = all)
+    "printType": "books"       <-- and "printType" (all, books, magazines)
+    "hybrid": true             <-- optional, books already stored (also removed ones) first, with "shelf_status"
+}
+Header "X-Library: <name>" (all endpoints) picks the library whose shelves are used, see libraries.py
 '''
+    lib = libraries.current_library()
     #extract the book_shelf info, since this is independent of the API
     book_shelf = query_params.pop("book_shelf", -1)
-
+    async_enrichment = bool(query_params.pop("async_enrichment", False))
+    hybrid = bool(query_params.pop("hybrid", False))
+    try:
+        fetch_options = pop_fetch_options(query_params)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     if not query_params:
         return jsonify({"error": "Request body must contain JSON data"}), 400
 
-    # Use the extracted JSON as query parameters
-    raw_data = fetch_books_data(query_params)
-    # Convert to Dataframe
-    API_books_df= json_to_dataframe(raw_data, book_shelf)
+    if hybrid:
+        # shelf lookup and Google Books run at the same time (descriptions only for the Google rows)
+        books_df = hybrid_search(query_params, book_shelf, fetch_options, describe=not async_enrichment,
+                                 mongo_uri=lib.mongo_uri, db_name=lib.db_name, collection_name=lib.collection_name)
+    else:
+        # Use the extracted JSON as query parameters
+        raw_data = fetch_books_data(query_params, fetch_options)
+        # Convert to Dataframe
+        books_df = json_to_dataframe(raw_data, book_shelf)
+        # "already on shelf X / removed" per row, one batched lookup
+        annotate_shelf_membership(books_df, lib.mongo_uri, db_name=lib.db_name, collection_name=lib.collection_name)
+
+    metrics.record_result_count("search_books", len(books_df))
+
+    if books_df.empty:
+        return jsonify({"message": "No books found for this query"}), 404
 
-    
-    
+    if async_enrichment:
+        #descriptions are looked up by the worker pool, poll /enrichment_jobs/<job_id> for them
+        job_id = enrichment_queue.enqueue_search_job(books_df)
+        # outside hybrid searches the membership columns are only shown, /select_book stores the row as it is
+        search_id = search_sessions.save_search(books_df if hybrid else books_df.drop(columns=MEMBERSHIP_COLUMNS),
+                                                job_id, library=lib.name)
+        with metrics.timed("serialize_search_books"):
+            return jsonify({
+                "search_id": search_id,
+                "job_id": job_id,
+                "status_url": f"/enrichment_jobs/{job_id}",
+                "books": books_df.to_dict(orient="records"),
+            }), 202, {"X-Search-Id": search_id}
 
-    if API_books_df.empty:
-        return jsonify({"message": "No books found for this query"}), 404
-    
     #if books were found also add a description using open library API
-    add_description_by_isbn(API_books_df)
+    if not hybrid:
+        add_description_by_isbn(books_df)
+    search_id = search_sessions.save_search(books_df if hybrid else books_df.drop(columns=MEMBERSHIP_COLUMNS),
+                                            library=lib.name)
+
+    with metrics.timed("serialize_search_books"):
+        return jsonify(books_df.to_dict(orient="records")), 200, {"X-Search-Id": search_id}
 
-    return jsonify(API_books_df.to_dict(orient="records"))
+
+def _sse(event, data):
+    """Formats one Server-Sent Event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/search_books_stream', methods=['GET', 'POST'])
+def search_books_stream():
+    """Streaming variant of /search_books using Server-Sent Events.
+
+    Sends the Google Books rows right away ("books" event), then one "description" event
+    per row as its Open Library lookup finishes, and a final "done" event.
+    Accepts the same JSON body as /search_books, or the same keys as query parameters for GET (EventSource).
+    The search_id for /select_book is in the X-Search-Id header and in the "done" event.
+    """
+
+    lib = libraries.current_library()
+    if request.method == 'POST':
+        query_params = dict(request.get_json(silent=True) or {})
+    else:
+        # an EventSource URL also carries ?library=, ?profile=, ..., only search terms and options go to Google
+        allowed = SEARCH_TERMS + tuple(FETCH_OPTION_DEFAULTS) + ("book_shelf",)
+        query_params = {key: value for key, value in request.args.items() if key in allowed}
+    book_shelf = query_params.pop("book_shelf", -1)
+    try:
+        fetch_options = pop_fetch_options(query_params)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if not query_params:
+        return jsonify({"error": "Request body must contain JSON data"}), 400
+
+    raw_data = fetch_books_data(query_params, fetch_options)
+    books_df = json_to_dataframe(raw_data, book_shelf)
+    annotate_shelf_membership(books_df, lib.mongo_uri, db_name=lib.db_name, collection_name=lib.collection_name)
+    metrics.record_result_count("search_books_stream", len(books_df))
+
+    if books_df.empty:
+        return jsonify({"message": "No books found for this query"}), 404
+
+    # the membership columns are only shown, /select_book stores the row as it is
+    search_id = search_sessions.save_search(books_df.drop(columns=MEMBERSHIP_COLUMNS), library=lib.name)
+
+    def generate():
+        # NaN is not valid JSON for browsers, send null instead
+        rows = books_df.astype(object).where(books_df.notna(), None).to_dict(orient="records")
+        yield _sse("books", rows)
+
+        found = 0
+        for index, description in iter_descriptions_by_isbn(books_df):
+            search_sessions.set_description(search_id, index, description)  # keeps /select_book in sync with the stream
+            found += 1
+            yield _sse("description", {"selection_id": int(books_df.loc[index, "selection_id"]), "description": description})
+
+        yield _sse("done", {"books": len(books_df), "descriptions": found, "search_id": search_id})
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Search-Id": search_id})
 
 
 @app.route('/select_book', methods=['POST'])
 def select_book_API():
     """Selects a book from the previous search results using selection_id.
-    {"selection_id":1}
-    
-    """
-    global API_books_df # Access global variable
+    {"selection_id":1, "search_id": "..."}   <-- search_id from /search_books, default the latest search
+    "move": true                              <-- optional, hybrid searches: move a book that is on another shelf
+                                                  instead of storing a second copy (removed books are always restored)
 
+    With WRITE_BEHIND=1 the book is journaled and written to Mongo shortly after (202 with its _id),
+    503 if too many selections are waiting.
+    """
     data = request.get_json()
     selection_id = data.get("selection_id")
+    lib = libraries.current_library()
 
-    if API_books_df is None:
+    search = search_sessions.load_search(data.get("search_id"), library=lib.name)
+    if search is None:
         return jsonify({"error": "No active book search found"}), 400
+    search_id, books_df, job_id = search
 
-    selected_book = API_books_df[API_books_df["selection_id"] == selection_id]
+    selected_book = books_df[books_df["selection_id"] == selection_id]
 
     if selected_book.empty:
         return jsonify({"error": "Invalid selection_id"}), 404
 
+    # Take over the descriptions the background workers found so far
+    if job_id is not None:
+        descriptions = enrichment_queue.job_descriptions(job_id)
+        found = [descriptions.get(i) for i in selected_book.index]
+        if any(description is not None for description in found):
+            selected_book = selected_book.assign(description=found)
 
     # Get MongoDB client (connected to Atlas)
-    # Get MongoDB Atlas URI from .env
-    mongo_uri = get_mongo_uri()
+    # Get MongoDB Atlas URI from .env (MONGO_URI_<LIBRARY> for libraries on a cluster of their own)
+    mongo_uri = lib.mongo_uri
+
+    # A removed book of a hybrid search is put back on the shelf (a shelved one moved with "move"), not stored twice
+    restored_ID = restore_known_book(selected_book, bool(data.get("move", False)), mongo_uri, db_name=lib.db_name,
+                                     collection_name=lib.collection_name)
+    if restored_ID is not None:
+        search_sessions.delete_search(search_id)
+        return jsonify({"message": "Book selected successfully!", "_id": restored_ID})
+    selected_book = selected_book.drop(columns=HYBRID_COLUMNS, errors="ignore")
+
+    if write_behind.WRITE_BEHIND:
+        book_ids = write_behind.enqueue_books(prepare_books(selected_book), db_name=lib.db_name,
+                                              collection_name=lib.collection_name)
+        if book_ids is None:
+            return jsonify({"error": "Too many selections waiting to be stored, try again shortly"}), 503, {"Retry-After": "5"}
+        search_sessions.delete_search(search_id)
+        return jsonify({"message": "Book selected successfully!", "_id": book_ids[0]}), 202
 
     # Save to mongodb
-    place_book_in_mongo(selected_book, mongo_uri, db_name="test", collection_name="stored_books")  # Insert into MongoDB
+    place_book_in_mongo(selected_book, mongo_uri, db_name=lib.db_name, collection_name=lib.collection_name)  # Insert into MongoDB
 
-    # **Flush API_books_df after selection**
-    API_books_df = None  
+    # **Flush the search after selection**
+    search_sessions.delete_search(search_id)
 
     return jsonify({"message": "Book selected successfully!"})
 
 
 @app.route('/get_selected_books', methods=['GET'])
 def get_selected_books():
-    """Fetch all selected books from MongoDB and return as JSON."""
-    mongo_uri = get_mongo_uri()
-    df = import_from_mongo(mongo_uri)  # Fetch from MongoDB
-    
-    return jsonify(df.to_dict(orient="records"))
+    """Fetch all selected books from MongoDB and return as JSON (streamed, compressed by compression.py)."""
+    lib = libraries.current_library()
+    books = stream_mongo_json(lib.mongo_uri, {}, [lib.collection_name], db_name=lib.db_name)
+    return Response(books, mimetype="application/json")
+
+
+@app.route('/export_books', methods=['GET'])
+def export_books():
+    """Streams the shelf as a file, batch by batch, without loading it into a DataFrame.
+    /export_books?format=parquet            formats: parquet, arrow (need pyarrow) and csv
+    &compression=zstd                       csv: gzip; parquet: snappy (default), gzip, zstd; arrow: lz4, zstd
+    &book_shelf=1                           one shelf, -1 for removed books; default all live books
+    &include_removed=1                      all books, removed and archived ones included
+    """
+    fmt = request.args.get("format", "parquet")
+    compression = request.args.get("compression", "default")
+    lib = libraries.current_library()
+    try:
+        chunks = export_shelf.export_chunks(fmt, lib.mongo_uri, db_name=lib.db_name, collection_name=lib.collection_name,
+                                            book_shelf=request.args.get("book_shelf"),
+                                            include_removed=request.args.get("include_removed") in ("1", "true"),
+                                            compression=compression)
+    except (ValueError, ImportError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    file_name = export_shelf.export_filename(fmt, compression)
+    # a .csv.gz is already compressed, the response compression only picks up text mimetypes
+    mimetype = "application/gzip" if file_name.endswith(".gz") else export_shelf.FORMATS[fmt][1]
+    return Response(stream_with_context(chunks), mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment; filename={file_name}"})
 
 
 @app.route('/search_books_in_mongo', methods=['POST'])
@@ -125,14 +371,95 @@ def search_books_in_mongo():
 
     query_params_uni= unify_json_inX_to_X(query_params)
 
-    mongo_uri=get_mongo_uri()
+    lib = libraries.current_library()
 
-    selected_books = or_filter_mongo(query_params_uni, mongo_uri=get_mongo_uri(), db_name="test", collection_name="stored_books")
+    selected_books = or_filter_mongo(query_params_uni, mongo_uri=lib.mongo_uri, db_name=lib.db_name,
+                                     collection_name=lib.collection_name)
 
     #selected_books is a JSON file 
 
     return selected_books
 
+@app.route('/fuzzy_search', methods=['GET'])
+def fuzzy_search_endpoint():
+    """Typo tolerant search over the Title and Authors of the books on the shelves.
+    /fuzzy_search?q=Mihael Ende&field=authors&limit=10&max_distance=2
+    field: authors, title or both (default); max_distance defaults to 0-2 edits depending on the word length.
+    """
+    query = request.args.get("q", "")
+    if not query.strip():
+        return jsonify({"error": "Parameter q is required"}), 400
+
+    field = request.args.get("field", "both")
+    if field not in ("authors", "title", "both"):
+        return jsonify({"error": "field must be authors, title or both"}), 400
+    fields = ("authors", "title") if field == "both" else (field,)
+
+    lib = libraries.current_library()
+    index = fuzzy_search.get_index(lib.mongo_uri, db_name=lib.db_name, collection_name=lib.collection_name)
+    with metrics.timed("fuzzy_search"):
+        results = index.search(query, fields, max_distance=request.args.get("max_distance", type=int),
+                               limit=request.args.get("limit", 10, type=int))
+    metrics.record_result_count("fuzzy_search", len(results))
+    return jsonify(results)
+
+@app.route('/shelf_changes', methods=['GET'])
+def get_shelf_changes():
+    """Books inserted, updated or removed after a change_seq, for clients that mirror the shelf.
+    /shelf_changes?since=0             0 = everything (a full sync), then the "since" of the last response
+    &after_id=65d...                   the "after_id" of the last response (needed when has_more was true)
+    &limit=500                         page size, at most 5000
+    Keep asking with the returned since/after_id while has_more is true.
+    """
+    lib = libraries.current_library()
+    try:
+        changes = shelf_changes.list_changes(lib.mongo_uri, db_name=lib.db_name, collection_name=lib.collection_name,
+                                             since=request.args.get("since", 0),
+                                             after_id=request.args.get("after_id"),
+                                             limit=request.args.get("limit", shelf_changes.CHANGES_PAGE_SIZE))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(changes)
+
+
+@app.route('/shelf_stats', methods=['GET'])
+def get_shelf_stats():
+    """Counts per book_shelf, Language, Category and Author, placed vs removed and total pages.
+
+    Reads the incremental counters when SHELF_STATS_COUNTERS is on, otherwise (or with ?source=aggregate)
+    runs a server-side aggregation. ?top=<n> limits the category/author lists.
+    """
+    top = request.args.get("top", 50, type=int)
+    lib = libraries.current_library()
+
+    # the counters live in the database of the library, so they only count its books
+    if shelf_stats.SHELF_STATS_COUNTERS and request.args.get("source") != "aggregate":
+        stats = shelf_stats.read_shelf_counters(lib.mongo_uri, db_name=lib.db_name, top=top)
+    else:
+        stats = shelf_stats.compute_shelf_stats(lib.mongo_uri, db_name=lib.db_name, collection_name=lib.collection_name,
+                                                top=top)
+
+    return jsonify(stats)
+
+@app.route('/enrichment_jobs/<job_id>', methods=['GET'])
+def enrichment_job_status(job_id):
+    """Returns the progress of a background enrichment job and, for searches, the books with descriptions."""
+    job = enrichment_queue.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job_id"}), 404
+    return jsonify(job)
+
+@app.route('/backfill_descriptions', methods=['POST'])
+def backfill_descriptions():
+    """Queues description lookups for stored books without one.
+    {"limit": 100}   <-- optional
+    """
+    data = request.get_json(silent=True) or {}
+    lib = libraries.current_library()
+    job_id = enrichment_queue.enqueue_backfill_job(lib.mongo_uri, db_name=lib.db_name, collection_name=lib.collection_name,
+                                                   limit=data.get("limit"))
+    return jsonify({"job_id": job_id, "status_url": f"/enrichment_jobs/{job_id}"}), 202
+
 @app.route('/remove_by_ID', methods=['POST'])
 def remove_by_ID():
     data = request.get_json()
@@ -146,12 +473,53 @@ def remove_by_ID():
         return jsonify({"message":"Wrong ID, nothing happened!"})
 
 
-    mongo_uri=get_mongo_uri()
-    book_removed = remove_selection_from_mongo(mongo_ID, mongo_uri, db_name="test", collection_name="stored_books")
+    lib = libraries.current_library()
+    book_removed = remove_selection_from_mongo(mongo_ID, lib.mongo_uri, db_name=lib.db_name,
+                                               collection_name=lib.collection_name)
     if book_removed:
         return jsonify({"message":"Book_removed"})
     
     return jsonify({"message":"Wrong ID, nothing happened!"})
 
+@app.route('/bulk_move', methods=['POST'])
+def bulk_move():
+    """Moves many books to another shelf, or removes them with "to_shelf": -1, in one update.
+    {
+    "_ids": ["65d...", "65e..."],   <-- and/or
+    "from_shelf": 3,                <-- every book on this shelf
+    "to_shelf": 5
+    }
+    """
+    data = request.get_json(silent=True) or {}
+
+    if "to_shelf" not in data:
+        return jsonify({"error": "to_shelf is required"}), 400
+
+    raw_IDs = data.get("_ids") or []
+    if not isinstance(raw_IDs, list):
+        return jsonify({"error": "_ids must be a list"}), 400
+
+    mongo_IDs = []
+    invalid_IDs = []
+    for raw_ID in raw_IDs:
+        #this makes sure no down stream errors occur
+        mongo_ID = check_correct_mongo_ID(raw_ID)
+        if mongo_ID is None:
+            invalid_IDs.append(raw_ID)
+        else:
+            mongo_IDs.append(mongo_ID)
+
+    if not mongo_IDs and data.get("from_shelf") is None:
+        return jsonify({"error": "No valid _ids or from_shelf given, nothing happened!", "invalid_ids": invalid_IDs}), 400
+
+    lib = libraries.current_library()
+    try:
+        result = move_books_in_mongo(data["to_shelf"], mongo_IDs, data.get("from_shelf"),
+                                     lib.mongo_uri, db_name=lib.db_name, collection_name=lib.collection_name)
+    except ValueError as e:
+        return jsonify({"error": str(e), "invalid_ids": invalid_IDs}), 400
+    result["invalid_ids"] = invalid_IDs
+    return jsonify(result)
+
 if __name__ == '__main__':
     app.run(debug=True)
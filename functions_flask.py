@@ -3,17 +3,42 @@ from flask import Flask, request, jsonify, send_from_directory, Response
 import requests
 from requests.exceptions import ConnectionError, Timeout, TooManyRedirects
 import json
+import re
 import numpy as np
 from IPython.display import Image, display
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import BulkWriteError
+from connections import http_session, mongo_client
+from singleflight import SingleFlight
 from dotenv import load_dotenv
 import os
 import pymongo
 from bson import ObjectId, errors
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from metrics import record_cache, timed, timed_upstream, upstream_error
+import shelf_stats
+from shelf_stats import counter_updates, apply_counter_updates
+from archive import archive_collection_name, ensure_live_indexes
+from search_keys import KEYED_FIELDS, SEARCH_KEY_FIELDS, add_search_keys, fold, tokens
+from fuzzy_search import loaded_index
+from openlibrary_dump import offline_description
+from shelf_changes import change_stamp, ensure_change_index, stamp_new_books
+from shelf_membership import MEMBERSHIP_COLUMNS, annotate_shelf_membership
+from result_cache import ResultCache, bump_shelf_version, shelf_version
+from isbn import CANONICAL_FIELD, canonical_isbn, clean_isbn, record_canonical_isbn
+from libraries import library_for
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+import array
+from book_schema import BOOK_SCHEMA, EXPORT_BATCH_SIZE, iter_column_batches
 
 
 #Handling mongo db
 
+# Projection that leaves out the normalized search keys, they are only used for querying
+SEARCH_KEYS_HIDDEN = {field: 0 for field in SEARCH_KEY_FIELDS}
+
 def get_mongo_uri():
     """Loads and returns the MongoDB URI from the .env file."""
     load_dotenv(".env")  # Load environment variables from .env
@@ -24,52 +49,180 @@ def get_mongo_uri():
 
     return mongo_uri  # Return the URI as a string
 
-def place_book_in_mongo(books_df, mongo_uri=None, db_name="test", collection_name="stored_books"):
-    """Inserts a Pandas DataFrame (single or multiple rows) into MongoDB.
+def normalize_book_shelf(book_shelf):
+    """Shelves are stored as integers, but JSON clients often send them as strings ("1")."""
+    try:
+        return int(book_shelf)
+    except (TypeError, ValueError):
+        return book_shelf
 
-    - Converts the DataFrame into a list of dictionaries.
-    - Uses a provided MongoDB URI or defaults to local.
-    - Manages the connection automatically.
+def checked_book_shelf(book_shelf):
+    """
+    normalize_book_shelf for shelves that are written: 2, 2.0 and "2" are shelf 2, -1 removes.
+
+    :raises ValueError: For anything else (True, 2.5, "x", -2), a string shelf would never be found
+                        again by the live queries (book_shelf > -1) and int() would cut 2.5 down to 2.
     """
+    if isinstance(book_shelf, bool) or (isinstance(book_shelf, float) and not book_shelf.is_integer()):
+        raise ValueError("to_shelf and from_shelf must be whole numbers, -1 for removed books")
+    book_shelf = normalize_book_shelf(book_shelf)
+    if not isinstance(book_shelf, int) or book_shelf < -1:
+        raise ValueError("to_shelf and from_shelf must be whole numbers, -1 for removed books")
+    return book_shelf
+
+def prepare_books(books_df):
+    """Turns a DataFrame of books into the dicts that are stored (with search keys and canonical ISBN)."""
     if not isinstance(books_df, pd.DataFrame):
         raise ValueError("Expected a Pandas DataFrame as input")
 
     # Convert DataFrame to a list of dictionaries
     books_list = books_df.to_dict(orient="records")  
 
-    # Use provided MongoDB URI or fallback to localhost
-    mongo_uri = mongo_uri #or "mongodb://localhost:27017/"
+    # normalized, accent-folded copies of Title/Authors for or_filter_mongo
+    add_search_keys(books_list)
+
+    # one canonical ISBN-13 per book (None without a valid ISBN), used by ISBN searches
+    for record in books_list:
+        record[CANONICAL_FIELD] = record_canonical_isbn(record)
+
+    return books_list
+
+_text_indexed = set()  # (uri, db, collection) that already got the text index in this process
+
+def store_books(books_list, mongo_uri=None, db_name="test", collection_name="stored_books"):
+    """
+    Inserts book dicts from prepare_books with one insert_many and keeps counters, fuzzy index and indexes in step.
+
+    Books may carry their _id already (write_behind.py assigns it when a selection is journaled). If such a
+    book is stored already, because a batch is replayed after a crash, it is skipped.
 
-    with MongoClient(mongo_uri) as client:  # Auto-close connection
+    :return: Number of books inserted.
+    """
+    with mongo_client(mongo_uri) as client:  # shared per process, see connections.py
         db = client[db_name]
         collection = db[collection_name]
-        result = collection.insert_many(books_list)
-        print(f"✅ {len(result.inserted_ids)} book(s) added.")
+        # change_seq/created_seq/updated_at for /shelf_changes
+        stamp_new_books(db, collection_name, books_list)
+        try:
+            collection.insert_many(books_list, ordered=False)
+        except BulkWriteError as e:
+            # duplicate _ids are books of a replayed batch, everything else is a real error
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+            duplicates = {error["index"] for error in e.details["writeErrors"]}
+            books_list = [record for i, record in enumerate(books_list) if i not in duplicates]
+        print(f"✅ {len(books_list)} book(s) added.")
+        bump_shelf_version(db, collection_name, mongo_uri)  # cached shelf searches are stale now
+
+        # keep the /shelf_stats counters in step (only if SHELF_STATS_COUNTERS is on)
+        apply_counter_updates(db, counter_updates(books_list))
+
+        # insert_many filled in the _ids, so the fuzzy index (if built) can take the books as they are
+        fuzzy_index = loaded_index(mongo_uri, db_name, collection_name)
+        if fuzzy_index:
+            fuzzy_index.add_books(books_list)
+
+        ensure_live_indexes(collection, mongo_uri)
+        ensure_change_index(collection, mongo_uri)
+        if (mongo_uri, db_name, collection_name) not in _text_indexed:
+            collection.create_index([
+                ("Authors", "text"), 
+                ("Publisher", "text"), 
+                ("Title", "text")
+            ])
+            _text_indexed.add((mongo_uri, db_name, collection_name))
+
+    return len(books_list)
 
-        collection.create_index([
-            ("Authors", "text"), 
-            ("Publisher", "text"), 
-            ("Title", "text")
-        ])
+def place_book_in_mongo(books_df, mongo_uri=None, db_name="test", collection_name="stored_books"):
+    """Inserts a Pandas DataFrame (single or multiple rows) into MongoDB.
+
+    - Converts the DataFrame into a list of dictionaries (prepare_books).
+    - Uses a provided MongoDB URI or defaults to local.
+    - Manages the connection automatically.
+    """
+    return store_books(prepare_books(books_df), mongo_uri, db_name, collection_name)
 
 
 def remove_selection_from_mongo(mongo_ID, mongo_uri=None, db_name="test", collection_name="stored_books"):
     #takes a mongo ObjectID _ID
-    with MongoClient(mongo_uri) as client:  # Auto-close connection
+    with mongo_client(mongo_uri) as client:  # shared per process, see connections.py
         db = client[db_name]
         collection = db[collection_name]
 
         result = collection.find_one_and_update(
-            {"_id": mongo_ID}, 
-            {"$set": {"book_shelf": -1}},
-            return_document=True  # Return updated version
+            # a book that is removed already keeps its removed_at and change_seq
+            {"_id": mongo_ID, "book_shelf": {"$ne": -1}},
+            # removed_at is used by archive.py, the change stamp by /shelf_changes
+            {"$set": {"book_shelf": -1, "removed_at": datetime.now(timezone.utc), **change_stamp(db, collection_name)}},
+            return_document=ReturnDocument.BEFORE  # the old shelf is needed for the stats counters
         )
 
-        if result is None:  # Handle missing ID
+        if result is None:  # Handle missing ID (or a book removed before)
             return None
+        bump_shelf_version(db, collection_name, mongo_uri)
+
+        apply_counter_updates(db, counter_updates([result], -1) + counter_updates([{**result, "book_shelf": -1}]))
+
+        fuzzy_index = loaded_index(mongo_uri, db_name, collection_name)
+        if fuzzy_index:
+            fuzzy_index.remove_books([mongo_ID])
 
         return {"success": f"Document updated successfully"}
 
+def move_books_in_mongo(to_shelf, mongo_IDs=None, from_shelf=None, mongo_uri=None, db_name="test", collection_name="stored_books"):
+    """
+    Moves many books to another shelf (or removes them with to_shelf=-1) in a single update_many.
+
+    :param to_shelf: Target shelf, -1 removes the books.
+    :param mongo_IDs: List of ObjectIds to move (optional).
+    :param from_shelf: Move the books of this shelf (optional, combined with mongo_IDs if both are given).
+    :return: Dict with the matched and modified counts.
+    :raises ValueError: For shelves that are not whole numbers >= -1, or without mongo_IDs and from_shelf.
+    """
+    to_shelf = checked_book_shelf(to_shelf)
+    if from_shelf is not None:
+        from_shelf = checked_book_shelf(from_shelf)
+
+    conditions = []
+    if mongo_IDs:
+        conditions.append({"_id": {"$in": list(mongo_IDs)}})
+    if from_shelf is not None:
+        conditions.append({"book_shelf": from_shelf})
+    if not conditions:
+        raise ValueError("Either mongo_IDs or from_shelf is needed")
+    # books already on the target shelf (or already removed) are left alone, they keep change_seq and removed_at
+    conditions.append({"book_shelf": {"$ne": to_shelf}})
+    query = {"$and": conditions}
+
+    with mongo_client(mongo_uri) as client:
+        db = client[db_name]
+        collection = db[collection_name]
+
+        # all moved books share one change_seq
+        if to_shelf == -1:
+            update = {"$set": {"book_shelf": -1, "removed_at": datetime.now(timezone.utc), **change_stamp(db, collection_name)}}
+        else:
+            update = {"$set": {"book_shelf": to_shelf, **change_stamp(db, collection_name)}, "$unset": {"removed_at": ""}}
+
+        # the stats counters need the old shelves of the books that actually change
+        moved_books = []
+        if shelf_stats.SHELF_STATS_COUNTERS:
+            projection = {"book_shelf": 1, "Language": 1, "Category": 1, "Authors": 1, "Page Count": 1}
+            moved_books = list(collection.find(query, projection))
+
+        result = collection.update_many(query, update)
+        bump_shelf_version(db, collection_name, mongo_uri)
+
+        apply_counter_updates(db, counter_updates(moved_books, -1)
+                              + counter_updates([{**book, "book_shelf": to_shelf} for book in moved_books]))
+
+    fuzzy_index = loaded_index(mongo_uri, db_name, collection_name)
+    if fuzzy_index and result.modified_count:
+        fuzzy_index.move_books(to_shelf, mongo_IDs, from_shelf)
+
+    return {"matched": result.matched_count, "modified": result.modified_count}
+
 def check_correct_mongo_ID(mongo_ID):
     
     if not mongo_ID:
@@ -82,81 +235,202 @@ def check_correct_mongo_ID(mongo_ID):
 
 
 
-def import_from_mongo(mongo_uri=None, db_name="test", collection_name="stored_books") -> pd.DataFrame:
-    """Fetches all book entries from MongoDB and returns them as a Pandas DataFrame."""
+# Documents per piece of a streamed JSON array (one piece = one chunk for the response compressor)
+JSON_STREAM_BATCH = 200
 
-    mongo_uri = mongo_uri #or "mongodb://localhost:27017/"
+def _json_default(value):
+    """JSON fallback: ISO format for datetimes, str for ObjectId."""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+def iter_json_array(docs, default=_json_default, batch_size=JSON_STREAM_BATCH):
+    """
+    Yields a JSON array of documents piece by piece, so a large result never exists as one string.
 
-    with MongoClient(mongo_uri) as client:
+    :param docs: Iterable of dicts, e.g. a Mongo cursor.
+    :param default: json.dumps fallback for values JSON does not know (ObjectId, datetime).
+    :param batch_size: Number of documents serialized into one piece.
+    """
+    separator = "["
+    batch = []
+    for doc in docs:
+        batch.append(json.dumps(doc, default=default))
+        if len(batch) >= batch_size:
+            yield separator + ",".join(batch)
+            separator = ","
+            batch = []
+    if batch:
+        yield separator + ",".join(batch)
+        separator = ","
+    yield "[]" if separator == "[" else "]"
+
+def stream_mongo_json(mongo_uri, query, collection_names, db_name="test", default=_json_default):
+    """Generator of a JSON array with the documents matching query in collection_names, read batch by batch."""
+    with mongo_client(mongo_uri) as client:
         db = client[db_name]
-        collection = db[collection_name]
+        cursors = (db[name].find(query, SEARCH_KEYS_HIDDEN, batch_size=EXPORT_BATCH_SIZE) for name in collection_names)
+        yield from iter_json_array((doc for cursor in cursors for doc in cursor), default=default)
 
-        # Retrieve all documents
-        books_list = list(collection.find())
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
 
-        # 🔥 Convert `_id` field from ObjectId to string
-        for book in books_list:
-            if "_id" in book:
-                book["_id"] = str(book["_id"])
+def import_from_mongo_columnar(mongo_uri=None, db_name="test", collection_name="stored_books", query=None,
+                               columns=None, batch_size=EXPORT_BATCH_SIZE) -> pd.DataFrame:
+    """
+    Loads books into a DataFrame with the fixed types of book_schema.BOOK_SCHEMA, for analytics on the shelf.
 
-        # Convert list to Pandas DataFrame
-        df = pd.DataFrame(books_list) if books_list else pd.DataFrame()
+    There is no list of dicts in between: the cursor is read batch_size documents at a time (with a
+    projection) and the values are appended to one typed buffer per column.
+    int columns become nullable Int64, str columns object, removed_at datetime64[us, UTC].
 
-    return df
+    :param query: Mongo filter, default all books of the collection.
+    :param columns: Subset of the BOOK_SCHEMA columns, default all.
+    :return: DataFrame with exactly the requested columns (also when nothing matched).
+    """
+    columns = list(columns or BOOK_SCHEMA)
+    buffers = {}
+    for column in columns:
+        if BOOK_SCHEMA[column] == "str":
+            buffers[column] = []
+        else:  # int64 values (datetimes as microseconds since the epoch) plus a missing-value mask
+            buffers[column] = (array.array("q"), bytearray())
+
+    with mongo_client(mongo_uri) as client:
+        cursor = client[db_name][collection_name].find(query or {}, {column: 1 for column in columns})
+        for batch, rows in iter_column_batches(cursor.batch_size(batch_size), columns, batch_size):
+            for column in columns:
+                values = batch[column]
+                if BOOK_SCHEMA[column] == "str":
+                    buffers[column].extend(values)
+                    continue
+                if BOOK_SCHEMA[column] == "datetime":
+                    values = [None if value is None else (value - _EPOCH) // _MICROSECOND for value in values]
+                data, mask = buffers[column]
+                data.extend(0 if value is None else value for value in values)
+                mask.extend(value is None for value in values)
+
+    frame = {}
+    for column in columns:
+        if BOOK_SCHEMA[column] == "str":
+            frame[column] = pd.Series(buffers[column], dtype=object)
+            continue
+        data, mask = buffers[column]
+        data = np.frombuffer(data, dtype=np.int64) if len(data) else np.zeros(0, dtype=np.int64)
+        mask = np.frombuffer(bytes(mask), dtype=bool)
+        if BOOK_SCHEMA[column] == "int":
+            frame[column] = pd.Series(pd.arrays.IntegerArray(data, mask))
+        else:
+            stamps = data.astype("datetime64[us]")
+            stamps[mask] = np.datetime64("NaT")
+            frame[column] = pd.Series(stamps).dt.tz_localize("UTC")
+    return pd.DataFrame(frame, columns=columns)
+
+# Small query planner for or_filter_mongo
+# Identifier fields are matched exactly (uses the ISBN/ID indexes). Title and Authors are searched on the
+# normalized keys from search_keys.py (lower-case, accents folded), other text fields on the field itself.
+# The "match" mode decides how text is compared:
+#   "contains" (default) - substring regex, the only mode that has to scan
+#   "prefix"             - anchored regex, on the normalized keys this is an index range
+#   "exact"              - equality, indexed on the normalized keys
+#   "words"              - every word must appear (umlauts in either spelling), indexed via the word arrays
+# User input is always regex-escaped, so ".*" or "(a+)+" in a title search is taken literally.
+IDENTIFIER_FIELDS = {"ISBN_13", "ISBN_10", "ID", CANONICAL_FIELD}
+TEXT_MATCH_MODES = ("contains", "prefix", "exact", "words")
+
+def plan_condition(key, value, match="contains"):
+    """Returns the Mongo condition for one search field."""
+    value = str(value).strip()
+
+    if key in IDENTIFIER_FIELDS:
+        return {key: value}
+
+    if key in KEYED_FIELDS:
+        key_field, tokens_field = KEYED_FIELDS[key]
+        folded = fold(value)
+        if match == "words":
+            return {tokens_field: {"$all": tokens(value)}} if tokens(value) else {key_field: folded}
+        if match == "exact":
+            return {key_field: folded}
+        if match == "prefix":
+            return {key_field: {"$regex": "^" + re.escape(folded)}}
+        return {key_field: {"$regex": re.escape(folded)}}
+
+    if match == "exact":
+        return {key: {"$regex": "^" + re.escape(value) + "$", "$options": "i"}}
+    if match == "prefix":
+        return {key: {"$regex": "^" + re.escape(value), "$options": "i"}}
+    return {key: {"$regex": re.escape(value), "$options": "i"}}
+
+def build_or_filter_query(or_query, collection_name="stored_books"):
+    """
+    Builds the Mongo filter used by or_filter_mongo and the collections it has to run on.
 
-def or_filter_mongo(or_query, mongo_uri=get_mongo_uri(), db_name="test", collection_name="stored_books"):
-    """ 
-    Performs an OR-based regex search in MongoDB and returns results as JSON.
-    
-    :param or_query: Dictionary with key-value pairs to search.
-    :param mongo_uri: MongoDB connection string.
-    :param db_name: Name of the database.
-    :param collection_name: Name of the collection.
-    :return: JSON string of matching documents.
+    :param or_query: Dictionary with key-value pairs to search, optionally with "book_shelf" and
+                     "match" (see TEXT_MATCH_MODES); both are removed from the dict.
+    :return: (query, list of collection names)
     """
+    book_shelf = normalize_book_shelf(or_query.pop("book_shelf", None))
+    match = or_query.pop("match", "contains")
+    if match not in TEXT_MATCH_MODES:
+        match = "contains"
 
-    book_shelf = or_query.pop("book_shelf", None)
+    or_conditions = [plan_condition(key, value, match) for key, value in or_query.items()]
 
-    # Clean and format search parameters for case-insensitive regex search
-    or_conditions = [
-        {key: {"$regex": f".*{value}.*", "$options": "i"}} for key, value in or_query.items()
-    ]
+    or_filter = {"$or": or_conditions} if or_conditions else {}  # Your original OR filter
+    collection_names = [collection_name]
 
     if book_shelf == -1:
-
-        query = {
-            "$and": [
-                {"$or": or_conditions} if or_conditions else {},  # Your original OR filter
-                {"book_shelf":-1}
-            ]
-        }
+        # Removed books: recently removed ones are still in the live collection, older ones in the archive
+        query = {"$and": [or_filter, {"book_shelf": -1}]}
+        collection_names.append(archive_collection_name(collection_name))
     elif book_shelf is None:
-        query = {"$or": or_conditions} if or_conditions else {},  # Your original OR filter
-    
+        # All live books; stating book_shelf > -1 lets Mongo use the partial indexes
+        query = {"$and": [or_filter, {"book_shelf": {"$gt": -1}}]}
     else:
-        query = {
-            "$and": [
-                {"$or": or_conditions} if or_conditions else {},  # Your original OR filter
-                {"book_shelf": {"$ne": -1}},  # Exclude books where book_shelf == -1
-                {"book_shelf": book_shelf}
-            ]
-        }
+        query = {"$and": [or_filter, {"book_shelf": book_shelf}]}
 
+    return query, collection_names
 
-    with MongoClient(mongo_uri) as client:
-        db = client[db_name]
-        collection = db[collection_name]
-        results_cursor = collection.find(query)
+# Serialized or_filter_mongo results per shelf version, see result_cache.py. One cache per library
+# (database), so a busy library cannot push the results of the others out.
+_shelf_search_caches = {}  # (uri, db, collection) -> ResultCache
+_shelf_search_caches_lock = threading.Lock()
 
-        # Convert cursor to list of dictionaries
-        results_list = list(results_cursor)
+def shelf_search_cache(mongo_uri, db_name, collection_name):
+    key = (mongo_uri, db_name, collection_name)
+    with _shelf_search_caches_lock:
+        cache = _shelf_search_caches.get(key)
+        if cache is None:
+            library = library_for(db_name, collection_name)
+            cache = _shelf_search_caches[key] = ResultCache("shelf_search", library=library.name if library else db_name)
+    return cache
 
-    # Convert ObjectId to string for JSON compatibility
-    for doc in results_list:
-        doc["_id"] = str(doc["_id"])  # Convert ObjectId to string
+def or_filter_mongo(or_query, mongo_uri=get_mongo_uri(), db_name="test", collection_name="stored_books"):
+    """ 
+    Performs an OR-based search in MongoDB and returns results as JSON (see plan_condition for how fields are matched).
     
-    json_data = json.dumps(results_list, indent=4)  # Convert to JSON string
-    return Response(json_data, content_type="application/json")  # Return proper JSON response
+    :param or_query: Dictionary with key-value pairs to search.
+    :param mongo_uri: MongoDB connection string.
+    :param db_name: Name of the database.
+    :param collection_name: Name of the collection.
+    :return: Streamed JSON response with the matching documents.
+    """
+
+    query, collection_names = build_or_filter_query(or_query, collection_name)
+
+    # the built filter is the normalized query ("Müller" and "muller" give the same one)
+    key = json.dumps([query, collection_names], sort_keys=True, default=str)
+    cache = shelf_search_cache(mongo_uri, db_name, collection_name)
+    with mongo_client(mongo_uri) as client:
+        version = shelf_version(client[db_name], collection_name, mongo_uri)
+    cached = cache.get(key, version)
+    if cached is not None:
+        return Response(cached, content_type="application/json")
+
+    # Streamed straight from the cursors (default=str turns _id and removed_at into strings), cached on the way
+    chunks = stream_mongo_json(mongo_uri, query, collection_names, db_name, default=str)
+    return Response(cache.fill(key, version, chunks), content_type="application/json")
 
 
 
@@ -168,7 +442,8 @@ def unify_json_inX_to_X(query_params):
     
     - "intitle" → "Title"
     - "inauthor" → "Authors"
-    - "isbn" → "ISBN_13" (if 13 digits) or "ISBN_10" (if 10 digits)
+    - "isbn" → "ISBN_canonical" (any valid ISBN-10/13, with or without hyphens, see isbn.py)
+      or, if the checksum does not match, "ISBN_13" (if 13 digits) or "ISBN_10" (if 10 digits)
     
     :param query_params: Dictionary with query parameters.
     :return: New dictionary with transformed keys.
@@ -178,11 +453,13 @@ def unify_json_inX_to_X(query_params):
     isbn_key = None
     
     if isbn:
-        isbn_length = len(isbn)
-        if isbn_length == 13:
-            isbn_key = "ISBN_13"
+        isbn_length = len(clean_isbn(isbn) or "")
+        if canonical_isbn(isbn):
+            isbn_key, isbn = CANONICAL_FIELD, canonical_isbn(isbn)
+        elif isbn_length == 13:
+            isbn_key, isbn = "ISBN_13", clean_isbn(isbn)
         elif isbn_length == 10:
-            isbn_key = "ISBN_10"
+            isbn_key, isbn = "ISBN_10", clean_isbn(isbn)
     
     # New dictionary with updated keys
     transformed_params = {
@@ -201,13 +478,90 @@ def unify_json_inX_to_X(query_params):
 
 
 
-def fetch_books_data(query_params):
+# Identical upstream calls that run at the same time share one request, see singleflight.py
+_google_books_flights = SingleFlight("google_books")
+_open_library_flights = SingleFlight("open_library")
+
+# The parts of a Google Books volume json_to_dataframe reads, per DataFrame column.
+# fetch_books_data asks only for these (the API's "fields" partial response), so a new column
+# needs its path here as well.
+VOLUME_FIELDS = {
+    "ID": "id",
+    "Title": "volumeInfo/title",
+    "Authors": "volumeInfo/authors",
+    "Publisher": "volumeInfo/publisher",
+    "Page Count": "volumeInfo/pageCount",
+    "Language": "volumeInfo/language",
+    "Category": "volumeInfo/categories",
+    "Thumbnail": "volumeInfo/imageLinks/thumbnail",
+    "ISBN_13": "volumeInfo/industryIdentifiers",
+    "ISBN_10": "volumeInfo/industryIdentifiers",
+}
+
+def google_books_fields(paths=VOLUME_FIELDS.values()):
+    """Builds the "fields" selector from volume paths: items(id,volumeInfo(title,imageLinks/thumbnail,...))."""
+    nested = {}
+    for path in paths:
+        head, _, rest = path.partition("/")
+        children = nested.setdefault(head, [])
+        if rest and rest not in children:
+            children.append(rest)
+    selectors = []
+    for head, children in nested.items():
+        # one level of nesting is grouped, deeper paths keep the slash syntax (imageLinks/thumbnail)
+        selectors.append(f"{head}({','.join(children)})" if children else head)
+    return f"items({','.join(selectors)})"
+
+GOOGLE_BOOKS_FIELDS = google_books_fields()
+
+# Per request options of the Google Books search, with their defaults
+FETCH_OPTION_DEFAULTS = {"maxResults": 5, "langRestrict": "de", "printType": "books"}
+PRINT_TYPES = ("all", "books", "magazines")
+# Keywords Google Books understands in q ("intitle:Python"); other keys of a query string are not search terms
+SEARCH_TERMS = ("intitle", "inauthor", "inpublisher", "subject", "isbn", "lccn", "oclc")
+
+def pop_fetch_options(query_params):
+    """
+    Takes maxResults, langRestrict and printType out of a /search_books body.
+
+    :return: Dict with all three options (defaults filled in).
+    :raises ValueError: For values the API would reject.
+    """
+    options = dict(FETCH_OPTION_DEFAULTS)
+    if "maxResults" in query_params:
+        try:
+            options["maxResults"] = int(query_params.pop("maxResults"))
+        except (TypeError, ValueError):
+            raise ValueError("maxResults must be a number between 1 and 40")
+        if not 1 <= options["maxResults"] <= 40:
+            raise ValueError("maxResults must be a number between 1 and 40")
+    if "langRestrict" in query_params:
+        options["langRestrict"] = query_params.pop("langRestrict") or None  # "" or null = all languages
+    if "printType" in query_params:
+        options["printType"] = query_params.pop("printType")
+        if options["printType"] not in PRINT_TYPES:
+            raise ValueError(f"printType must be one of {', '.join(PRINT_TYPES)}")
+    return options
+
+def fetch_books_data(query_params, options=None):
     """
     Fetch raw data from the Google Books API with flexible query parameters.
 
+    Only the fields json_to_dataframe reads are requested (VOLUME_FIELDS), gzip compressed.
+    Concurrent calls with the same query (ignoring case, spacing and key order) and options share one
+    request, the returned dict is then the same object for all of them and must not be modified.
+
     :param query_params: A dictionary of query parameters (e.g., {"intitle": "Python", "inauthor": "Guido"}).
+    :param options: maxResults, langRestrict and printType (see pop_fetch_options), default FETCH_OPTION_DEFAULTS.
     :return: The raw JSON response from the API.
     """
+    options = {**FETCH_OPTION_DEFAULTS, **(options or {})}
+    flight_key = (tuple(sorted((name, " ".join(str(value).casefold().split())) for name, value in query_params.items())),
+                  tuple(sorted(options.items())))
+    return _google_books_flights.do(flight_key, _fetch_books_data, query_params, options)
+
+
+def _fetch_books_data(query_params, options):
     # Define the base URL for the Google Books API
     url = "https://www.googleapis.com/books/v1/volumes"
 
@@ -222,20 +576,27 @@ def fetch_books_data(query_params):
     # Define the parameters for the API request
     params = {
         "q": query,  # The query string constructed above
-        "maxResults": 5,  # Limit the number of results returned by the API to x
-        "printType": "books",
-        "langRestrict": "de"
+        "maxResults": options["maxResults"],  # Limit the number of results returned by the API to x
+        "printType": options["printType"],
+        "fields": GOOGLE_BOOKS_FIELDS,  # partial response, only what json_to_dataframe reads
     }
+    if options["langRestrict"]:
+        params["langRestrict"] = options["langRestrict"]
+
+    # Google only compresses responses if the User-Agent also mentions gzip
+    headers = {"Accept-Encoding": "gzip", "User-Agent": "GB4F (gzip)"}
 
     try:
-        # Send a GET request to the Google Books API with the specified parameters
-        response = requests.get(url, params=params)
+        with timed_upstream(url):
+            # Send a GET request to the Google Books API with the specified parameters
+            response = http_session().get(url, params=params, headers=headers)  # keep-alive connection of this process
 
-        # Check for HTTP errors; raise an exception if the response status indicates an error
-        response.raise_for_status()
+            # Check for HTTP errors; raise an exception if the response status indicates an error
+            response.raise_for_status()
 
         # If the request is successful, return the JSON data from the API response
-        return response.json()
+        with timed("parse_google_books_json"):
+            return response.json()
 
     except requests.exceptions.RequestException as e:
         # If an error occurs during the request, print the error message
@@ -266,6 +627,11 @@ def json_to_dataframe(raw_data, book_shelf):
     :param json_data: Raw JSON data from the Google Books API.
     :return: A pandas DataFrame containing relevant book information.
     """
+    with timed("json_to_dataframe"):
+        return _json_to_dataframe(raw_data, book_shelf)
+
+
+def _json_to_dataframe(raw_data, book_shelf):
     try:
         # Extract the list of books from the JSON data
         items = raw_data.get("items", [])
@@ -280,7 +646,7 @@ def json_to_dataframe(raw_data, book_shelf):
         for item in items:
             volume_info = item.get("volumeInfo", {})
             record = {
-                "book_shelf": book_shelf,
+                "book_shelf": normalize_book_shelf(book_shelf),
                 "selection_id": selection_id_counter,  # Add running selection_id
                 "ID": item.get("id", np.nan),
                 "Title": volume_info.get("title", np.nan),
@@ -309,26 +675,182 @@ def json_to_dataframe(raw_data, book_shelf):
                     np.nan,
                 ),
             }
+            record[CANONICAL_FIELD] = record_canonical_isbn(record) or np.nan
             metadata.append(record)
 
             # Increment the selection_id counter after each book
             selection_id_counter += 1
 
         # Create a DataFrame from the metadata
-        return pd.DataFrame(metadata)
+        return dedupe_by_isbn(pd.DataFrame(metadata))
 
     except Exception as e:
         print(f"Error processing JSON data: {e}")
         return pd.DataFrame()
 
 
+def dedupe_by_isbn(books_df):
+    """
+    Drops Google Books results that are the same book (same canonical ISBN) as an earlier row
+    and renumbers selection_id. Rows without an ISBN are always kept.
+    """
+    if books_df.empty or CANONICAL_FIELD not in books_df.columns:
+        return books_df
+    duplicate = books_df[CANONICAL_FIELD].notna() & books_df.duplicated(subset=CANONICAL_FIELD, keep="first")
+    books_df = books_df[~duplicate].reset_index(drop=True)
+    books_df["selection_id"] = range(1, len(books_df) + 1)
+    return books_df
+
+
+# Hybrid search: books already known on the shelf (also removed and archived ones) ahead of Google Books hits
+HYBRID_LOCAL_LIMIT = 20
+HYBRID_COLUMNS = MEMBERSHIP_COLUMNS  # _id, shelf_status, stored_shelf: only in search results, never stored
+BOOK_COLUMNS = ["book_shelf", "selection_id", *VOLUME_FIELDS, CANONICAL_FIELD, "description"]
+
+def find_known_books(or_query, mongo_uri=None, db_name="test", collection_name="stored_books", limit=HYBRID_LOCAL_LIMIT):
+    """
+    Looks up stored books matching a unified query (see unify_json_inX_to_X) on every shelf, removed and archived
+    ones included.
+
+    :return: List of (document, shelf_status) with shelf_status "on_shelf", "removed" or "archived".
+    """
+    or_query = dict(or_query)
+    or_query.pop("book_shelf", None)
+    match = or_query.pop("match", "contains")
+    or_conditions = [plan_condition(key, value, match if match in TEXT_MATCH_MODES else "contains")
+                     for key, value in or_query.items()]
+    if not or_conditions:
+        return []
+
+    known = []
+    with mongo_client(mongo_uri) as client:
+        db = client[db_name]
+        for name in (collection_name, archive_collection_name(collection_name)):
+            for doc in db[name].find({"$or": or_conditions}, SEARCH_KEYS_HIDDEN).limit(limit - len(known)):
+                if name != collection_name:
+                    status = "archived"
+                else:
+                    status = "removed" if doc.get("book_shelf") == -1 else "on_shelf"
+                known.append((doc, status))
+            if len(known) >= limit:
+                break
+    return known
+
+def merge_hybrid_results(known_books, books_df, book_shelf):
+    """
+    Puts the known books ahead of the Google Books rows and drops Google rows that are one of them
+    (same canonical ISBN or same volume ID). Every row gets shelf_status and stored_shelf (Google rows keep
+    those of annotate_shelf_membership, else "new"), known books their _id as a string; selection_id is renumbered.
+    """
+    rows = []
+    seen_isbns = set()
+    seen_ids = set()
+    for doc, status in known_books:
+        row = {column: doc.get(column, np.nan) for column in BOOK_COLUMNS}
+        row.update({"book_shelf": normalize_book_shelf(book_shelf), "_id": str(doc["_id"]),
+                    "shelf_status": status, "stored_shelf": doc.get("book_shelf", np.nan)})
+        rows.append(row)
+        if isinstance(row[CANONICAL_FIELD], str):
+            seen_isbns.add(row[CANONICAL_FIELD])
+        if isinstance(row["ID"], str):
+            seen_ids.add(row["ID"])
+
+    for row in books_df.to_dict(orient="records"):
+        if row.get(CANONICAL_FIELD) in seen_isbns or row.get("ID") in seen_ids:
+            continue
+        rows.append({"_id": np.nan, "shelf_status": "new", "stored_shelf": np.nan, **row})
+
+    merged = pd.DataFrame(rows)
+    if not merged.empty:
+        merged["selection_id"] = range(1, len(merged) + 1)
+    return merged
+
+def hybrid_search(query_params, book_shelf, fetch_options=None, describe=True,
+                  mongo_uri=None, db_name="test", collection_name="stored_books"):
+    """
+    Runs the shelf lookup and the Google Books search at the same time and merges them (merge_hybrid_results),
+    so the answer takes as long as the slower of the two, not both.
+
+    :param describe: Look up Open Library descriptions for the Google rows (known books keep their own).
+    :return: DataFrame like json_to_dataframe, plus the HYBRID_COLUMNS.
+    """
+    local_query = unify_json_inX_to_X(dict(query_params))
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        known_future = executor.submit(find_known_books, local_query, mongo_uri, db_name, collection_name)
+        books_df = json_to_dataframe(fetch_books_data(query_params, fetch_options), book_shelf)
+        # Google rows that are stored but did not match the shelf lookup (other title, over the limit)
+        annotate_shelf_membership(books_df, mongo_uri, db_name, collection_name)
+        if describe and not books_df.empty:
+            add_description_by_isbn(books_df)
+        try:
+            known_books = known_future.result()
+        except Exception as e:
+            print(f"Shelf lookup of the hybrid search failed: {e}")
+            known_books = []
+    return merge_hybrid_results(known_books, books_df, book_shelf)
+
+def restore_known_book(selected_book, move_shelved=False, mongo_uri=None, db_name="test", collection_name="stored_books"):
+    """
+    Selecting a removed book of a hybrid search puts the stored book back on the search's shelf instead of
+    storing a second copy. A book that is on a shelf is only moved with move_shelved, otherwise (and for
+    archived books, or when the search named no shelf) the row is stored as a new book.
+
+    :param selected_book: One row DataFrame from the search.
+    :param move_shelved: Move a book that is on another shelf instead of storing a second copy.
+    :return: The _id of the moved book, or None if the row has to be stored with place_book_in_mongo.
+    """
+    if "shelf_status" not in selected_book.columns:
+        return None
+    row = selected_book.iloc[0]
+    to_shelf = normalize_book_shelf(row["book_shelf"])
+    if not isinstance(to_shelf, int) or to_shelf < 0:
+        return None  # no book_shelf in the search (-1): moving would remove the stored book
+    if row["shelf_status"] == "removed" or (row["shelf_status"] == "on_shelf" and move_shelved):
+        move_books_in_mongo(to_shelf, [ObjectId(row["_id"])], mongo_uri=mongo_uri, db_name=db_name,
+                            collection_name=collection_name)
+        return row["_id"]
+    return None
+
+
+# Descriptions by canonical ISBN, so ISBN-10/13 spellings of the same book share one Open Library lookup.
+# Only answers from Open Library are kept (also "No description available."), failed requests are retried.
+DESCRIPTION_CACHE_SIZE = 4096
+_description_cache = OrderedDict()
+_description_cache_lock = threading.Lock()
+
+
 def open_library_API_ISBN_to_description(isbn):
+    key = canonical_isbn(isbn) or clean_isbn(isbn)
+    with _description_cache_lock:
+        if key in _description_cache:
+            _description_cache.move_to_end(key)
+            record_cache("description", True)
+            return _description_cache[key]
+    record_cache("description", False)
+
+    # the offline index built by openlibrary_dump.py (if configured) saves the network round trip
+    description = offline_description(key)
+    record_cache("openlibrary_dump", description is not None)
+    if description is None:
+        description = _open_library_flights.do(key, _open_library_API_ISBN_to_description, key)
+    if description is not None:
+        with _description_cache_lock:
+            _description_cache[key] = description
+            if len(_description_cache) > DESCRIPTION_CACHE_SIZE:
+                _description_cache.popitem(last=False)
+    return description if description is not None else "No description available."
+
+
+def _open_library_API_ISBN_to_description(isbn):
+    """Open Library lookup; returns None if the request failed (nothing to cache)."""
     url = f"https://openlibrary.org/api/books?bibkeys=ISBN:{isbn}&jscmd=details&format=json"
 
-    response = requests.get(url)
+    with timed_upstream(url):
+        response = http_session().get(url)
 
     if response.status_code != 200:
-        return "No description available." #This should be updated
+        upstream_error(url)
+        return None
     
     data = response.json()
 
@@ -349,7 +871,17 @@ def open_library_API_ISBN_to_description(isbn):
 
 
 def add_description_by_isbn(books_df):
-    if 'ISBN_13' in books_df.columns and books_df['ISBN_13'].notna().any():
+    with timed("add_description_by_isbn"):
+        return _add_description_by_isbn(books_df)
+
+
+def _add_description_by_isbn(books_df):
+    if CANONICAL_FIELD in books_df.columns and books_df[CANONICAL_FIELD].notna().any():
+        # the canonical ISBN covers rows with only an ISBN_10; rows with an invalid ISBN fall back to it as is
+        isbns = books_df[CANONICAL_FIELD].fillna(books_df.get('ISBN_13')).fillna(books_df.get('ISBN_10'))
+        books_df['description'] = isbns.apply(
+            lambda isbn: open_library_API_ISBN_to_description(isbn) if isinstance(isbn, str) else np.nan)
+    elif 'ISBN_13' in books_df.columns and books_df['ISBN_13'].notna().any():
         books_df['description'] = books_df['ISBN_13'].fillna(books_df.get('ISBN_10')).apply(open_library_API_ISBN_to_description)
     elif 'ISBN_10' in books_df.columns and books_df['ISBN_10'].notna().any():
         books_df['description'] = books_df['ISBN_10'].apply(open_library_API_ISBN_to_description)
@@ -357,6 +889,42 @@ def add_description_by_isbn(books_df):
     return books_df
 
 
+def iter_descriptions_by_isbn(books_df, max_workers=8):
+    """
+    Looks up the descriptions of all rows concurrently and yields them as soon as each lookup finishes.
+
+    Uses the same ISBN as add_description_by_isbn (canonical, else ISBN_13, else ISBN_10); rows without any
+    ISBN are skipped. Rows with the same ISBN share one lookup.
+
+    :param books_df: DataFrame from json_to_dataframe.
+    :param max_workers: Number of parallel Open Library requests.
+    :return: Generator of (row index, description) in completion order.
+    """
+    isbn_13 = books_df['ISBN_13'] if 'ISBN_13' in books_df.columns else pd.Series(np.nan, index=books_df.index)
+    isbns = isbn_13.fillna(books_df['ISBN_10']) if 'ISBN_10' in books_df.columns else isbn_13
+    if CANONICAL_FIELD in books_df.columns:
+        isbns = books_df[CANONICAL_FIELD].fillna(isbns)
+    isbns = isbns.dropna()
+
+    if isbns.empty:
+        return
+
+    rows_by_isbn = {}
+    for index, isbn in isbns.items():
+        rows_by_isbn.setdefault(isbn, []).append(index)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(open_library_API_ISBN_to_description, isbn): isbn for isbn in rows_by_isbn}
+        for future in as_completed(futures):
+            try:
+                description = future.result()
+            except requests.exceptions.RequestException as e:
+                print(f"API request error: {e}")
+                description = "No description available."
+            for index in rows_by_isbn[futures[future]]:
+                yield index, description
+
+
 
 
 
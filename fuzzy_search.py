@@ -0,0 +1,210 @@
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from connections import mongo_client
+from search_keys import tokens
+
+
+#Typo tolerant search over the shelf's titles and authors
+#Every word of a live book's Title and Authors (normalized by search_keys.tokens) goes into a BK-tree,
+#which finds all words within a few edits of a query word without comparing against every word.
+#Books are ranked by how closely their words match the query words.
+#
+#The index is kept in memory per collection, built from Mongo on first use and updated by
+#place/remove/bulk move in this process. It is rebuilt every FUZZY_REBUILD_INTERVAL seconds to pick up
+#writes made by other processes.
+
+load_dotenv(".env")
+FUZZY_REBUILD_INTERVAL = float(os.getenv("FUZZY_REBUILD_INTERVAL", "300"))
+FIELDS = {"authors": "Authors", "title": "Title"}
+
+
+def levenshtein(a, b, max_distance=None):
+    """Edit distance between two strings; stops early once it exceeds max_distance."""
+    if a == b:
+        return 0
+    if len(a) < len(b):
+        a, b = b, a
+    if max_distance is not None and len(a) - len(b) > max_distance:
+        return max_distance + 1
+
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if max_distance is not None and min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+
+class BKTree:
+    """Burkhard-Keller tree over words with the edit distance as metric."""
+
+    def __init__(self):
+        self.root = None  # (word, {distance: child node})
+        self.size = 0
+
+    def add(self, word):
+        if self.root is None:
+            self.root = (word, {})
+            self.size = 1
+            return
+        node = self.root
+        while True:
+            distance = levenshtein(word, node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (word, {})
+                self.size += 1
+                return
+            node = child
+
+    def search(self, word, max_distance):
+        """Returns [(word, distance)] for all words within max_distance of word."""
+        if self.root is None:
+            return []
+        found = []
+        stack = [self.root]
+        while stack:
+            node_word, children = stack.pop()
+            distance = levenshtein(word, node_word)
+            if distance <= max_distance:
+                found.append((node_word, distance))
+            # triangle inequality: only children between distance-max and distance+max can match
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return found
+
+
+def default_max_distance(word):
+    """Short words tolerate fewer typos, otherwise everything matches everything."""
+    if len(word) <= 3:
+        return 0
+    if len(word) <= 6:
+        return 1
+    return 2
+
+
+class FuzzyIndex:
+    """BK-trees plus word -> book postings for the title and author words of live books."""
+
+    def __init__(self):
+        self.trees = {field: BKTree() for field in FIELDS}
+        self.postings = {field: {} for field in FIELDS}  # word -> set of book ids
+        self.books = {}  # book id -> {"_id", "Title", "Authors", "book_shelf"}
+        self.built_at = 0
+        self.lock = threading.RLock()
+
+    def add_books(self, docs):
+        with self.lock:
+            for doc in docs:
+                if doc.get("book_shelf") == -1:
+                    self.remove_books([doc["_id"]])
+                    continue
+                book_id = str(doc["_id"])
+                self.books[book_id] = {"_id": book_id, "Title": doc.get("Title"), "Authors": doc.get("Authors"),
+                                       "book_shelf": doc.get("book_shelf")}
+                for field, stored_field in FIELDS.items():
+                    for word in tokens(doc.get(stored_field)):
+                        self.trees[field].add(word)
+                        self.postings[field].setdefault(word, set()).add(book_id)
+
+    def remove_books(self, book_ids):
+        """Drops books from the postings; their words stay in the trees but no longer point anywhere."""
+        with self.lock:
+            for book_id in map(str, book_ids):
+                book = self.books.pop(book_id, None)
+                if book is None:
+                    continue
+                for field, stored_field in FIELDS.items():
+                    for word in tokens(book.get(stored_field)):
+                        self.postings[field].get(word, set()).discard(book_id)
+
+    def move_books(self, to_shelf, book_ids=None, from_shelf=None):
+        """Mirrors move_books_in_mongo; books coming back from shelf -1 are not in the index, so it goes stale."""
+        with self.lock:
+            book_ids = set(map(str, book_ids)) if book_ids else None
+            moved = [book_id for book_id, book in self.books.items()
+                     if (book_ids is None or book_id in book_ids)
+                     and (from_shelf is None or book["book_shelf"] == from_shelf)]
+            if to_shelf == -1:
+                self.remove_books(moved)
+            else:
+                for book_id in moved:
+                    self.books[book_id]["book_shelf"] = to_shelf
+                if from_shelf == -1 or (book_ids and len(book_ids) > len(moved)):
+                    self.built_at = 0  # rebuilt on the next search
+
+    def search(self, query, fields=("authors", "title"), max_distance=None, limit=10):
+        """
+        Ranks books by how well their words match the query words.
+
+        Each query word scores 1 - distance/len for its best matching word in a book;
+        the book score is the average over all query words (1.0 = every word matched exactly).
+
+        :return: List of book dicts with "score" and "matched" (query word -> matched word), best first.
+        """
+        query_words = tokens(query)
+        if not query_words:
+            return []
+
+        scores = {}  # book id -> {query word: (similarity, matched word)}
+        with self.lock:
+            for query_word in query_words:
+                allowed = default_max_distance(query_word) if max_distance is None else int(max_distance)
+                for field in fields:
+                    for word, distance in self.trees[field].search(query_word, allowed):
+                        similarity = 1 - distance / max(len(query_word), len(word))
+                        for book_id in self.postings[field].get(word, ()):
+                            best = scores.setdefault(book_id, {}).get(query_word)
+                            if best is None or similarity > best[0]:
+                                scores[book_id][query_word] = (similarity, word)
+
+            # tokens() yields two spellings for words with umlauts; count each query word once
+            results = []
+            for book_id, matches in scores.items():
+                score = sum(similarity for similarity, _ in matches.values()) / len(query_words)
+                results.append({**self.books[book_id], "score": round(score, 3),
+                                "matched": {query_word: word for query_word, (_, word) in matches.items()}})
+
+        results.sort(key=lambda book: book["score"], reverse=True)
+        return results[:limit]
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def build_index(mongo_uri, db_name="test", collection_name="stored_books"):
+    """Builds a fresh index from the live books of a collection."""
+    index = FuzzyIndex()
+    with mongo_client(mongo_uri) as client:
+        cursor = client[db_name][collection_name].find(
+            {"book_shelf": {"$gt": -1}}, {"Title": 1, "Authors": 1, "book_shelf": 1}
+        )
+        index.add_books(cursor)
+    index.built_at = time.time()
+    return index
+
+
+def get_index(mongo_uri, db_name="test", collection_name="stored_books"):
+    """Returns the index of a collection, building or rebuilding it when needed."""
+    key = (mongo_uri, db_name, collection_name)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None or time.time() - index.built_at > FUZZY_REBUILD_INTERVAL:
+            index = _indexes[key] = build_index(mongo_uri, db_name, collection_name)
+    return index
+
+
+def loaded_index(mongo_uri, db_name="test", collection_name="stored_books"):
+    """Returns the index only if it was already built; writes do not trigger a build."""
+    return _indexes.get((mongo_uri, db_name, collection_name))
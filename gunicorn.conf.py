@@ -0,0 +1,58 @@
+import gc
+import multiprocessing
+import os
+
+from dotenv import load_dotenv
+
+
+#Production serving of flask_api with gunicorn (Linux/macOS)
+#
+#    gunicorn -c gunicorn.conf.py flask_api:app
+#
+#WEB_WORKERS processes with WEB_THREADS threads each. The app is imported once in the master
+#(preload_app) and the workers are forked from it, so imported modules and the app's memory are shared
+#copy-on-write. Everything that must not be shared across a fork is created per process:
+#Mongo clients and HTTP sessions (connections.py) and the background threads (start_background_services).
+#Search results between /search_books and /select_book are in search_sessions.db, shared by all workers.
+#
+#The /metrics numbers are counted per worker and added up over all workers at every scrape, through
+#snapshot files in METRICS_MULTIPROC_DIR (see metrics.py). Per-process state that is NOT shared: the
+#description cache and the /fuzzy_search index (rebuilt per worker).
+#
+#python flask_api.py still starts the single-process development server.
+
+load_dotenv(".env")
+# set before preload_app imports metrics.py
+os.environ.setdefault("METRICS_MULTIPROC_DIR", "metrics_multiproc")
+
+bind = os.getenv("WEB_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_WORKERS", str(multiprocessing.cpu_count() * 2 + 1)))
+threads = int(os.getenv("WEB_THREADS", "4"))
+worker_class = "gthread"
+preload_app = True
+timeout = 120  # uncached searches wait for Google Books and Open Library
+graceful_timeout = 30
+keepalive = 5
+accesslog = os.getenv("WEB_ACCESS_LOG", "-") or None  # "-" = stdout, empty = off (load_test.py turns it off)
+
+
+def on_starting(server):
+    import metrics
+
+    metrics.clear_snapshots()  # a new server starts counting from 0
+
+
+def pre_fork(server, worker):
+    # Move everything allocated so far out of the garbage collector's reach. Otherwise the first
+    # collection in a worker touches (and so copies) every page of the preloaded app.
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import connections
+    import flask_api
+    import metrics
+
+    connections.reset_after_fork()
+    metrics.reset_after_fork()
+    flask_api.start_background_services()
@@ -0,0 +1,205 @@
+import argparse
+import json
+
+from pymongo import MongoClient
+
+from archive import LIVE_FILTER
+from functions_flask import build_or_filter_query, get_mongo_uri, unify_json_inX_to_X
+
+
+#Index advisor for or_filter_mongo
+#Replays the query shapes /search_books_in_mongo produces (no shelf, removed books, one shelf, each
+#combined with title / author / ISBN searches), runs explain("executionStats") on each and reports
+#collection scans and queries that examine many more documents than they return.
+#For those it proposes compound (book_shelf, <field>) indexes and can create them with --create.
+#
+#    python index_advisor.py                 report only
+#    python index_advisor.py --create        also create the proposed indexes
+#    python index_advisor.py --json          machine readable report
+
+RATIO_THRESHOLD = 10  # docsExamined / nReturned above this is flagged
+REMOVED_FILTER = {"book_shelf": {"$eq": -1}}
+
+
+def sample_values(collection):
+    """Takes search values from a real stored book so the replayed queries return something."""
+    doc = collection.find_one(
+        {"book_shelf": {"$gt": -1}, "Title": {"$type": "string"}, "Authors": {"$type": "string"}}
+    ) or collection.find_one() or {}
+
+    def first_word(value, default):
+        return value.split()[0] if isinstance(value, str) and value.split() else default
+
+    return {
+        "intitle": first_word(doc.get("Title"), "Python"),
+        "inauthor": first_word(doc.get("Authors"), "Guido"),
+        "isbn13": doc.get("ISBN_13") if isinstance(doc.get("ISBN_13"), str) else "9781449355739",
+        "isbn10": doc.get("ISBN_10") if isinstance(doc.get("ISBN_10"), str) else "1449355730",
+        "book_shelf": doc.get("book_shelf") if isinstance(doc.get("book_shelf"), int) and doc["book_shelf"] > -1 else 1,
+    }
+
+
+def query_shapes(values):
+    """Returns (name, API style query_params) for every shape or_filter_mongo can build."""
+    searches = {
+        "title": {"intitle": values["intitle"]},
+        "author": {"inauthor": values["inauthor"]},
+        "title+author": {"intitle": values["intitle"], "inauthor": values["inauthor"]},
+        "isbn13": {"isbn": values["isbn13"]},
+        "isbn10": {"isbn": values["isbn10"]},
+        "title prefix": {"intitle": values["intitle"], "match": "prefix"},
+        "author exact": {"inauthor": values["inauthor"], "match": "exact"},
+        "author words": {"inauthor": values["inauthor"], "match": "words"},
+    }
+    shelves = {"all": None, "removed": -1, "shelf": values["book_shelf"]}
+
+    shapes = []
+    for shelf_name, book_shelf in shelves.items():
+        for search_name, params in searches.items():
+            params = dict(params)
+            if book_shelf is not None:
+                params["book_shelf"] = book_shelf
+            shapes.append((f"{search_name} / {shelf_name}", params))
+    return shapes
+
+
+def _plan_stages(plan):
+    """Yields every stage of a winning plan (depth first)."""
+    yield plan
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            yield from _plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from _plan_stages(child)
+
+
+def explain_query(db, collection_name, query):
+    """Runs explain("executionStats") for a find and boils it down to the numbers that matter."""
+    explain = db.command("explain", {"find": collection_name, "filter": query}, verbosity="executionStats")
+    stats = explain.get("executionStats", {})
+    stages = list(_plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {})))
+
+    returned = stats.get("nReturned", 0)
+    examined = stats.get("totalDocsExamined", 0)
+    return {
+        "stages": sorted({stage.get("stage") for stage in stages if stage.get("stage")}),
+        "indexes": sorted({stage["indexName"] for stage in stages if "indexName" in stage}),
+        "nReturned": returned,
+        "docsExamined": examined,
+        "keysExamined": stats.get("totalKeysExamined", 0),
+        "millis": stats.get("executionTimeMillis", 0),
+        "ratio": examined / max(returned, 1),
+    }
+
+
+def _fields_of(query):
+    """(field, is a contains-regex) for the $or part of a query built by build_or_filter_query."""
+    fields = []
+    for part in query.get("$and", []):
+        for condition in part.get("$or", []):
+            fields.extend((field, isinstance(value, dict) and not value.get("$regex", "^").startswith("^"))
+                          for field, value in condition.items())
+    return fields
+
+
+def propose_indexes(query, stats):
+    """Proposes one (book_shelf, field) index per OR clause; every $or branch needs its own index."""
+    if "COLLSCAN" not in stats["stages"] and stats["ratio"] <= RATIO_THRESHOLD:
+        return []
+
+    proposals = []
+    for field, is_regex in _fields_of(query) or [(None, False)]:
+        keys = [("book_shelf", 1)] + ([(field, 1)] if field else [])
+        proposals.append({
+            "keys": keys,
+            "partialFilterExpression": None,
+            "note": "unanchored regex: the index is scanned instead of the collection, but not seeked; "
+                    "consider \"match\": \"prefix\"" if is_regex else "",
+        })
+    return proposals
+
+
+def advise(mongo_uri, db_name="test", collection_name="stored_books"):
+    """Replays all query shapes and returns the report rows and the unique index proposals."""
+    report = []
+    proposals = {}
+
+    with MongoClient(mongo_uri) as client:
+        db = client[db_name]
+        values = sample_values(db[collection_name])
+
+        for name, params in query_shapes(values):
+            query, collection_names = build_or_filter_query(unify_json_inX_to_X(dict(params)), collection_name)
+            for target in collection_names:
+                stats = explain_query(db, target, query)
+                flagged = "COLLSCAN" in stats["stages"] or stats["ratio"] > RATIO_THRESHOLD
+                report.append({"shape": name, "collection": target, "query": query, "flagged": flagged, **stats})
+
+                for proposal in propose_indexes(query, stats):
+                    # In the live collection, live shapes and removed shapes each get a partial index
+                    # over their own part of the collection; the archive only holds removed books anyway
+                    if target == collection_name:
+                        proposal["partialFilterExpression"] = REMOVED_FILTER if "removed" in name else LIVE_FILTER
+                    key = (target, tuple(proposal["keys"]), str(proposal["partialFilterExpression"]))
+                    proposals.setdefault(key, {"collection": target, **proposal, "shapes": []})["shapes"].append(name)
+
+    return report, list(proposals.values())
+
+
+def create_indexes(mongo_uri, proposals, db_name="test"):
+    """Creates the proposed indexes and returns their names."""
+    created = []
+    with MongoClient(mongo_uri) as client:
+        db = client[db_name]
+        for proposal in proposals:
+            options = {"name": "advisor_" + "_".join(field for field, _ in proposal["keys"])}
+            if proposal["partialFilterExpression"]:
+                prefix = "removed_" if proposal["partialFilterExpression"] == REMOVED_FILTER else "live_"
+                options["name"] = prefix + options["name"]
+                options["partialFilterExpression"] = proposal["partialFilterExpression"]
+            created.append(db[proposal["collection"]].create_index(proposal["keys"], **options))
+    return created
+
+
+def print_report(report, proposals):
+    print(f"{'shape':<26} {'collection':<22} {'plan':<28} {'returned':>8} {'examined':>8} {'ratio':>7}")
+    for row in report:
+        plan = "+".join(row["indexes"]) if row["indexes"] else ",".join(row["stages"])
+        flag = "  <-- " + ("COLLSCAN" if "COLLSCAN" in row["stages"] else "poor ratio") if row["flagged"] else ""
+        print(f"{row['shape']:<26} {row['collection']:<22} {plan[:28]:<28} "
+              f"{row['nReturned']:>8} {row['docsExamined']:>8} {row['ratio']:>7.1f}{flag}")
+
+    if not proposals:
+        print("\nNo index proposals, every shape is served by an index.")
+        return
+
+    print("\nProposed indexes:")
+    for proposal in proposals:
+        partial = ""
+        if proposal["partialFilterExpression"] == LIVE_FILTER:
+            partial = " (partial: live books only)"
+        elif proposal["partialFilterExpression"] == REMOVED_FILTER:
+            partial = " (partial: removed books only)"
+        print(f"  {proposal['collection']}: {proposal['keys']}{partial}  <- {', '.join(proposal['shapes'])}")
+        if proposal["note"]:
+            print(f"      note: {proposal['note']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Explain the query shapes of or_filter_mongo and propose indexes.")
+    parser.add_argument("--db", default="test")
+    parser.add_argument("--collection", default="stored_books")
+    parser.add_argument("--create", action="store_true", help="create the proposed indexes")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    mongo_uri = get_mongo_uri()
+    report, proposals = advise(mongo_uri, args.db, args.collection)
+
+    if args.json:
+        print(json.dumps({"report": report, "proposals": proposals}, indent=4, default=str))
+    else:
+        print_report(report, proposals)
+
+    if args.create and proposals:
+        print(f"\nCreated: {', '.join(create_indexes(mongo_uri, proposals, args.db))}")
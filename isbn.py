@@ -0,0 +1,118 @@
+import argparse
+import math
+import re
+
+from pymongo import MongoClient, UpdateOne
+
+from shelf_changes import change_stamp
+
+
+#Canonical ISBNs
+#Google Books, Open Library and people typing into the search field write ISBNs differently
+#("978-3-522-20260-2", "3 522 20260 0", "isbn 3522202600"). Every book gets one canonical key, the ISBN-13
+#without separators, stored as ISBN_canonical next to ISBN_13/ISBN_10. Shelf searches, description
+#lookups and duplicate detection compare that key, so an ISBN-10 query finds a book stored with only an
+#ISBN-13 and the other way round.
+#
+#Books stored before ISBN_canonical existed need one run of:   python isbn.py
+
+CANONICAL_FIELD = "ISBN_canonical"
+_SEPARATORS = re.compile(r"[\s\-\u2010-\u2015]")  # spaces, hyphens and unicode dashes
+# "ISBN", "ISBN:", "ISBN-13: ", "ISBN 10 " - the 10/13 only when a colon or space follows ("ISBN 1000000000")
+_PREFIX = re.compile(r"^ISBN(?:[\s\-\u2010-\u2015]*1[03](?=[\s:]))?[\s:]*", re.IGNORECASE)
+
+
+def clean_isbn(value):
+    """Strips an "ISBN-13:" style prefix and separators, upper-cases the check digit X. None for missing values."""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    cleaned = _SEPARATORS.sub("", _PREFIX.sub("", str(value).strip())).upper()
+    return cleaned or None
+
+
+def isbn10_check_digit(first_nine):
+    total = sum((10 - i) * int(digit) for i, digit in enumerate(first_nine))
+    check = (11 - total % 11) % 11
+    return "X" if check == 10 else str(check)
+
+
+def isbn13_check_digit(first_twelve):
+    total = sum((3 if i % 2 else 1) * int(digit) for i, digit in enumerate(first_twelve))
+    return str((10 - total % 10) % 10)
+
+
+def is_valid_isbn10(isbn):
+    return (isinstance(isbn, str) and len(isbn) == 10 and isbn[:9].isdigit()
+            and isbn[9] == isbn10_check_digit(isbn[:9]))
+
+
+def is_valid_isbn13(isbn):
+    return isinstance(isbn, str) and len(isbn) == 13 and isbn.isdigit() and isbn[12] == isbn13_check_digit(isbn[:12])
+
+
+def isbn10_to_13(isbn10):
+    body = "978" + isbn10[:9]
+    return body + isbn13_check_digit(body)
+
+
+def canonical_isbn(value):
+    """
+    Returns the ISBN-13 (digits only) for an ISBN-10 or ISBN-13 in any notation.
+
+    :return: The canonical ISBN, or None if the value is no valid ISBN (wrong length or check digit).
+    """
+    isbn = clean_isbn(value)
+    if is_valid_isbn13(isbn):
+        return isbn
+    if is_valid_isbn10(isbn):
+        return isbn10_to_13(isbn)
+    return None
+
+
+def record_canonical_isbn(record):
+    """Canonical ISBN of a book record, from ISBN_13 or else ISBN_10."""
+    for key in ("ISBN_13", "ISBN_10"):
+        canonical = canonical_isbn(record.get(key))
+        if canonical:
+            return canonical
+    return None
+
+
+def backfill_canonical_isbns(collection, batch_size=500):
+    """
+    Writes ISBN_canonical into stored books that do not have it yet, in bulk_write batches.
+
+    :return: Number of books updated.
+    """
+    query = {CANONICAL_FIELD: {"$exists": False}}
+    updated = 0
+    batch = []
+
+    for doc in collection.find(query, {"ISBN_13": 1, "ISBN_10": 1}):
+        if not batch:
+            stamp = change_stamp(collection.database, collection.name)  # one change_seq per batch
+        batch.append(UpdateOne({"_id": doc["_id"]}, {"$set": {CANONICAL_FIELD: record_canonical_isbn(doc), **stamp}}))
+        if len(batch) >= batch_size:
+            updated += collection.bulk_write(batch, ordered=False).modified_count
+            batch = []
+    if batch:
+        updated += collection.bulk_write(batch, ordered=False).modified_count
+
+    return updated
+
+
+if __name__ == "__main__":
+    from archive import archive_collection_name, ensure_live_indexes
+    from functions_flask import get_mongo_uri
+
+    parser = argparse.ArgumentParser(description="Write the canonical ISBN into stored books.")
+    parser.add_argument("--db", default="test")
+    parser.add_argument("--collection", default="stored_books")
+    args = parser.parse_args()
+
+    mongo_uri = get_mongo_uri()
+    with MongoClient(mongo_uri) as client:
+        db = client[args.db]
+        for name in (args.collection, archive_collection_name(args.collection)):
+            print(f"{name}: {backfill_canonical_isbns(db[name])} book(s) updated.")
+        ensure_live_indexes(db[args.collection], mongo_uri)
@@ -0,0 +1,97 @@
+import os
+import re
+from collections import namedtuple
+
+from dotenv import load_dotenv
+from flask import g, jsonify, request
+
+
+#Libraries (branches) with their own shelves
+#Every request names its library with the header "X-Library: <name>" (or ?library=<name>); without one it
+#goes to DEFAULT_LIBRARY, which is the "test" database of before. Each library is a database of its own,
+#so its queries, indexes, archive, change sequence, /shelf_stats counters, fuzzy index and caches (all keyed
+#by database and collection) never touch another library's books.
+#
+#In the .env file, name=database or name=database/collection, comma separated:
+#    LIBRARIES=nord=gb4f_nord,sued=gb4f_sued/books
+#A library can live on a cluster of its own with MONGO_URI_<NAME> (e.g. MONGO_URI_NORD), otherwise MONGO_URI.
+#Libraries on the same cluster share one connection pool (connections.py), others get their own.
+
+load_dotenv(".env")
+DEFAULT_LIBRARY = os.getenv("DEFAULT_LIBRARY", "default")
+DEFAULT_DB_NAME = "test"
+DEFAULT_COLLECTION_NAME = "stored_books"
+
+_NAME = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class Library(namedtuple("Library", ["name", "db_name", "collection_name"])):
+    """One library: where its books are stored."""
+
+    __slots__ = ()
+
+    @property
+    def mongo_uri(self):
+        mongo_uri = os.getenv(f"MONGO_URI_{self.name.upper().replace('-', '_')}") or os.getenv("MONGO_URI")
+        if not mongo_uri:
+            raise ValueError("MONGO_URI not found in .env file!")
+        return mongo_uri
+
+
+def load_libraries(spec=None):
+    """
+    Parses the LIBRARIES setting; DEFAULT_LIBRARY is always there.
+
+    :return: Dict name -> Library.
+    :raises ValueError: For malformed entries or two libraries in one database.
+    """
+    spec = os.getenv("LIBRARIES", "") if spec is None else spec
+    libraries = {DEFAULT_LIBRARY: Library(DEFAULT_LIBRARY, DEFAULT_DB_NAME, DEFAULT_COLLECTION_NAME)}
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, target = entry.partition("=")
+        db_name, _, collection_name = target.strip().partition("/")
+        name = name.strip()
+        if not _NAME.match(name) or not db_name:
+            raise ValueError(f"LIBRARIES entry {entry!r} is not name=database or name=database/collection")
+        libraries[name] = Library(name, db_name, collection_name or DEFAULT_COLLECTION_NAME)
+
+    # stats counters, change sequences and the archive are per database, so databases must not be shared
+    db_names = [library.db_name for library in libraries.values()]
+    if len(set(db_names)) != len(db_names):
+        raise ValueError("Every library needs a database of its own (LIBRARIES)")
+    return libraries
+
+
+LIBRARIES = load_libraries()
+
+
+def get_library(name=None):
+    """The library of that name (None for unknown names), DEFAULT_LIBRARY without a name."""
+    return LIBRARIES.get(name or DEFAULT_LIBRARY)
+
+
+def library_for(db_name, collection_name=DEFAULT_COLLECTION_NAME):
+    """The library stored in a database, for background work that only kept db_name/collection_name."""
+    for library in LIBRARIES.values():
+        if library.db_name == db_name and library.collection_name == collection_name:
+            return library
+    return None
+
+
+def mongo_uri_for(db_name, collection_name=DEFAULT_COLLECTION_NAME):
+    library = library_for(db_name, collection_name)
+    return library.mongo_uri if library else get_library().mongo_uri
+
+
+def select_library():
+    """before_request hook: looks up the library of the request, 404 for unknown ones."""
+    name = request.headers.get("X-Library") or request.args.get("library")
+    library = get_library(name)
+    if library is None:
+        return jsonify({"error": f"Unknown library {name!r}"}), 404
+    g.library = library
+
+
+def current_library():
+    """The library of the current request (DEFAULT_LIBRARY outside of requests)."""
+    return g.get("library") or get_library()
@@ -0,0 +1,156 @@
+import argparse
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+
+#Load test for the API
+#Sends requests from a pool of client threads for a fixed time and reports throughput and latency.
+#
+#Against a running server:
+#    python load_test.py --url http://127.0.0.1:8000 --path "/fuzzy_search?q=ende" --clients 32
+#
+#Scaling with the number of gunicorn workers (starts gunicorn -c gunicorn.conf.py for each count):
+#    python load_test.py --workers 1,2,4,8 --path /get_selected_books
+#
+#POST requests: --method POST --body '{"intitle": "Momo"}'
+
+DEFAULT_PORT = 8765
+
+
+def run_load(url, method="GET", body=None, clients=16, duration=10.0):
+    """
+    Keeps `clients` threads sending requests to url for `duration` seconds.
+
+    :return: Dict with requests, errors, requests per second and latency percentiles in ms.
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+    data = body.encode("utf-8") if body else None
+
+    def client():
+        own_latencies = []
+        own_errors = 0
+        while time.perf_counter() < deadline:
+            request = urllib.request.Request(url, data=data, method=method,
+                                             headers={"Content-Type": "application/json"} if data else {})
+            started = time.perf_counter()
+            try:
+                with urllib.request.urlopen(request, timeout=30) as response:
+                    response.read()
+            except urllib.error.HTTPError as e:
+                if e.code >= 500:
+                    own_errors += 1
+                    continue
+            except (urllib.error.URLError, OSError):
+                own_errors += 1
+                continue
+            own_latencies.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(own_latencies)
+            errors[0] += own_errors
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+
+    def percentile(p):
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 1) if latencies else None
+
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "rps": round(len(latencies) / elapsed, 1),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 1) if latencies else None,
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+    }
+
+
+def wait_until_up(url, timeout=30.0):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=2).read()
+            return True
+        except urllib.error.HTTPError:
+            return True  # the server answers, that is enough
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.2)
+    return False
+
+
+def start_gunicorn(workers, threads, port):
+    env = dict(os.environ, WEB_WORKERS=str(workers), WEB_THREADS=str(threads), WEB_BIND=f"127.0.0.1:{port}",
+               WEB_ACCESS_LOG="")
+    return subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "flask_api:app"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+
+def scaling_test(worker_counts, threads, path, method, body, clients, duration, port=DEFAULT_PORT):
+    """Runs the same load against gunicorn with each worker count, one after another."""
+    results = []
+    for workers in worker_counts:
+        server = start_gunicorn(workers, threads, port)
+        try:
+            base_url = f"http://127.0.0.1:{port}"
+            if not wait_until_up(base_url + "/"):
+                print(f"gunicorn with {workers} worker(s) did not come up")
+                continue
+            run_load(base_url + path, method, body, clients, min(duration, 2.0))  # warm up caches and pools
+            result = run_load(base_url + path, method, body, clients, duration)
+            results.append({"workers": workers, "threads": threads, **result})
+            print(f"{workers:>3} worker(s): {result['rps']:>8} req/s  p50 {result['p50_ms']} ms  "
+                  f"p99 {result['p99_ms']} ms  errors {result['errors']}")
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait(timeout=30)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the API, optionally across gunicorn worker counts.")
+    parser.add_argument("--url", default=None, help="base URL of a running server (omit with --workers)")
+    parser.add_argument("--path", default="/get_selected_books")
+    parser.add_argument("--method", default="GET")
+    parser.add_argument("--body", default=None, help="JSON body for POST requests")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent client threads")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per run")
+    parser.add_argument("--workers", default=None, help="comma separated gunicorn worker counts, e.g. 1,2,4")
+    parser.add_argument("--threads", type=int, default=4, help="threads per gunicorn worker")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    if args.workers:
+        results = scaling_test([int(n) for n in args.workers.split(",")], args.threads, args.path, args.method,
+                               args.body, args.clients, args.duration)
+        if results and len(results) > 1:
+            base = results[0]["rps"] or 1
+            print("speedup vs. first run: " + ", ".join(f"{r['workers']}w x{r['rps'] / base:.2f}" for r in results))
+    elif args.url:
+        results = run_load(args.url.rstrip("/") + args.path, args.method, args.body, args.clients, args.duration)
+        print(f"{results['rps']} req/s  mean {results['mean_ms']} ms  p50 {results['p50_ms']} ms  "
+              f"p95 {results['p95_ms']} ms  p99 {results['p99_ms']} ms  errors {results['errors']}")
+    else:
+        parser.error("give --url of a running server or --workers to start gunicorn")
+
+    if args.json:
+        print(json.dumps(results, indent=4))
@@ -0,0 +1,298 @@
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+from urllib.parse import urlparse
+
+from dotenv import load_dotenv
+from pymongo import monitoring
+
+
+#Per-stage timing and counters, exposed in the Prometheus text format at /metrics
+#Switch on with METRICS_ENABLED=1 in the .env file. When it is off every helper returns
+#right away (a shared no-op timer), so the instrumented hot path pays one attribute lookup.
+#
+#Several worker processes (gunicorn.conf.py): every process counts in its own memory and writes a snapshot
+#to METRICS_MULTIPROC_DIR every METRICS_SNAPSHOT_INTERVAL seconds. /metrics, whichever worker answers it,
+#adds up the snapshots of all processes. Snapshots of exited workers are kept, so counters never go back;
+#the directory is emptied when the server starts. Other workers' numbers are up to one interval old.
+
+load_dotenv(".env")
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0").lower() in ("1", "true", "yes")
+METRICS_MULTIPROC_DIR = os.getenv("METRICS_MULTIPROC_DIR", "")  # empty = this process only
+METRICS_SNAPSHOT_INTERVAL = float(os.getenv("METRICS_SNAPSHOT_INTERVAL", "1"))  # seconds
+
+# Latency buckets in seconds (upstream calls are usually between 50 ms and a few seconds)
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Buckets for "how many rows did a search return" (Google Books caps maxResults at 40)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 40, 100, 500)
+
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+_buckets = {}     # name -> bucket bounds
+_changes = [0]    # bumped on every update, the snapshot writer skips unchanged rounds
+_snapshot = {}    # pid -> snapshot file of that process
+_help = {
+    "gb4f_stage_duration_seconds": "Time spent in each processing stage.",
+    "gb4f_upstream_request_duration_seconds": "Duration of outbound HTTP calls per host.",
+    "gb4f_mongo_operation_duration_seconds": "Duration of MongoDB commands per operation.",
+    "gb4f_http_request_duration_seconds": "Duration of Flask requests per endpoint.",
+    "gb4f_search_result_count": "Number of rows returned per search.",
+    "gb4f_upstream_errors_total": "Failed outbound HTTP calls per host and reason (exception, http_status, ...).",
+    "gb4f_mongo_errors_total": "Failed MongoDB commands per operation.",
+    "gb4f_cache_hits_total": "Cache hits per cache.",
+    "gb4f_cache_misses_total": "Cache misses per cache.",
+    "gb4f_singleflight_shared_total": "Calls answered by an identical call already in flight, per group.",
+    "gb4f_compression_input_bytes_total": "Response bytes before compression, per encoding.",
+    "gb4f_compression_output_bytes_total": "Response bytes after compression, per encoding.",
+    "gb4f_write_behind_flushed_total": "Journaled selections written to Mongo by the write-behind flusher.",
+}
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Adds value to the counter name{labels}. Does nothing when metrics are disabled."""
+    if not METRICS_ENABLED:
+        return
+    key = (name, _label_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+        _changes[0] += 1
+
+
+def observe(name, value, buckets=DURATION_BUCKETS, **labels):
+    """Records one observation in the histogram name{labels}."""
+    if not METRICS_ENABLED:
+        return
+    key = (name, _label_key(labels))
+    with _lock:
+        bounds = _buckets.setdefault(name, buckets)
+        entry = _histograms.get(key)
+        if entry is None:
+            entry = _histograms[key] = [[0] * len(bounds), 0.0, 0]
+        for i, bound in enumerate(bounds):
+            if value <= bound:
+                entry[0][i] += 1
+        entry[1] += value
+        entry[2] += 1
+        _changes[0] += 1
+
+
+def record_cache(cache, hit, **labels):
+    """Counts a hit or a miss for the named cache (labels e.g. library=... for caches kept per library)."""
+    inc("gb4f_cache_hits_total" if hit else "gb4f_cache_misses_total", cache=cache, **labels)
+
+
+def record_result_count(endpoint, count):
+    observe("gb4f_search_result_count", count, buckets=COUNT_BUCKETS, endpoint=endpoint)
+
+
+class _NullTimer:
+    """Shared timer used while metrics are disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ("name", "labels", "error_counter", "error_labels", "start")
+
+    def __init__(self, name, labels, error_counter=None, error_labels=None):
+        self.name = name
+        self.labels = labels
+        self.error_counter = error_counter
+        self.error_labels = {**labels, **(error_labels or {})}
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.name, time.perf_counter() - self.start, **self.labels)
+        if exc_type is not None and self.error_counter:
+            inc(self.error_counter, **self.error_labels)
+        return False
+
+
+def timed(stage):
+    """Context manager timing one processing stage, e.g. `with timed("json_to_dataframe"):`."""
+    if not METRICS_ENABLED:
+        return _NULL_TIMER
+    return _Timer("gb4f_stage_duration_seconds", {"stage": stage})
+
+
+def timed_upstream(url):
+    """Context manager timing an outbound HTTP call; exceptions are counted as upstream errors."""
+    if not METRICS_ENABLED:
+        return _NULL_TIMER
+    host = urlparse(url).hostname or "unknown"
+    # same labels as upstream_error, so the error counter has one label set
+    return _Timer("gb4f_upstream_request_duration_seconds", {"host": host}, "gb4f_upstream_errors_total",
+                  {"reason": "exception"})
+
+
+def upstream_error(url, reason="http_status"):
+    """Counts a failed upstream call that did not raise (e.g. a non-200 status)."""
+    if not METRICS_ENABLED:
+        return
+    inc("gb4f_upstream_errors_total", host=urlparse(url).hostname or "unknown", reason=reason)
+
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """Times every MongoDB command (find, insert, update, createIndexes, ...) via pymongo's monitoring API."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        observe("gb4f_mongo_operation_duration_seconds", event.duration_micros / 1e6,
+                operation=event.command_name)
+
+    def failed(self, event):
+        observe("gb4f_mongo_operation_duration_seconds", event.duration_micros / 1e6,
+                operation=event.command_name)
+        inc("gb4f_mongo_errors_total", operation=event.command_name)
+
+
+# Listeners must be registered before any MongoClient is created
+if METRICS_ENABLED:
+    monitoring.register(MongoCommandTimer())
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    body = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs)
+    return "{" + body + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _snapshot_path():
+    # the pid alone is not enough, a later worker may get the pid of an exited one
+    pid = os.getpid()
+    if pid not in _snapshot:
+        _snapshot[pid] = os.path.join(METRICS_MULTIPROC_DIR, f"metrics-{pid}-{uuid.uuid4().hex[:8]}.json")
+    return _snapshot[pid]
+
+
+def write_snapshot():
+    """Writes the numbers of this process to METRICS_MULTIPROC_DIR (atomically, readers never see half a file)."""
+    with _lock:
+        data = {
+            "counters": [[name, labels, value] for (name, labels), value in _counters.items()],
+            "histograms": [[name, labels, _buckets[name], entry[0], entry[1], entry[2]]
+                           for (name, labels), entry in _histograms.items()],
+        }
+    path = _snapshot_path()
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+
+def reset_after_fork():
+    """Forgets the numbers inherited from the parent process, its own snapshot already counts them."""
+    global _lock
+    _lock = threading.Lock()  # the parent may have held it while forking
+    _counters.clear()
+    _histograms.clear()
+
+
+def clear_snapshots():
+    """Deletes the snapshots of a previous run (gunicorn.conf.py calls it when the server starts)."""
+    if METRICS_MULTIPROC_DIR:
+        os.makedirs(METRICS_MULTIPROC_DIR, exist_ok=True)
+        for path in glob.glob(os.path.join(METRICS_MULTIPROC_DIR, "metrics-*.json*")):
+            os.remove(path)
+
+
+def start_snapshot_writer(interval=METRICS_SNAPSHOT_INTERVAL):
+    """Writes a snapshot every interval seconds while something changed. Runs per process, after the fork."""
+    if not (METRICS_ENABLED and METRICS_MULTIPROC_DIR):
+        return None
+    os.makedirs(METRICS_MULTIPROC_DIR, exist_ok=True)
+    stop_event = threading.Event()
+
+    def loop():
+        written = None
+        while not stop_event.wait(interval):
+            if _changes[0] != written:
+                written = _changes[0]
+                try:
+                    write_snapshot()
+                except OSError as e:
+                    print(f"Writing the metrics snapshot failed: {e}")
+
+    threading.Thread(target=loop, name="metrics-snapshot", daemon=True).start()
+    return stop_event
+
+
+def _collect():
+    """Counters, histograms and bucket bounds of this process, or added up over all snapshots."""
+    if not METRICS_MULTIPROC_DIR:
+        with _lock:
+            return (dict(_counters),
+                    {key: [list(entry[0]), entry[1], entry[2]] for key, entry in _histograms.items()},
+                    dict(_buckets))
+
+    write_snapshot()  # this process' own numbers are always current
+    counters, histograms, buckets = {}, {}, {}
+    for path in glob.glob(os.path.join(METRICS_MULTIPROC_DIR, "metrics-*.json")):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue  # replaced while listing
+        for name, labels, value in data["counters"]:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, bounds, counts, total, count in data["histograms"]:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            bounds = buckets.setdefault(name, tuple(bounds))
+            entry = histograms.setdefault(key, [[0] * len(bounds), 0.0, 0])
+            entry[0] = [a + b for a, b in zip(entry[0], counts)]
+            entry[1] += total
+            entry[2] += count
+    return counters, histograms, buckets
+
+
+def render_prometheus():
+    """Returns all collected metrics in the Prometheus text exposition format (version 0.0.4)."""
+    counters, histograms, buckets = _collect()
+
+    lines = []
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f"# HELP {name} {_help.get(name, name)}")
+        lines.append(f"# TYPE {name} counter")
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+    for name in sorted({name for name, _ in histograms}):
+        lines.append(f"# HELP {name} {_help.get(name, name)}")
+        lines.append(f"# TYPE {name} histogram")
+        for (metric, labels), (counts, total, count) in sorted(histograms.items()):
+            if metric != name:
+                continue
+            for bound, bucket_count in zip(buckets[name], counts):
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {bucket_count}")
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+    return "\n".join(lines) + "\n"
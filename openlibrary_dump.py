@@ -0,0 +1,249 @@
+import argparse
+import gzip
+import heapq
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+from dotenv import load_dotenv
+
+from isbn import canonical_isbn
+
+
+#Offline Open Library descriptions
+#Builds an ISBN -> description index from the Open Library dumps (https://openlibrary.org/developers/dumps),
+#so open_library_API_ISBN_to_description can answer without a network call.
+#
+#    python openlibrary_dump.py ol_dump_editions_latest.txt.gz ol_dump_works_latest.txt.gz --out data/openlibrary
+#
+#writes two files:
+#    data/openlibrary.idx    sorted fixed-width records: 13 byte ISBN-13, 8 byte offset, 4 byte length
+#    data/openlibrary.blob   the UTF-8 descriptions the offsets point into
+#and the app uses them with OPENLIBRARY_INDEX=data/openlibrary in the .env file.
+#
+#The dumps are read line by line and everything that has to be sorted goes through sorted run files on
+#disk (external merge sort), so memory stays flat no matter how big the dumps are.
+#An edition's own description wins over the description of its work.
+
+load_dotenv(".env")
+OPENLIBRARY_INDEX = os.getenv("OPENLIBRARY_INDEX", "")  # base path without .idx/.blob, empty = no offline index
+
+RECORD = struct.Struct(">13sQI")  # ISBN-13, offset into the blob, length
+RUN_SIZE = 1_000_000  # lines per sorted run file
+
+
+def _description_text(value):
+    if isinstance(value, dict):
+        value = value.get("value")
+    return value.strip() if isinstance(value, str) and value.strip() else None
+
+
+def _open_dump(path):
+    return gzip.open(path, "rt", encoding="utf-8") if path.endswith(".gz") else open(path, encoding="utf-8")
+
+
+class _RunWriter:
+    """Collects lines and spills them as sorted run files of at most run_size lines."""
+
+    def __init__(self, directory, name, run_size):
+        self.directory, self.name, self.run_size = directory, name, run_size
+        self.lines = []
+        self.paths = []
+
+    def add(self, line):
+        self.lines.append(line)
+        if len(self.lines) >= self.run_size:
+            self.flush()
+
+    def flush(self):
+        if not self.lines:
+            return
+        self.lines.sort()
+        path = os.path.join(self.directory, f"{self.name}-{len(self.paths)}.run")
+        with open(path, "w", encoding="utf-8") as run:
+            run.writelines(self.lines)
+        self.paths.append(path)
+        self.lines = []
+
+    def merged(self):
+        """Yields all lines in sorted order (k-way merge of the run files)."""
+        self.flush()
+        files = [open(path, encoding="utf-8") for path in self.paths]
+        try:
+            yield from heapq.merge(*files)
+        finally:
+            for file in files:
+                file.close()
+
+
+def _read_dumps(dump_paths, blob, isbn_runs, ref_runs, work_runs):
+    """First pass: writes descriptions to the blob and spills ISBN, edition->work and work records to runs."""
+    offset = blob.tell()
+    counts = {"editions": 0, "works": 0}
+
+    def write_description(text):
+        nonlocal offset
+        data = text.encode("utf-8")
+        blob.write(data)
+        offset += len(data)
+        return offset - len(data), len(data)
+
+    for path in dump_paths:
+        with _open_dump(path) as dump:
+            for line in dump:
+                # dump lines: type, key, revision, last_modified, JSON
+                parts = line.rstrip("\n").split("\t", 4)
+                if len(parts) != 5:
+                    continue
+                record_type, key, _, _, payload = parts
+
+                if record_type == "/type/edition" and '"isbn_' in payload:
+                    record = json.loads(payload)
+                    isbns = {canonical_isbn(value) for value in record.get("isbn_13", []) + record.get("isbn_10", [])}
+                    isbns.discard(None)
+                    if not isbns:
+                        continue
+                    counts["editions"] += 1
+                    description = _description_text(record.get("description"))
+                    if description:
+                        start, length = write_description(description)
+                        for isbn in isbns:
+                            isbn_runs.add(f"{isbn}\t0\t{start}\t{length}\n")  # 0: edition description wins
+                    else:
+                        for work in record.get("works", [])[:1]:
+                            for isbn in isbns:
+                                ref_runs.add(f"{work['key']}\t{isbn}\n")
+
+                elif record_type == "/type/work" and '"description"' in payload:
+                    description = _description_text(json.loads(payload).get("description"))
+                    if description:
+                        counts["works"] += 1
+                        start, length = write_description(description)
+                        work_runs.add(f"{key}\t{start}\t{length}\n")
+
+    return counts
+
+
+def _join_works(isbn_runs, ref_runs, work_runs):
+    """Second pass: merge join of edition->work references with work descriptions, both sorted by work key."""
+    works = (line.rstrip("\n").split("\t") for line in work_runs.merged())
+    work = next(works, None)
+    joined = 0
+
+    for line in ref_runs.merged():
+        work_key, isbn = line.rstrip("\n").split("\t")
+        while work is not None and work[0] < work_key:
+            work = next(works, None)
+        if work is not None and work[0] == work_key:
+            isbn_runs.add(f"{isbn}\t1\t{work[1]}\t{work[2]}\n")
+            joined += 1
+    return joined
+
+
+def build_index(dump_paths, out_path, run_size=RUN_SIZE, tmp_dir=None):
+    """
+    Builds <out_path>.idx and <out_path>.blob from Open Library dump files (.txt or .txt.gz).
+
+    Editions and works can come from separate dumps or the combined "all" dump.
+    The files are written under temporary names and moved into place at the end, so a running app
+    keeps the old index until the new one is complete.
+
+    :return: Dict with the number of editions, works and ISBNs indexed.
+    """
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as directory:
+        isbn_runs = _RunWriter(directory, "isbn", run_size)
+        ref_runs = _RunWriter(directory, "ref", run_size)
+        work_runs = _RunWriter(directory, "work", run_size)
+
+        with open(out_path + ".blob.tmp", "wb") as blob:
+            counts = _read_dumps(dump_paths, blob, isbn_runs, ref_runs, work_runs)
+        counts["joined"] = _join_works(isbn_runs, ref_runs, work_runs)
+
+        # Third pass: sorted by ISBN and priority, keep the first record per ISBN
+        counts["isbns"] = 0
+        previous = None
+        with open(out_path + ".idx.tmp", "wb") as index:
+            for line in isbn_runs.merged():
+                isbn, _, start, length = line.rstrip("\n").split("\t")
+                if isbn == previous:
+                    continue
+                index.write(RECORD.pack(isbn.encode("ascii"), int(start), int(length)))
+                previous = isbn
+                counts["isbns"] += 1
+
+    os.replace(out_path + ".blob.tmp", out_path + ".blob")
+    os.replace(out_path + ".idx.tmp", out_path + ".idx")
+    return counts
+
+
+class DescriptionIndex:
+    """Read side: both files memory-mapped, lookups are a binary search over the fixed-width records."""
+
+    def __init__(self, path):
+        with open(path + ".idx", "rb") as index, open(path + ".blob", "rb") as blob:
+            self.index = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path + ".idx") else b""
+            self.blob = mmap.mmap(blob.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path + ".blob") else b""
+        self.count = len(self.index) // RECORD.size
+
+    def __len__(self):
+        return self.count
+
+    def lookup(self, isbn):
+        """Returns the description for any ISBN-10/13 notation, or None if the dump has none."""
+        canonical = canonical_isbn(isbn)
+        if canonical is None:
+            return None
+        key = canonical.encode("ascii")
+
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            position = middle * RECORD.size
+            candidate = self.index[position:position + 13]
+            if candidate < key:
+                low = middle + 1
+            elif candidate > key:
+                high = middle
+            else:
+                _, start, length = RECORD.unpack_from(self.index, position)
+                return self.blob[start:start + length].decode("utf-8")
+        return None
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def offline_description(isbn):
+    """Description from the OPENLIBRARY_INDEX files, or None (no index configured, or ISBN not in it)."""
+    global _index
+    if not OPENLIBRARY_INDEX:
+        return None
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                try:
+                    _index = DescriptionIndex(OPENLIBRARY_INDEX)
+                except OSError as e:
+                    print(f"Open Library index {OPENLIBRARY_INDEX} not usable: {e}")
+                    _index = False  # do not retry on every lookup
+    return _index.lookup(isbn) if _index else None
+
+
+if __name__ == "__main__":
+    import time
+
+    parser = argparse.ArgumentParser(description="Build the offline ISBN -> description index from Open Library dumps.")
+    parser.add_argument("dumps", nargs="+", help="editions/works dump files (.txt or .txt.gz)")
+    parser.add_argument("--out", default=OPENLIBRARY_INDEX or "openlibrary", help="base path of the .idx/.blob files")
+    parser.add_argument("--run-size", type=int, default=RUN_SIZE, help="lines per sorted run (memory vs. number of runs)")
+    parser.add_argument("--tmp-dir", default=None, help="directory for the run files (needs room for a few GB)")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    counts = build_index(args.dumps, args.out, args.run_size, args.tmp_dir)
+    print(f"{counts['isbns']} ISBNs indexed ({counts['editions']} editions, {counts['works']} work descriptions, "
+          f"{counts['joined']} ISBNs via their work) in {time.perf_counter() - started:.0f}s -> {args.out}.idx/.blob")
@@ -0,0 +1,159 @@
+import cProfile
+import hmac
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from dotenv import load_dotenv
+from flask import g, request
+
+
+#Opt-in profiling of single requests
+#A request is profiled when it carries the header "X-Profile: <PROFILE_TOKEN>" (or ?profile=<PROFILE_TOKEN>).
+#It then runs under cProfile (deterministic, saved as .pstats) while a sampler thread records the
+#request thread's stack every few milliseconds (saved as .collapsed, readable by flamegraph.pl / speedscope).
+#Without PROFILE_TOKEN in the .env file profiling is switched off completely.
+
+load_dotenv(".env")
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_DIR = os.path.abspath(os.getenv("PROFILE_DIR", "profiles"))
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "50"))  # number of profiled requests kept on disk
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))  # seconds
+
+# The profile endpoints themselves use the token too, but should not create new profiles
+EXCLUDED_ENDPOINTS = {"list_profiles", "download_profile", "metrics_endpoint"}
+
+# cProfile cannot run twice at the same time on newer Pythons, so only one request is profiled at once
+_profile_lock = threading.Lock()
+
+
+def is_authorized(token):
+    """Checks a token against PROFILE_TOKEN in constant time."""
+    if not PROFILE_TOKEN or not token:
+        return False
+    return hmac.compare_digest(str(token), PROFILE_TOKEN)
+
+
+def profile_requested():
+    return is_authorized(request.headers.get("X-Profile") or request.args.get("profile"))
+
+
+class StackSampler(threading.Thread):
+    """Samples the stack of one thread at a fixed interval and counts identical stacks."""
+
+    def __init__(self, thread_id, interval=PROFILE_SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def start_profile():
+    """before_request hook: starts the profilers if the request asked for it."""
+    if not PROFILE_TOKEN or request.endpoint in EXCLUDED_ENDPOINTS or not profile_requested():
+        return
+    if not _profile_lock.acquire(blocking=False):
+        g.profile_skipped = True  # another request is being profiled right now
+        return
+
+    sampler = StackSampler(threading.get_ident())
+    profiler = cProfile.Profile()
+    g.profile = (profiler, sampler, time.time())
+    sampler.start()
+    profiler.enable()
+
+
+def finish_profile(response):
+    """after_request hook: names the profile in a header and writes both files once the body is sent."""
+    if g.pop("profile_skipped", False):
+        response.headers["X-Profile-Skipped"] = "another request is being profiled"
+        return response
+
+    profile = g.pop("profile", None)
+    if profile is None:
+        return response
+
+    profiler, sampler, started = profile
+    name = "{}_{}_{}".format(time.strftime("%Y%m%d-%H%M%S", time.localtime(started)),
+                             int((started % 1) * 1000), request.endpoint or "unknown")
+    response.headers["X-Profile-ID"] = name
+    if response.is_streamed:
+        # a streamed body (Mongo cursors serialized chunk by chunk) is produced after this hook, while the
+        # server sends it: keep profiling until the response is closed
+        response.call_on_close(lambda: save_profile(profiler, sampler, name))
+    else:
+        save_profile(profiler, sampler, name)
+    return response
+
+
+def save_profile(profiler, sampler, name):
+    """Stops the profilers and writes <name>.pstats and <name>.collapsed."""
+    try:
+        profiler.disable()
+        sampler.stop()
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(os.path.join(PROFILE_DIR, name + ".pstats"))
+        with open(os.path.join(PROFILE_DIR, name + ".collapsed"), "w", encoding="utf-8") as f:
+            for stack, count in sampler.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        prune_profiles()
+    finally:
+        _profile_lock.release()
+
+
+def abort_profile(exc=None):
+    """teardown_request hook: releases the profiler if the request failed before after_request ran."""
+    profile = g.pop("profile", None)
+    if profile is None:
+        return
+    profile[0].disable()
+    profile[1].stop()
+    _profile_lock.release()
+
+
+def prune_profiles(max_profiles=PROFILE_MAX_FILES):
+    """Deletes the oldest profiles so that at most max_profiles requests are kept in PROFILE_DIR."""
+    profiles = list_profiles()
+    for profile in profiles[max_profiles:]:
+        for file_name in profile["files"]:
+            try:
+                os.remove(os.path.join(PROFILE_DIR, file_name))
+            except FileNotFoundError:
+                pass
+
+
+def list_profiles():
+    """Returns the stored profiles, newest first, as a list of dicts."""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+
+    profiles = {}
+    for file_name in os.listdir(PROFILE_DIR):
+        name, ext = os.path.splitext(file_name)
+        if ext not in (".pstats", ".collapsed"):
+            continue
+        path = os.path.join(PROFILE_DIR, file_name)
+        entry = profiles.setdefault(name, {"id": name, "files": [], "created": os.path.getmtime(path)})
+        entry["files"].append(file_name)
+
+    return sorted(profiles.values(), key=lambda p: p["created"], reverse=True)
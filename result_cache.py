@@ -0,0 +1,115 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+from metrics import record_cache
+from shelf_changes import CHANGE_SEQUENCES, sequence_name
+
+
+#Cache of shelf search results (/search_books_in_mongo)
+#The serialized JSON of a search is kept in an LRU cache together with the shelf version it was read at.
+#The shelf version is the change counter of shelf_changes.py, which every write moves on, so a cached
+#result is used only while nothing on the shelf has changed, in this process or in any other.
+#
+#Writes move the counter a second time once they are done (bump_shelf_version): a search that ran while the
+#write was in flight was cached under the version of the stamp and is thrown away by that second step.
+#
+#The version is read from Mongo (one _id lookup) on every search. With RESULT_CACHE_VERSION_TTL > 0 it is
+#reused for that many seconds, saving the round trip but showing writes of other processes that much later.
+
+load_dotenv(".env")
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # 0 = no caching
+RESULT_CACHE_MAX_ENTRY_BYTES = int(os.getenv("RESULT_CACHE_MAX_ENTRY_BYTES", str(4 * 1024 * 1024)))
+RESULT_CACHE_VERSION_TTL = float(os.getenv("RESULT_CACHE_VERSION_TTL", "0"))  # seconds
+
+_versions = {}  # (uri, db, collection) -> (version, read at)
+_versions_lock = threading.Lock()
+
+
+def shelf_version(db, collection_name, mongo_uri=None):
+    """Current change counter of a collection (0 before the first write)."""
+    key = (mongo_uri, db.name, sequence_name(collection_name))
+    now = time.monotonic()
+    if RESULT_CACHE_VERSION_TTL > 0:
+        with _versions_lock:
+            cached = _versions.get(key)
+        if cached is not None and now - cached[1] < RESULT_CACHE_VERSION_TTL:
+            return cached[0]
+
+    counter = db[CHANGE_SEQUENCES].find_one({"_id": key[2]})
+    version = counter["seq"] if counter else 0
+    if RESULT_CACHE_VERSION_TTL > 0:
+        with _versions_lock:
+            _versions[key] = (version, now)
+    return version
+
+
+def bump_shelf_version(db, collection_name, mongo_uri=None):
+    """Called after a write has reached Mongo: cached searches of this collection are stale from now on."""
+    db[CHANGE_SEQUENCES].update_one({"_id": sequence_name(collection_name)}, {"$inc": {"seq": 1}}, upsert=True)
+    with _versions_lock:
+        _versions.pop((mongo_uri, db.name, sequence_name(collection_name)), None)
+
+
+class ResultCache:
+    """LRU cache of serialized results (bytes), bounded by their total size."""
+
+    def __init__(self, name, max_bytes=RESULT_CACHE_MAX_BYTES, max_entry_bytes=RESULT_CACHE_MAX_ENTRY_BYTES, **labels):
+        self.name = name
+        self.labels = labels  # extra metric labels
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self._entries = OrderedDict()  # key -> (version, data)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        """Returns the cached bytes if they were stored at this version, else None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] != version:
+                self._drop(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+        record_cache(self.name, entry is not None, **self.labels)
+        return entry[1] if entry is not None else None
+
+    def put(self, key, version, data):
+        if len(data) > self.max_entry_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (version, data)
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def fill(self, key, version, chunks):
+        """Passes a stream of str/bytes chunks on as bytes and caches the whole body if it stays small enough."""
+        kept = []
+        size = 0
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            if kept is not None:
+                size += len(chunk)
+                if size <= self.max_entry_bytes:
+                    kept.append(chunk)
+                else:
+                    kept = None  # too large to cache, keep streaming only
+            yield chunk
+        if kept is not None:
+            self.put(key, version, b"".join(kept))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _drop(self, key):
+        self._size -= len(self._entries.pop(key)[1])
@@ -0,0 +1,102 @@
+import argparse
+import re
+import unicodedata
+
+from pymongo import MongoClient, UpdateOne
+
+
+#Normalized search keys for German metadata
+#Titles and authors are stored a second time lower-cased and accent-folded ("Müller" -> "muller"),
+#plus word arrays that contain both the folded and the German transliterated spelling
+#("müller" -> "muller" and "mueller"). or_filter_mongo searches these fields, so "Muller",
+#"Müller" and "MUELLER" find the same book and prefix/equality searches can use an index.
+#
+#Books stored before these keys existed need one run of:   python search_keys.py
+
+KEYED_FIELDS = {
+    # stored field: (folded key, word array)
+    "Title": ("search_title", "search_title_tokens"),
+    "Authors": ("search_authors", "search_authors_tokens"),
+}
+SEARCH_KEY_FIELDS = [name for names in KEYED_FIELDS.values() for name in names]
+
+_GERMAN = str.maketrans({"ä": "ae", "ö": "oe", "ü": "ue", "ß": "ss"})
+_WORD = re.compile(r"\w+")
+
+
+def fold(text):
+    """Lower-cases and strips accents: "Müller, Straße" -> "muller, strasse"."""
+    if not isinstance(text, str):
+        return ""
+    decomposed = unicodedata.normalize("NFKD", text.casefold())  # casefold turns ß into ss
+    return " ".join("".join(c for c in decomposed if not unicodedata.combining(c)).split())
+
+
+def fold_german(text):
+    """Lower-cases and transliterates umlauts the German way: "Müller" -> "mueller"."""
+    if not isinstance(text, str):
+        return ""
+    return fold(text.lower().translate(_GERMAN))
+
+
+def tokens(text):
+    """Distinct words of a text in both spellings (accent-folded and transliterated)."""
+    words = set(_WORD.findall(fold(text))) | set(_WORD.findall(fold_german(text)))
+    return sorted(words)
+
+
+def search_keys(record):
+    """Returns the search key fields for one book record."""
+    keys = {}
+    for field, (key_field, tokens_field) in KEYED_FIELDS.items():
+        keys[key_field] = fold(record.get(field))
+        keys[tokens_field] = tokens(record.get(field))
+    return keys
+
+
+def add_search_keys(books_list):
+    """Adds the search key fields to a list of book dicts (in place) and returns it."""
+    for record in books_list:
+        record.update(search_keys(record))
+    return books_list
+
+
+def backfill_search_keys(collection, batch_size=500, only_missing=True):
+    """
+    Writes the search keys into stored books, in bulk_write batches.
+
+    :param only_missing: Skip books that already have keys (set False after changing fold()).
+    :return: Number of books updated.
+    """
+    query = {"search_title_tokens": {"$exists": False}} if only_missing else {}
+    projection = {field: 1 for field in KEYED_FIELDS}
+    updated = 0
+    batch = []
+
+    for doc in collection.find(query, projection):
+        batch.append(UpdateOne({"_id": doc["_id"]}, {"$set": search_keys(doc)}))
+        if len(batch) >= batch_size:
+            updated += collection.bulk_write(batch, ordered=False).modified_count
+            batch = []
+    if batch:
+        updated += collection.bulk_write(batch, ordered=False).modified_count
+
+    return updated
+
+
+if __name__ == "__main__":
+    from archive import archive_collection_name, ensure_live_indexes
+    from functions_flask import get_mongo_uri
+
+    parser = argparse.ArgumentParser(description="Write normalized search keys into stored books.")
+    parser.add_argument("--db", default="test")
+    parser.add_argument("--collection", default="stored_books")
+    parser.add_argument("--all", action="store_true", help="recompute the keys of every book")
+    args = parser.parse_args()
+
+    mongo_uri = get_mongo_uri()
+    with MongoClient(mongo_uri) as client:
+        db = client[args.db]
+        for name in (args.collection, archive_collection_name(args.collection)):
+            print(f"{name}: {backfill_search_keys(db[name], only_missing=not args.all)} book(s) updated.")
+        ensure_live_indexes(db[args.collection], mongo_uri)
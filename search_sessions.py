@@ -0,0 +1,128 @@
+import json
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+
+import pandas as pd
+from dotenv import load_dotenv
+
+from libraries import DEFAULT_LIBRARY
+
+
+#Search results between /search_books and /select_book
+#The rows of a Google Books search have to survive until the user selects one. They used to live in a
+#module global of flask_api, which only works with a single process and a single thread. Here every
+#search gets a search_id and its rows go into a small SQLite file that all worker processes share.
+#
+#/select_book takes the search_id; without one it uses the latest search, like the global used to,
+#so existing clients keep working. A selected search is deleted, unselected ones expire after
+#SEARCH_SESSION_TTL seconds.
+#
+#Searches belong to the library (libraries.py) they were made in: every library has its own latest
+#search, and a search_id of one library is unknown in the others.
+
+load_dotenv(".env")
+SEARCH_SESSION_DB = os.getenv("SEARCH_SESSION_DB", "search_sessions.db")
+SEARCH_SESSION_TTL = 3600
+
+
+@contextmanager
+def _connect():
+    conn = sqlite3.connect(SEARCH_SESSION_DB, timeout=30, isolation_level=None)  # autocommit, explicit BEGIN below
+    conn.row_factory = sqlite3.Row
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def init_sessions():
+    """Creates the tables if needed."""
+    with _connect() as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS searches (
+                search_id TEXT PRIMARY KEY,
+                created_at REAL NOT NULL,
+                job_id TEXT,
+                rows TEXT NOT NULL,
+                library TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS latest_search (
+                library TEXT PRIMARY KEY,
+                search_id TEXT
+            );
+            DROP TABLE IF EXISTS latest;
+        """)
+        # files from before libraries.py: their searches belong to the default library
+        columns = [column["name"] for column in conn.execute("PRAGMA table_info(searches)")]
+        if "library" not in columns:
+            conn.execute(f"ALTER TABLE searches ADD COLUMN library TEXT NOT NULL DEFAULT '{DEFAULT_LIBRARY}'")
+
+
+def _dump(books_df):
+    # orient="split" keeps the row index, which enrichment jobs refer to; NaN stays NaN (json allows it)
+    return json.dumps(books_df.to_dict(orient="split"), default=str)
+
+
+def _load(rows):
+    data = json.loads(rows)
+    return pd.DataFrame(data["data"], index=data["index"], columns=data["columns"])
+
+
+def save_search(books_df, job_id=None, library=DEFAULT_LIBRARY):
+    """Stores the rows of a search and makes it the latest one of its library. Returns its search_id."""
+    search_id = uuid.uuid4().hex
+    now = time.time()
+    with _connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM searches WHERE created_at < ?", (now - SEARCH_SESSION_TTL,))
+        conn.execute("INSERT INTO searches (search_id, created_at, job_id, rows, library) VALUES (?, ?, ?, ?, ?)",
+                     (search_id, now, job_id, _dump(books_df), library))
+        conn.execute("INSERT OR REPLACE INTO latest_search (library, search_id) VALUES (?, ?)", (library, search_id))
+        conn.execute("COMMIT")
+    return search_id
+
+
+def load_search(search_id=None, library=DEFAULT_LIBRARY):
+    """
+    Returns (search_id, books_df, job_id) of a stored search.
+
+    :param search_id: None for the latest search of the library.
+    :param library: Name of the library the search has to belong to.
+    :return: The tuple, or None if the search is unknown, expired or already selected.
+    """
+    with _connect() as conn:
+        if search_id is None:
+            latest = conn.execute("SELECT search_id FROM latest_search WHERE library = ?", (library,)).fetchone()
+            if latest is None or latest["search_id"] is None:
+                return None
+            search_id = latest["search_id"]
+        search = conn.execute("SELECT * FROM searches WHERE search_id = ? AND library = ? AND created_at >= ?",
+                              (search_id, library, time.time() - SEARCH_SESSION_TTL)).fetchone()
+    if search is None:
+        return None
+    return search_id, _load(search["rows"]), search["job_id"]
+
+
+def set_description(search_id, row_index, description):
+    """Writes one description into a stored search (used while /search_books_stream is running)."""
+    with _connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        search = conn.execute("SELECT rows FROM searches WHERE search_id = ?", (search_id,)).fetchone()
+        if search is not None:
+            books_df = _load(search["rows"])
+            books_df.loc[row_index, "description"] = description
+            conn.execute("UPDATE searches SET rows = ? WHERE search_id = ?", (_dump(books_df), search_id))
+        conn.execute("COMMIT")
+
+
+def delete_search(search_id):
+    """Deletes a search; if it was the latest, there is no latest search until the next one."""
+    with _connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM searches WHERE search_id = ?", (search_id,))
+        conn.execute("UPDATE latest_search SET search_id = NULL WHERE search_id = ?", (search_id,))
+        conn.execute("COMMIT")
@@ -0,0 +1,199 @@
+import argparse
+import heapq
+import os
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId, errors
+from dotenv import load_dotenv
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+
+from archive import ARCHIVE_SUFFIX, archive_collection_name
+from connections import mongo_client
+from search_keys import SEARCH_KEY_FIELDS
+
+
+#Change sequence for delta sync (/shelf_changes)
+#Every write to a book stamps it with change_seq (from a per-collection counter in CHANGE_SEQUENCES, so it
+#only grows), updated_at and, on insert, created_seq. A client that mirrors the shelf remembers the last
+#change_seq it saw and asks for /shelf_changes?since=<seq>, instead of downloading the whole shelf again.
+#
+#Removals are ordinary changes (book_shelf -1). Archived books keep their stamps, so /shelf_changes reads
+#the archive collection too and a removal stays visible after archiving. A bulk move gives all moved books
+#the same change_seq, pages are therefore ordered by (change_seq, _id) and continue after both.
+#
+#A change_seq is taken before the write reaches Mongo, so a slow write could show up after a higher one.
+#Pages stop at the first change younger than CHANGES_SETTLE_SECONDS to not skip over such writes.
+#
+#Books stored before the stamps existed need one run of:   python shelf_changes.py --backfill
+
+load_dotenv(".env")
+CHANGE_SEQ_FIELD = "change_seq"
+CREATED_SEQ_FIELD = "created_seq"
+UPDATED_AT_FIELD = "updated_at"
+CHANGE_SEQUENCES = "change_sequences"
+CHANGES_PAGE_SIZE = 500
+CHANGES_MAX_PAGE_SIZE = 5000
+CHANGES_SETTLE_SECONDS = float(os.getenv("CHANGES_SETTLE_SECONDS", "2"))
+
+_indexed = set()  # (uri, db, collection) that already got the change index in this process
+
+
+def sequence_name(collection_name):
+    """Archive collections share the sequence of their live collection."""
+    if collection_name.endswith(ARCHIVE_SUFFIX):
+        return collection_name[:-len(ARCHIVE_SUFFIX)]
+    return collection_name
+
+
+def reserve_change_seqs(db, collection_name, count=1):
+    """Reserves count consecutive change_seq values and returns the first one."""
+    counter = db[CHANGE_SEQUENCES].find_one_and_update(
+        {"_id": sequence_name(collection_name)}, {"$inc": {"seq": count}},
+        upsert=True, return_document=ReturnDocument.AFTER,
+    )
+    return counter["seq"] - count + 1
+
+
+def change_stamp(db, collection_name):
+    """Fields to $set on an update: one new change_seq and the current time."""
+    return {CHANGE_SEQ_FIELD: reserve_change_seqs(db, collection_name),
+            UPDATED_AT_FIELD: datetime.now(timezone.utc)}
+
+
+def stamp_new_books(db, collection_name, books_list):
+    """Stamps book dicts before insert_many (in place), one change_seq per book."""
+    if not books_list:
+        return books_list
+    first = reserve_change_seqs(db, collection_name, len(books_list))
+    now = datetime.now(timezone.utc)
+    for seq, record in enumerate(books_list, start=first):
+        record[CHANGE_SEQ_FIELD] = seq
+        record[CREATED_SEQ_FIELD] = seq
+        record[UPDATED_AT_FIELD] = now
+    return books_list
+
+
+def ensure_change_index(collection, mongo_uri=None):
+    """Creates the (change_seq, _id) index /shelf_changes pages over, once per process."""
+    key = (mongo_uri, collection.database.name, collection.name)
+    if key in _indexed:
+        return
+    collection.create_index([(CHANGE_SEQ_FIELD, 1), ("_id", 1)], name=CHANGE_SEQ_FIELD)
+    _indexed.add(key)
+
+
+def _as_utc(value):
+    # pymongo returns naive datetimes (in UTC) unless the client is tz_aware
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+
+def _json_ready(doc):
+    doc["_id"] = str(doc["_id"])
+    for field, value in doc.items():
+        if isinstance(value, datetime):
+            doc[field] = _as_utc(value).isoformat()
+    return doc
+
+
+def list_changes(mongo_uri=None, db_name="test", collection_name="stored_books", since=0, after_id=None,
+                 limit=CHANGES_PAGE_SIZE):
+    """
+    Returns one page of the books changed after a point of the change sequence.
+
+    :param since: Last change_seq the client has seen (0 = everything).
+    :param after_id: _id of the last book of the previous page, if that page ended inside a bulk change.
+    :param limit: Page size (at most CHANGES_MAX_PAGE_SIZE).
+    :return: Dict with "changes" (op insert/update/remove and the book), the "since"/"after_id" to ask
+             for next and "has_more".
+    """
+    try:
+        since = int(since)
+        limit = max(1, min(int(limit), CHANGES_MAX_PAGE_SIZE))
+    except (TypeError, ValueError):
+        raise ValueError("since and limit must be numbers")
+    query = {CHANGE_SEQ_FIELD: {"$gt": since}}
+    if after_id is not None:
+        try:
+            after_id = ObjectId(after_id)
+        except (errors.InvalidId, TypeError):
+            raise ValueError("after_id is not a valid id")
+        query = {"$or": [query, {CHANGE_SEQ_FIELD: since, "_id": {"$gt": after_id}}]}
+
+    settled_before = datetime.now(timezone.utc) - timedelta(seconds=CHANGES_SETTLE_SECONDS)
+    projection = {field: 0 for field in SEARCH_KEY_FIELDS}
+    sort = [(CHANGE_SEQ_FIELD, 1), ("_id", 1)]
+
+    with mongo_client(mongo_uri) as client:
+        db = client[db_name]
+        cursors = []
+        for name in (collection_name, archive_collection_name(collection_name)):
+            ensure_change_index(db[name], mongo_uri)
+            cursors.append(db[name].find(query, projection).sort(sort).limit(limit + 1))
+        merged = heapq.merge(*cursors, key=lambda doc: (doc[CHANGE_SEQ_FIELD], doc["_id"]))
+
+        changes = []
+        has_more = False
+        for doc in merged:
+            if len(changes) == limit or _as_utc(doc[UPDATED_AT_FIELD]) > settled_before:
+                has_more = True
+                break
+            if doc.get("book_shelf") == -1:
+                op = "remove"
+            elif doc.get(CREATED_SEQ_FIELD, 0) > since:
+                op = "insert"
+            else:
+                op = "update"
+            changes.append({"op": op, "change_seq": doc[CHANGE_SEQ_FIELD], "book": doc})
+
+    if changes:
+        since = changes[-1]["change_seq"]
+        after_id = changes[-1]["book"]["_id"]
+    return {
+        "changes": [{**change, "book": _json_ready(change["book"])} for change in changes],
+        "since": since,
+        "after_id": str(after_id) if after_id is not None else None,
+        "has_more": has_more,
+    }
+
+
+def backfill_change_seqs(db, collection_name, batch_size=500):
+    """
+    Stamps stored books that have no change_seq yet (in bulk_write batches), so a sync from 0 sees them.
+
+    :return: Number of books stamped.
+    """
+    collection = db[collection_name]
+    updated = 0
+    while True:
+        ids = [doc["_id"] for doc in collection.find({CHANGE_SEQ_FIELD: {"$exists": False}}, {"_id": 1}).limit(batch_size)]
+        if not ids:
+            break
+        first = reserve_change_seqs(db, collection_name, len(ids))
+        now = datetime.now(timezone.utc)
+        batch = [UpdateOne({"_id": _id}, {"$set": {CHANGE_SEQ_FIELD: seq, CREATED_SEQ_FIELD: seq, UPDATED_AT_FIELD: now}})
+                 for seq, _id in enumerate(ids, start=first)]
+        updated += collection.bulk_write(batch, ordered=False).modified_count
+    return updated
+
+
+if __name__ == "__main__":
+    import json
+
+    from functions_flask import get_mongo_uri
+
+    parser = argparse.ArgumentParser(description="Stamp stored books for /shelf_changes, or list changes.")
+    parser.add_argument("--backfill", action="store_true", help="stamp books that have no change_seq yet")
+    parser.add_argument("--since", type=int, default=None, help="print the changes after this change_seq")
+    parser.add_argument("--db", default="test")
+    parser.add_argument("--collection", default="stored_books")
+    args = parser.parse_args()
+
+    mongo_uri = get_mongo_uri()
+    if args.backfill:
+        with MongoClient(mongo_uri) as client:
+            db = client[args.db]
+            for name in (args.collection, archive_collection_name(args.collection)):
+                print(f"{name}: {backfill_change_seqs(db, name)} book(s) stamped.")
+                ensure_change_index(db[name], mongo_uri)
+    if args.since is not None:
+        print(json.dumps(list_changes(mongo_uri, args.db, args.collection, since=args.since), indent=4))
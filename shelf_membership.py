@@ -0,0 +1,215 @@
+import hashlib
+import math
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from dotenv import load_dotenv
+from pymongo.errors import PyMongoError
+
+from archive import archive_collection_name, ensure_archive_indexes
+from connections import mongo_client
+from isbn import CANONICAL_FIELD
+from result_cache import shelf_version
+from shelf_changes import CHANGE_SEQ_FIELD, CHANGES_SETTLE_SECONDS, UPDATED_AT_FIELD
+
+
+#Shelf membership of search results
+#Every Google Books row of /search_books gets shelf_status ("on_shelf", "removed", "archived" or "new"),
+#stored_shelf and the _id of the stored book, the same columns as a hybrid search. All rows are looked up
+#with one $in query on the identifiers (canonical ISBN, ISBN_13, ISBN_10, Google volume ID) of the live
+#collection; only rows that are not found there are looked up in the archive, with a second query.
+#When Mongo cannot be reached the rows get shelf_status "unknown", the Google results are still returned.
+#
+#With SHELF_BLOOM=1 a Bloom filter of all stored identifiers sits in front: rows it has never seen are "new"
+#without being looked up. The filter is built once per process and then follows the writes of every process
+#through change_seq (see shelf_changes.py). To know whether there are new writes it reads the shelf version
+#(one _id lookup) on every search, so a search of only new books still does that one query, unless
+#RESULT_CACHE_VERSION_TTL > 0 keeps the version cached (see result_cache.py).
+#Bloom filters have false positives (those rows are simply looked up) but no false negatives.
+
+load_dotenv(".env")
+SHELF_BLOOM = os.getenv("SHELF_BLOOM", "0").lower() in ("1", "true", "yes")
+SHELF_BLOOM_CAPACITY = int(os.getenv("SHELF_BLOOM_CAPACITY", "100000"))  # identifiers, grows when exceeded
+SHELF_BLOOM_ERROR_RATE = 0.01
+
+MEMBERSHIP_FIELDS = [CANONICAL_FIELD, "ISBN_13", "ISBN_10", "ID"]
+MEMBERSHIP_COLUMNS = ["_id", "shelf_status", "stored_shelf"]
+
+
+class BloomFilter:
+    """Set of strings with false positives (about error_rate) but no false negatives."""
+
+    def __init__(self, capacity, error_rate=SHELF_BLOOM_ERROR_RATE):
+        self.capacity = capacity
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))  # bits
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+def _keys(record):
+    """Identifiers of a book or a search row, prefixed with the field (a volume ID is not an ISBN)."""
+    keys = []
+    for field in MEMBERSHIP_FIELDS:
+        value = record.get(field)
+        if isinstance(value, str) and value:
+            keys.append(f"{field}:{value}")
+    return keys
+
+
+class _StoredIdentifiers:
+    """The Bloom filter of one collection and how far it has followed the change sequence."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bloom = None
+        self.version = None   # shelf version at the last refresh
+        self.safe_seq = 0     # every book up to this change_seq is in the filter
+        self.unsettled = False
+
+    def _add_books(self, cursor):
+        # books written less than CHANGES_SETTLE_SECONDS ago are read again next time, a slower write with a
+        # lower change_seq might still land (same reasoning as /shelf_changes)
+        settled_before = datetime.now(timezone.utc) - timedelta(seconds=CHANGES_SETTLE_SECONDS)
+        unsettled_seqs = []
+        for doc in cursor:
+            for key in _keys(doc):
+                self.bloom.add(key)
+            seq = doc.get(CHANGE_SEQ_FIELD)
+            if seq is None:
+                continue
+            updated_at = doc.get(UPDATED_AT_FIELD)
+            if updated_at is not None and updated_at.replace(tzinfo=updated_at.tzinfo or timezone.utc) > settled_before:
+                unsettled_seqs.append(seq)
+            else:
+                self.safe_seq = max(self.safe_seq, seq)
+        if unsettled_seqs:
+            self.safe_seq = min(self.safe_seq, min(unsettled_seqs) - 1)
+        self.unsettled = bool(unsettled_seqs)
+
+    def refresh(self, db, collection_name, mongo_uri):
+        """Reads the shelf version (cached for RESULT_CACHE_VERSION_TTL), then the books changed since the last one."""
+        projection = {field: 1 for field in MEMBERSHIP_FIELDS + [CHANGE_SEQ_FIELD, UPDATED_AT_FIELD]}
+        version = shelf_version(db, collection_name, mongo_uri)
+        with self.lock:
+            if self.bloom is not None and self.bloom.count > self.bloom.capacity:
+                self.bloom = None  # full, rebuild with twice the capacity
+            if self.bloom is None:
+                capacity = max(SHELF_BLOOM_CAPACITY, 2 * db[collection_name].estimated_document_count())
+                self.bloom = BloomFilter(capacity)
+                self.safe_seq = 0
+                for name in (collection_name, archive_collection_name(collection_name)):
+                    self._add_books(db[name].find({}, projection))
+            elif version != self.version or self.unsettled:
+                # archived books were in the live collection when they got their change_seq
+                self._add_books(db[collection_name].find({CHANGE_SEQ_FIELD: {"$gt": self.safe_seq}}, projection))
+            self.version = version
+            return self.bloom
+
+
+_stored = {}  # (uri, db, collection) -> _StoredIdentifiers
+_stored_lock = threading.Lock()
+
+
+def stored_identifiers(db, collection_name, mongo_uri=None):
+    """The up to date Bloom filter of the identifiers stored in a collection (and its archive)."""
+    key = (mongo_uri, db.name, collection_name)
+    with _stored_lock:
+        stored = _stored.get(key)
+        if stored is None:
+            stored = _stored[key] = _StoredIdentifiers()
+    return stored.refresh(db, collection_name, mongo_uri)
+
+
+def _in_query(rows_keys):
+    values = {field: set() for field in MEMBERSHIP_FIELDS}
+    for keys in rows_keys:
+        for key in keys:
+            field, _, value = key.partition(":")
+            values[field].add(value)
+    return [{field: {"$in": sorted(found)}} for field, found in values.items() if found]
+
+
+def _find_stored(rows_keys, mongo_uri, db_name, collection_name):
+    """Looks the identifier keys of the rows up, returns {identifier key: (stored doc, shelf_status)}."""
+    found = {}
+    with mongo_client(mongo_uri) as client:
+        db = client[db_name]
+        candidates = [keys for keys in rows_keys if keys]
+        if SHELF_BLOOM and candidates:
+            bloom = stored_identifiers(db, collection_name, mongo_uri)
+            candidates = [keys for keys in candidates if any(key in bloom for key in keys)]
+
+        branches = _in_query(candidates)
+        if branches:
+            projection = {field: 1 for field in MEMBERSHIP_FIELDS + ["book_shelf"]}
+            # each branch names the shelf condition itself, so the partial indexes of archive.py can be used
+            live_query = {"$or": [{**branch, "book_shelf": {"$gt": -1}} for branch in branches]
+                          + [{"book_shelf": -1, "$or": branches}]}
+            for doc in db[collection_name].find(live_query, projection):
+                status = "removed" if doc.get("book_shelf") == -1 else "on_shelf"
+                for key in _keys(doc):
+                    # a book on a shelf wins over a removed copy of it
+                    if key not in found or status == "on_shelf":
+                        found[key] = (doc, status)
+
+            missing = [keys for keys in candidates if not any(key in found for key in keys)]
+            branches = _in_query(missing)
+            if branches:
+                archive = db[archive_collection_name(collection_name)]
+                ensure_archive_indexes(archive, mongo_uri)
+                for doc in archive.find({"$or": branches}, projection):
+                    for key in _keys(doc):
+                        found.setdefault(key, (doc, "archived"))
+    return found
+
+
+def annotate_shelf_membership(books_df, mongo_uri=None, db_name="test", collection_name="stored_books"):
+    """
+    Adds the MEMBERSHIP_COLUMNS to the rows of a search (in place) and returns the DataFrame.
+    If Mongo cannot be reached the search still answers, with shelf_status "unknown" for every row.
+
+    :param books_df: DataFrame from json_to_dataframe.
+    """
+    if books_df.empty:
+        return books_df
+    rows_keys = [_keys(row) for row in books_df.to_dict(orient="records")]
+    try:
+        found = _find_stored(rows_keys, mongo_uri, db_name, collection_name)
+        unmatched = "new"
+    except PyMongoError as e:
+        print(f"Shelf membership lookup failed: {e}")
+        found, unmatched = {}, "unknown"
+
+    columns = {column: [] for column in MEMBERSHIP_COLUMNS}
+    for keys in rows_keys:
+        match = next((found[key] for key in keys if key in found), None)
+        if match is None:
+            columns["_id"].append(np.nan)
+            columns["shelf_status"].append(unmatched)
+            columns["stored_shelf"].append(np.nan)
+        else:
+            doc, status = match
+            columns["_id"].append(str(doc["_id"]))
+            columns["shelf_status"].append(status)
+            columns["stored_shelf"].append(doc.get("book_shelf", np.nan))
+    for column, values in columns.items():
+        books_df[column] = values
+    return books_df
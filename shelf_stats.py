@@ -0,0 +1,169 @@
+import math
+import os
+
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+
+from archive import archive_collection_name
+from connections import mongo_client
+
+
+#Shelf statistics without shipping the collection to the client
+#compute_shelf_stats runs one $facet aggregation on the server.
+#With SHELF_STATS_COUNTERS=1 place/remove also keep counters up to date in the "shelf_stats"
+#collection (one small document per counted value), so /shelf_stats reads those instead.
+#
+#Language, Category and Author are counted for placed books only, removed books (book_shelf -1)
+#show up in by_shelf["-1"] and in "removed", including those already moved to the archive.
+
+load_dotenv(".env")
+SHELF_STATS_COUNTERS = os.getenv("SHELF_STATS_COUNTERS", "0").lower() in ("1", "true", "yes")
+STATS_COLLECTION = "shelf_stats"
+
+_FIELDS = {"book_shelf": "by_shelf", "Language": "by_language", "Category": "by_category", "Author": "by_author"}
+
+
+def _is_removed(book_shelf):
+    return str(book_shelf) == "-1"
+
+
+def _valid_pages(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and not math.isnan(value) and value >= 0
+
+
+def _split(value):
+    """Authors and Category are stored as ", "-joined strings by json_to_dataframe."""
+    return [part for part in value.split(", ") if part] if isinstance(value, str) else []
+
+
+def _stat_keys(doc):
+    """Returns the (field, value) pairs a single book contributes to."""
+    removed = _is_removed(doc.get("book_shelf"))
+    keys = [("book_shelf", str(doc.get("book_shelf"))), ("status", "removed" if removed else "placed")]
+    if not removed:
+        if isinstance(doc.get("Language"), str):
+            keys.append(("Language", doc["Language"]))
+        keys += [("Category", category) for category in _split(doc.get("Category"))]
+        keys += [("Author", author) for author in _split(doc.get("Authors"))]
+    return keys
+
+
+def counter_updates(docs, sign=1):
+    """Builds the $inc upserts that add (sign=1) or subtract (sign=-1) the given books from the counters."""
+    updates = []
+    for doc in docs:
+        pages = doc.get("Page Count") if _valid_pages(doc.get("Page Count")) else 0
+        for field, value in _stat_keys(doc):
+            inc = {"count": sign}
+            if field == "status":
+                inc["pages"] = sign * pages
+            updates.append(UpdateOne({"_id": {"field": field, "value": value}}, {"$inc": inc}, upsert=True))
+    return updates
+
+
+def apply_counter_updates(db, updates):
+    """Writes counter updates in one bulk_write, if counters are enabled."""
+    if SHELF_STATS_COUNTERS and updates:
+        db[STATS_COLLECTION].bulk_write(updates, ordered=False)
+
+
+def _empty_stats():
+    stats = {"total": 0, "placed": 0, "removed": 0, "total_pages": 0}
+    stats.update({name: {} for name in _FIELDS.values()})
+    return stats
+
+
+def _split_expr(field):
+    return {"$cond": [{"$eq": [{"$type": f"${field}"}, "string"]}, {"$split": [f"${field}", ", "]}, []]}
+
+
+def _group_count(key_expr, top=None, unwind=False):
+    stages = [{"$match": {"book_shelf": {"$nin": [-1, "-1"]}}}]
+    if unwind:
+        stages += [{"$project": {"key": key_expr}}, {"$unwind": "$key"}, {"$match": {"key": {"$ne": ""}}}]
+        key_expr = "$key"
+    stages += [{"$group": {"_id": key_expr, "count": {"$sum": 1}}}, {"$sort": {"count": -1}}]
+    if top:
+        stages.append({"$limit": int(top)})
+    return stages
+
+
+def compute_shelf_stats(mongo_uri=None, db_name="test", collection_name="stored_books", top=50):
+    """
+    Computes the shelf statistics with a single server-side aggregation.
+
+    :param top: Maximum number of categories and authors returned (most frequent first).
+    :return: Dict with total/placed/removed counts, total_pages of placed books and by_* histograms.
+    """
+    pages = {"$cond": [{"$and": [{"$isNumber": "$Page Count"}, {"$gte": ["$Page Count", 0]}]}, "$Page Count", 0]}
+    pipeline = [{"$facet": {
+        "by_shelf": [{"$group": {"_id": {"$toString": "$book_shelf"}, "count": {"$sum": 1}}}],
+        "status": [{"$group": {
+            "_id": {"$cond": [{"$in": ["$book_shelf", [-1, "-1"]]}, "removed", "placed"]},
+            "count": {"$sum": 1},
+            "pages": {"$sum": pages},
+        }}],
+        "by_language": _group_count({"$cond": [{"$eq": [{"$type": "$Language"}, "string"]}, "$Language", None]}),
+        "by_category": _group_count(_split_expr("Category"), top, unwind=True),
+        "by_author": _group_count(_split_expr("Authors"), top, unwind=True),
+    }}]
+
+    with mongo_client(mongo_uri) as client:
+        db = client[db_name]
+        facets = next(db[collection_name].aggregate(pipeline), {})
+        archived = db[archive_collection_name(collection_name)].estimated_document_count()
+
+    stats = _empty_stats()
+    for row in facets.get("status", []):
+        stats[row["_id"]] = row["count"]
+        if row["_id"] == "placed":
+            stats["total_pages"] = row["pages"]
+    for name in _FIELDS.values():
+        stats[name] = {str(row["_id"]): row["count"] for row in facets.get(name, []) if row["_id"] is not None}
+
+    if archived:
+        stats["removed"] += archived
+        stats["by_shelf"]["-1"] = stats["by_shelf"].get("-1", 0) + archived
+    stats["total"] = stats["placed"] + stats["removed"]
+    return stats
+
+
+def read_shelf_counters(mongo_uri=None, db_name="test", top=50):
+    """Reads the incrementally maintained counters; the cost does not depend on the number of books."""
+    with mongo_client(mongo_uri) as client:
+        counters = list(client[db_name][STATS_COLLECTION].find({"count": {"$gt": 0}}))
+
+    stats = _empty_stats()
+    for counter in counters:
+        field, value = counter["_id"]["field"], counter["_id"]["value"]
+        if field == "status":
+            stats[value] = counter["count"]
+            if value == "placed":
+                stats["total_pages"] = counter.get("pages", 0)
+        else:
+            stats[_FIELDS[field]][value] = counter["count"]
+    stats["total"] = stats["placed"] + stats["removed"]
+
+    for name in ("by_category", "by_author"):
+        ranked = sorted(stats[name].items(), key=lambda item: item[1], reverse=True)
+        stats[name] = dict(ranked[:top] if top else ranked)
+    return stats
+
+
+def rebuild_shelf_counters(mongo_uri=None, db_name="test", collection_name="stored_books"):
+    """Recomputes all counters from the stored books, e.g. after enabling SHELF_STATS_COUNTERS."""
+    projection = {"book_shelf": 1, "Language": 1, "Category": 1, "Authors": 1, "Page Count": 1}
+    with mongo_client(mongo_uri) as client:
+        db = client[db_name]
+        updates = counter_updates(db[collection_name].find({}, projection))
+        updates += counter_updates(db[archive_collection_name(collection_name)].find({}, projection))
+        db[STATS_COLLECTION].delete_many({})
+        if updates:
+            db[STATS_COLLECTION].bulk_write(updates, ordered=False)
+    return len(updates)
+
+
+if __name__ == "__main__":
+    from functions_flask import get_mongo_uri
+
+    print(f"{rebuild_shelf_counters(get_mongo_uri())} counter updates written.")
@@ -0,0 +1,57 @@
+import threading
+
+import metrics
+
+
+#Request coalescing ("single flight")
+#If several threads ask for the same thing at the same time (a class searching the same title), only the
+#first one calls upstream; the others wait for that call and get the same result (or the same exception).
+#Nothing is kept once the call is done, so this only limits concurrent duplicates, caching is separate.
+#
+#Shared results are the same object for every caller, callers must not modify them.
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """One group of coalesced calls, e.g. all Google Books searches."""
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> _Call in flight
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Returns fn(*args, **kwargs), sharing the call with concurrent callers that use the same key.
+
+        :param key: Hashable identity of the call (normalize it, e.g. lower-case query, canonical ISBN).
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            metrics.inc("gb4f_singleflight_shared_total", group=self.name)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
@@ -0,0 +1,96 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+import pymongo
+
+
+#Test setup
+#The app is imported once with an in-memory Mongo (mongomock) and its SQLite files in a temporary
+#directory. Google Books and Open Library are answered by fake_get, so no test touches the network.
+#    pip install pytest mongomock
+#    python -m pytest -q
+
+_tmp = tempfile.mkdtemp(prefix="gb4f-tests-")
+os.environ.update({
+    "MONGO_URI": "mongodb://localhost:27017/",
+    "LIBRARIES": "nord=gb4f_nord",
+    "SEARCH_SESSION_DB": os.path.join(_tmp, "search_sessions.db"),
+    "ENRICHMENT_DB": os.path.join(_tmp, "enrichment_jobs.db"),
+    "ENRICHMENT_WORKERS": "0",
+    "SHELF_STATS_COUNTERS": "1",  # mongomock cannot run the $type of the /shelf_stats aggregation
+    "METRICS_ENABLED": "1",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_mongo = mongomock.MongoClient()
+pymongo.MongoClient = lambda *args, **kwargs: _mongo  # before connections.py imports it
+
+import flask_api  # noqa: E402
+import functions_flask  # noqa: E402
+import fuzzy_search  # noqa: E402
+import shelf_membership  # noqa: E402
+
+GOOGLE_BOOKS = {"items": [
+    {"id": "a", "volumeInfo": {"title": "Momo", "authors": ["Michael Ende"], "language": "de",
+                               "industryIdentifiers": [{"type": "ISBN_13", "identifier": "9783522202602"},
+                                                       {"type": "ISBN_10", "identifier": "3522202600"}]}},
+    {"id": "b", "volumeInfo": {"title": "Die unendliche Geschichte", "authors": ["Michael Ende"],
+                               "industryIdentifiers": [{"type": "ISBN_13", "identifier": "9783522202107"}]}},
+]}
+
+
+class FakeResponse:
+    status_code = 200
+    headers = {}
+
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def fake_apis(monkeypatch):
+    """Answers Google Books with GOOGLE_BOOKS and Open Library with "desc <isbn>". Yields the called URLs."""
+    calls = []
+
+    def fake_get(url, params=None, **kwargs):
+        calls.append((url, params))
+        if "googleapis" in url:
+            return FakeResponse(GOOGLE_BOOKS)
+        isbn = url.split("ISBN:")[1].split("&")[0]
+        return FakeResponse({f"ISBN:{isbn}": {"details": {"description": f"desc {isbn}"}}})
+
+    monkeypatch.setattr("requests.get", fake_get)
+    monkeypatch.setattr("requests.Session.get", lambda self, url, **kwargs: fake_get(url, **kwargs))
+    yield calls
+
+
+@pytest.fixture(autouse=True)
+def empty_mongo():
+    """Every test starts with empty databases and caches."""
+    for db_name in _mongo.list_database_names():
+        _mongo.drop_database(db_name)
+    functions_flask._shelf_search_caches.clear()
+    fuzzy_search._indexes.clear()
+    shelf_membership._stored.clear()
+    yield
+
+
+@pytest.fixture
+def client():
+    return flask_api.app.test_client()
+
+
+@pytest.fixture
+def mongo():
+    """The shared in-memory client (emptied before every test by empty_mongo)."""
+    return _mongo
@@ -0,0 +1,67 @@
+import zlib
+
+import pytest
+from flask import Flask, Response
+
+import compression
+
+PAYLOAD = [("line %d of a streamed shelf export\n" % n).encode() for n in range(500)]
+
+
+def decompress(data, encoding):
+    if encoding == "br":
+        return compression.brotli.decompress(data)
+    return zlib.decompress(data, 31)
+
+
+def encodings():
+    return ["gzip"] + (["br"] if compression.brotli is not None else [])
+
+
+@pytest.mark.parametrize("encoding", encodings())
+def test_compress_chunks_round_trip(encoding):
+    closed = []
+
+    class Source(list):
+        def close(self):
+            closed.append(True)
+
+    output = list(compression.compress_chunks(iter(PAYLOAD), encoding, Source()))
+    assert decompress(b"".join(output), encoding) == b"".join(PAYLOAD)
+    assert closed == [True]
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    app.after_request(compression.compress_response)
+
+    @app.route("/stream")
+    def stream():
+        return Response((chunk for chunk in PAYLOAD), mimetype="text/csv")
+
+    @app.route("/short")
+    def short():
+        return Response((chunk for chunk in PAYLOAD[:2]), mimetype="text/csv")
+
+    return app.test_client()
+
+
+@pytest.mark.parametrize("encoding", encodings())
+def test_streamed_response_round_trip(client, encoding):
+    response = client.get("/stream", headers={"Accept-Encoding": encoding})
+    assert response.headers["Content-Encoding"] == encoding
+    assert "Content-Length" not in response.headers
+    assert decompress(response.get_data(), encoding) == b"".join(PAYLOAD)
+
+
+def test_short_stream_is_sent_uncompressed(client):
+    response = client.get("/short", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
+    assert response.get_data() == b"".join(PAYLOAD[:2])
+
+
+def test_identity_when_nothing_is_accepted(client):
+    response = client.get("/stream", headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in response.headers
+    assert response.get_data() == b"".join(PAYLOAD)
@@ -0,0 +1,19 @@
+import enrichment_queue
+
+
+def test_backfill_skips_books_without_isbn(mongo):
+    mongo["test"]["stored_books"].insert_many([
+        {"Title": "Momo", "ISBN_13": "9783522202602"},
+        {"Title": "Only ISBN-10", "ISBN_13": "", "ISBN_10": "3522202600"},
+        {"Title": "Empty", "ISBN_13": "", "ISBN_10": ""},
+        {"Title": "Missing", "ISBN_13": None},
+        {"Title": "Described", "ISBN_13": "9783522202107", "description": "known"},
+    ])
+    job = enrichment_queue.get_job(enrichment_queue.enqueue_backfill_job(None))
+    assert (job["kind"], job["status"], job["tasks_total"]) == ("backfill", "pending", 2)
+
+
+def test_backfill_without_candidates_is_done_at_once(mongo):
+    mongo["test"]["stored_books"].insert_one({"Title": "Empty", "ISBN_13": "", "ISBN_10": ""})
+    job = enrichment_queue.get_job(enrichment_queue.enqueue_backfill_job(None))
+    assert (job["status"], job["tasks_total"]) == ("done", 0)
@@ -0,0 +1,54 @@
+import csv
+import gzip
+import io
+from datetime import datetime, timezone
+
+import pytest
+
+from book_schema import BOOK_SCHEMA
+from export_shelf import export_chunks
+
+
+@pytest.fixture
+def shelf(mongo):
+    mongo["test"]["stored_books"].insert_many([
+        {"Title": "Momo", "book_shelf": 1, "Page Count": 300.0, "ISBN_13": "9783522202602"},
+        {"Title": "Ende", "book_shelf": "2", "Page Count": float("nan"), "Authors": "Michael Ende"},  # old types
+        {"Title": "Weg", "book_shelf": -1, "removed_at": datetime(2024, 5, 1, 12, 0)},
+        {"Title": "Rose", "book_shelf": 3, "Page Count": "many"},
+    ])
+    return mongo
+
+
+def test_arrow_export_has_the_fixed_schema(shelf):
+    pa = pytest.importorskip("pyarrow")
+    data = b"".join(export_chunks("arrow", include_removed=True, batch_size=2))
+    table = pa.ipc.open_file(pa.BufferReader(data)).read_all()
+
+    assert table.column_names == list(BOOK_SCHEMA)
+    assert table.schema.field("book_shelf").type == pa.int64()
+    assert table.schema.field("Page Count").type == pa.int64()
+    assert table.schema.field("Title").type == pa.string()
+    assert table.schema.field("removed_at").type == pa.timestamp("us", tz="UTC")
+    rows = {row["Title"]: row for row in table.to_pylist()}
+    assert rows["Ende"]["book_shelf"] == 2 and rows["Ende"]["Page Count"] is None
+    assert rows["Momo"]["Page Count"] == 300
+    assert rows["Rose"]["Page Count"] is None
+    assert rows["Weg"]["removed_at"] == datetime(2024, 5, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def test_csv_export(shelf):
+    live = list(csv.DictReader(io.StringIO(b"".join(export_chunks("csv", batch_size=2)).decode("utf-8"))))
+    assert list(live[0]) == list(BOOK_SCHEMA)
+    assert sorted(row["Title"] for row in live) == ["Momo", "Rose"]  # a string shelf is not > -1 in Mongo
+
+    removed = gzip.decompress(b"".join(export_chunks("csv", book_shelf=-1, compression="gzip"))).decode("utf-8")
+    row = next(csv.DictReader(io.StringIO(removed)))
+    assert (row["Title"], row["removed_at"]) == ("Weg", "2024-05-01T12:00:00+00:00")
+
+
+def test_unknown_format_or_compression():
+    with pytest.raises(ValueError):
+        export_chunks("xlsx")
+    with pytest.raises(ValueError):
+        export_chunks("csv", compression="zstd")
@@ -0,0 +1,37 @@
+from fuzzy_search import BKTree, FuzzyIndex, levenshtein
+
+
+def test_levenshtein():
+    assert levenshtein("ende", "ende") == 0
+    assert levenshtein("mihael", "michael") == 1
+    assert levenshtein("kitten", "sitting") == 3
+    assert levenshtein("kitten", "sitting", max_distance=1) == 2  # stops early, anything above the limit
+
+
+def test_bk_tree_finds_every_word_within_the_distance():
+    words = ["ende", "enden", "ente", "momo", "michael", "mihail", "geschichte"]
+    tree = BKTree()
+    for word in words + ["ende"]:
+        tree.add(word)
+    assert tree.size == len(words)
+    for query in ("ende", "mihael", "momo", "x"):
+        for max_distance in (0, 1, 2):
+            expected = {(word, levenshtein(query, word)) for word in words if levenshtein(query, word) <= max_distance}
+            assert set(tree.search(query, max_distance)) == expected
+
+
+def test_fuzzy_index_ranks_closer_matches_first():
+    index = FuzzyIndex()
+    index.add_books([
+        {"_id": 1, "Title": "Momo", "Authors": "Michael Ende", "book_shelf": 1},
+        {"_id": 2, "Title": "Die unendliche Geschichte", "Authors": "Michael Ende", "book_shelf": 1},
+        {"_id": 3, "Title": "Der Name der Rose", "Authors": "Umberto Eco", "book_shelf": 2},
+        {"_id": 4, "Title": "Mama", "Authors": "Mihail Bulgakov", "book_shelf": -1},  # removed, not indexed
+    ])
+    results = index.search("Mihael Ende", fields=("authors",))
+    assert {book["_id"] for book in results} == {"1", "2"}
+    assert results[0]["matched"] == {"mihael": "michael", "ende": "ende"}
+    assert results[0]["score"] < 1
+
+    assert [book["_id"] for book in index.search("Momo", fields=("title",))] == ["1"]
+    assert index.search("Bulgakov") == []
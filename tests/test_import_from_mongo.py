@@ -0,0 +1,36 @@
+from datetime import datetime
+
+import pandas as pd
+
+from book_schema import BOOK_SCHEMA
+from functions_flask import import_from_mongo_columnar
+
+
+def test_columns_get_the_schema_dtypes(mongo):
+    mongo["test"]["stored_books"].insert_many([
+        {"Title": "Momo", "book_shelf": 1, "Page Count": 300.0, "ISBN_13": "9783522202602"},
+        {"Title": "Ende", "book_shelf": "2", "Page Count": float("nan"), "Authors": "Michael Ende"},  # old types
+        {"Title": "Weg", "book_shelf": -1, "removed_at": datetime(2024, 5, 1, 12, 0)},
+    ])
+    books_df = import_from_mongo_columnar(batch_size=2)
+
+    assert list(books_df.columns) == list(BOOK_SCHEMA)
+    assert str(books_df["book_shelf"].dtype) == "Int64"
+    assert str(books_df["Page Count"].dtype) == "Int64"
+    assert books_df["Title"].dtype == object
+    assert str(books_df["removed_at"].dtype) == "datetime64[us, UTC]"
+
+    assert books_df["book_shelf"].tolist() == [1, 2, -1]
+    assert books_df["Page Count"].tolist() == [300, pd.NA, pd.NA]
+    assert books_df["Authors"].tolist() == [None, "Michael Ende", None]
+    assert books_df["removed_at"].iloc[2] == pd.Timestamp("2024-05-01T12:00:00Z")
+    assert books_df["removed_at"].iloc[:2].isna().all()
+
+
+def test_empty_result_keeps_the_columns_and_dtypes(mongo):
+    books_df = import_from_mongo_columnar(query={"book_shelf": 5}, columns=["Title", "book_shelf", "removed_at"])
+
+    assert books_df.empty
+    assert list(books_df.columns) == ["Title", "book_shelf", "removed_at"]
+    assert str(books_df["book_shelf"].dtype) == "Int64"
+    assert str(books_df["removed_at"].dtype) == "datetime64[us, UTC]"
@@ -0,0 +1,38 @@
+from isbn import (canonical_isbn, clean_isbn, is_valid_isbn10, is_valid_isbn13, isbn10_check_digit,
+                  isbn13_check_digit, record_canonical_isbn)
+
+
+def test_check_digits():
+    assert isbn10_check_digit("352220260") == "0"
+    assert isbn10_check_digit("080442957") == "X"
+    assert isbn13_check_digit("978352220260") == "2"
+    assert is_valid_isbn10("080442957X")
+    assert not is_valid_isbn10("3522202601")
+    assert is_valid_isbn13("9783522202602")
+    assert not is_valid_isbn13("9783522202603")
+
+
+def test_clean_isbn():
+    assert clean_isbn("978-3-522 20260‑2") == "9783522202602"
+    assert clean_isbn("isbn 080442957x") == "080442957X"
+    assert clean_isbn("ISBN-13: 978-3-522-20260-2") == "9783522202602"
+    assert clean_isbn("ISBN10:3522202600") == "3522202600"
+    assert clean_isbn("ISBN-10 3-522-20260-0") == "3522202600"
+    assert clean_isbn("ISBN 1000000000") == "1000000000"  # no colon or space after "10": part of the ISBN
+    assert clean_isbn(None) is None
+    assert clean_isbn(float("nan")) is None
+
+
+def test_canonical_isbn_is_the_isbn13():
+    assert canonical_isbn("3-522-20260-0") == "9783522202602"
+    assert canonical_isbn("978-3-522-20260-2") == "9783522202602"
+    assert canonical_isbn("ISBN-10: 3-522-20260-0") == "9783522202602"
+    assert canonical_isbn("080442957X") == "9780804429573"
+    assert canonical_isbn("3522202601") is None  # wrong check digit
+    assert canonical_isbn("12345") is None
+
+
+def test_record_canonical_isbn_prefers_isbn13():
+    assert record_canonical_isbn({"ISBN_13": "9783522202602", "ISBN_10": "080442957X"}) == "9783522202602"
+    assert record_canonical_isbn({"ISBN_13": "broken", "ISBN_10": "3522202600"}) == "9783522202602"
+    assert record_canonical_isbn({}) is None
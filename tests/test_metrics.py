@@ -0,0 +1,49 @@
+import os
+
+import metrics
+
+
+def test_metrics_add_up_over_worker_processes(monkeypatch, tmp_path):
+    monkeypatch.setattr(metrics, "METRICS_MULTIPROC_DIR", str(tmp_path))
+    monkeypatch.setattr(metrics, "_counters", {})
+    monkeypatch.setattr(metrics, "_histograms", {})
+
+    metrics.inc("gb4f_cache_hits_total", cache="test")
+    pid = os.fork()
+    if pid == 0:  # a second worker
+        metrics.reset_after_fork()
+        metrics.inc("gb4f_cache_hits_total", 2, cache="test")
+        metrics.observe("gb4f_stage_duration_seconds", 0.002, stage="test")
+        metrics.write_snapshot()
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+    text = metrics.render_prometheus()
+    assert 'gb4f_cache_hits_total{cache="test"} 3' in text
+    assert 'gb4f_stage_duration_seconds_count{stage="test"} 1' in text
+
+
+def test_clear_snapshots(monkeypatch, tmp_path):
+    monkeypatch.setattr(metrics, "METRICS_MULTIPROC_DIR", str(tmp_path))
+    (tmp_path / "metrics-1-abc.json").write_text("{}")
+    metrics.clear_snapshots()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_upstream_errors_always_carry_a_reason(monkeypatch):
+    monkeypatch.setattr(metrics, "_counters", {})
+    monkeypatch.setattr(metrics, "_histograms", {})
+
+    try:
+        with metrics.timed_upstream("https://openlibrary.org/api/books"):
+            raise ConnectionError("refused")
+    except ConnectionError:
+        pass
+    metrics.upstream_error("https://www.googleapis.com/books/v1/volumes")
+
+    errors = [line for line in metrics.render_prometheus().splitlines()
+              if line.startswith("gb4f_upstream_errors_total{")]
+    assert sorted(errors) == [
+        'gb4f_upstream_errors_total{host="openlibrary.org",reason="exception"} 1',
+        'gb4f_upstream_errors_total{host="www.googleapis.com",reason="http_status"} 1',
+    ]
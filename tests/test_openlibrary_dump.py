@@ -0,0 +1,50 @@
+import gzip
+import json
+
+from isbn import isbn13_check_digit
+from openlibrary_dump import DescriptionIndex, build_index
+
+
+def dump_line(record_type, key, record):
+    return f"{record_type}\t{key}\t1\t2024-01-01\t{json.dumps(record)}\n"
+
+
+def test_index_from_sorted_runs(tmp_path):
+    editions = [
+        # edition with its own description: wins over the work's
+        dump_line("/type/edition", "/books/OL1M", {"isbn_13": ["978-3-522-20260-2"], "works": [{"key": "/works/OL1W"}],
+                                                 "description": {"type": "/type/text", "value": "Edition text"}}),
+        # no description: takes the one of its work, for both of its ISBNs
+        dump_line("/type/edition", "/books/OL2M", {"isbn_10": ["080442957X"], "isbn_13": ["9780804429573"],
+                                                 "works": [{"key": "/works/OL2W"}]}),
+        dump_line("/type/edition", "/books/OL3M", {"isbn_10": ["3522202601"]}),  # invalid ISBN, skipped
+    ]
+    # more editions than run_size, so the ISBNs are spread over several run files and merged
+    fillers = [f"979100000{n:03d}" for n in range(30)]
+    editions += [dump_line("/type/edition", f"/books/OL{n}X", {"isbn_13": [body + isbn13_check_digit(body)],
+                                                              "description": f"Filler {n}"})
+                 for n, body in enumerate(fillers)]
+    works = [
+        dump_line("/type/work", "/works/OL2W", {"description": "Work text"}),
+        dump_line("/type/work", "/works/OL1W", {"description": "Other work text"}),
+    ]
+    with gzip.open(tmp_path / "editions.txt.gz", "wt", encoding="utf-8") as f:
+        f.writelines(editions)
+    (tmp_path / "works.txt").write_text("".join(works), encoding="utf-8")
+
+    counts = build_index([str(tmp_path / "editions.txt.gz"), str(tmp_path / "works.txt")], str(tmp_path / "ol"),
+                         run_size=4, tmp_dir=str(tmp_path))
+    assert counts["joined"] == 1  # OL2M: both ISBNs are the same book
+    assert counts["isbns"] == 32
+
+    index = DescriptionIndex(str(tmp_path / "ol"))
+    assert len(index) == counts["isbns"]
+    assert index.lookup("3-522-20260-0") == "Edition text"
+    assert index.lookup("080442957X") == "Work text"
+    assert index.lookup("978-0-8044-2957-3") == "Work text"
+    assert index.lookup("3522202601") is None
+    assert index.lookup("9783522202107") is None
+    assert index.lookup("9791000000176") == "Filler 17"
+
+    keys = [index.index[i * 25:i * 25 + 13] for i in range(len(index))]
+    assert keys == sorted(keys) and len(set(keys)) == len(keys)
@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+import functions_flask
+import result_cache
+from result_cache import ResultCache, bump_shelf_version, shelf_version
+
+
+def test_entries_of_an_older_version_are_dropped():
+    cache = ResultCache("test")
+    cache.put("key", 1, b"[1]")
+    assert cache.get("key", 1) == b"[1]"
+    assert cache.get("key", 2) is None
+    assert cache.get("key", 1) is None  # dropped, not kept for the old version
+
+
+def test_size_bound_evicts_least_recently_used():
+    cache = ResultCache("test", max_bytes=8, max_entry_bytes=8)
+    cache.put("a", 1, b"aaaa")
+    cache.put("b", 1, b"bbbb")
+    cache.get("a", 1)
+    cache.put("c", 1, b"cccc")
+    assert cache.get("a", 1) == b"aaaa"
+    assert cache.get("b", 1) is None
+    cache.put("big", 1, b"x" * 9)  # larger than an entry may be
+    assert cache.get("big", 1) is None
+
+
+def test_fill_caches_the_streamed_body():
+    cache = ResultCache("test")
+    assert b"".join(cache.fill("key", 3, ["[", b"1", "]"])) == b"[1]"
+    assert cache.get("key", 3) == b"[1]"
+
+
+@pytest.mark.parametrize("ttl", [0, 60])
+def test_bump_moves_the_version_on(mongo, monkeypatch, ttl):
+    monkeypatch.setattr(result_cache, "RESULT_CACHE_VERSION_TTL", ttl)
+    monkeypatch.setattr(result_cache, "_versions", {})
+    db = mongo["test"]
+    before = shelf_version(db, "stored_books")
+    bump_shelf_version(db, "stored_books")
+    assert shelf_version(db, "stored_books") == before + 1
+    assert shelf_version(db, "stored_books_archive") == before + 1  # the archive shares the counter
+
+
+def test_shelf_search_is_not_served_stale_after_a_write(mongo):
+    def search():
+        response = functions_flask.or_filter_mongo({"Publisher": "Thienemann"}, None)
+        return [book["Title"] for book in json.loads(response.get_data())]
+
+    functions_flask.store_books([{"Title": "Momo", "Publisher": "Thienemann", "book_shelf": 0}])
+    assert search() == ["Momo"]
+    assert search() == ["Momo"]  # from the cache
+
+    functions_flask.store_books([{"Title": "Momo", "Publisher": "Thienemann", "book_shelf": 1}])
+    assert search() == ["Momo", "Momo"]
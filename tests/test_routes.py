@@ -0,0 +1,224 @@
+import json
+
+import mongomock
+from bson import ObjectId
+from pymongo.errors import ServerSelectionTimeoutError
+
+NORD = {"X-Library": "nord"}
+
+
+def select_first(client, headers=None, **search):
+    """Runs a /search_books and selects its first row, returns the /select_book response."""
+    response = client.post("/search_books", json={"intitle": "Ende", **search}, headers=headers)
+    assert response.status_code == 200
+    return client.post("/select_book", json={"selection_id": 1, "search_id": response.headers["X-Search-Id"]},
+                       headers=headers)
+
+
+def stored_books(client, headers=None):
+    return client.get("/get_selected_books", headers=headers).get_json()
+
+
+def test_unknown_library_is_404(client):
+    assert client.get("/get_selected_books", headers={"X-Library": "west"}).status_code == 404
+
+
+def test_search_and_select_stay_in_their_library(client, mongo):
+    assert select_first(client, NORD, book_shelf=2).status_code == 200
+    assert [book["Title"] for book in stored_books(client, NORD)] == ["Momo"]
+    assert stored_books(client) == []
+    assert mongo["gb4f_nord"]["stored_books"].count_documents({}) == 1
+    assert mongo["test"]["stored_books"].count_documents({}) == 0
+
+
+def test_latest_search_is_per_library(client):
+    client.post("/search_books", json={"intitle": "Ende"}, headers=NORD)
+    assert client.post("/select_book", json={"selection_id": 1}).status_code == 400
+
+
+def test_search_books_annotates_from_its_library(client):
+    select_first(client, NORD, book_shelf=2)
+    nord = client.post("/search_books", json={"intitle": "Ende"}, headers=NORD).get_json()
+    default = client.post("/search_books", json={"intitle": "Ende"}).get_json()
+    assert [book["shelf_status"] for book in nord] == ["on_shelf", "new"]
+    assert [book["shelf_status"] for book in default] == ["new", "new"]
+
+
+def test_search_books_stream(client):
+    select_first(client, NORD, book_shelf=2)
+    response = client.get("/search_books_stream?intitle=Ende&library=nord")
+    assert response.status_code == 200
+    events = response.get_data(as_text=True).split("\n\n")
+    books = json.loads(events[0].split("data: ", 1)[1])
+    assert [book["shelf_status"] for book in books] == ["on_shelf", "new"]
+
+
+def test_search_books_stream_sends_only_search_terms(client, fake_apis):
+    client.get("/search_books_stream?intitle=Ende&profile=secret&library=nord")
+    google = [params for url, params in fake_apis if "googleapis" in url]
+    assert google[0]["q"] == "intitle:Ende"
+
+
+def test_search_books_in_mongo(client):
+    select_first(client, NORD, book_shelf=2)
+    assert len(client.post("/search_books_in_mongo", json={"intitle": "Momo"}, headers=NORD).get_json()) == 1
+    assert client.post("/search_books_in_mongo", json={"intitle": "Momo"}).get_json() == []
+
+
+def test_export_books(client):
+    select_first(client, NORD, book_shelf=2)
+    nord = client.get("/export_books?format=csv", headers=NORD).get_data(as_text=True)
+    default = client.get("/export_books?format=csv").get_data(as_text=True)
+    assert "Momo" in nord and "Momo" not in default
+
+
+def test_fuzzy_search(client):
+    select_first(client, NORD, book_shelf=2)
+    assert len(client.get("/fuzzy_search?q=Mommo", headers=NORD).get_json()) == 1
+    assert client.get("/fuzzy_search?q=Mommo").get_json() == []
+
+
+def test_shelf_changes(client, monkeypatch):
+    monkeypatch.setattr("shelf_changes.CHANGES_SETTLE_SECONDS", 0)
+    select_first(client, NORD, book_shelf=2)
+    assert len(client.get("/shelf_changes", headers=NORD).get_json()["changes"]) == 1
+    assert client.get("/shelf_changes").get_json()["changes"] == []
+
+
+def test_shelf_stats(client):
+    select_first(client, NORD, book_shelf=2)
+    assert client.get("/shelf_stats", headers=NORD).status_code == 200
+    assert client.get("/shelf_stats").status_code == 200
+
+
+def test_backfill_descriptions(client):
+    response = client.post("/backfill_descriptions", json={}, headers=NORD)
+    assert response.status_code == 202
+
+
+def test_remove_by_id(client):
+    select_first(client, NORD, book_shelf=2)
+    book_id = stored_books(client, NORD)[0]["_id"]
+    assert client.post("/remove_by_ID", json={"_id": book_id}).get_json()["message"] != "Book_removed"
+    assert client.post("/remove_by_ID", json={"_id": book_id}, headers=NORD).get_json()["message"] == "Book_removed"
+
+
+def test_remove_by_id_leaves_removed_books_alone(client, mongo):
+    select_first(client, book_shelf=2)
+    book_id = stored_books(client)[0]["_id"]
+    assert client.post("/remove_by_ID", json={"_id": book_id}).get_json()["message"] == "Book_removed"
+    removed = mongo["test"]["stored_books"].find_one()
+    assert client.post("/remove_by_ID", json={"_id": book_id}).get_json()["message"] != "Book_removed"
+    again = mongo["test"]["stored_books"].find_one()
+    assert (again["removed_at"], again["change_seq"]) == (removed["removed_at"], removed["change_seq"])
+
+
+def test_bulk_move(client):
+    select_first(client, NORD, book_shelf=2)
+    book_id = stored_books(client, NORD)[0]["_id"]
+    response = client.post("/bulk_move", json={"_ids": [book_id], "to_shelf": 5}, headers=NORD)
+    assert response.status_code == 200
+    assert response.get_json()["modified"] == 1
+    assert stored_books(client, NORD)[0]["book_shelf"] == 5
+
+
+def test_bulk_move_removes_only_once(client, mongo):
+    select_first(client, book_shelf=2)
+    book_id = stored_books(client)[0]["_id"]
+    first = client.post("/bulk_move", json={"_ids": [book_id], "to_shelf": -1}).get_json()
+    removed_at = mongo["test"]["stored_books"].find_one()["removed_at"]
+    second = client.post("/bulk_move", json={"_ids": [book_id], "to_shelf": -1}).get_json()
+    assert (first["modified"], second["matched"], second["modified"]) == (1, 0, 0)
+    assert mongo["test"]["stored_books"].find_one()["removed_at"] == removed_at
+
+
+def test_bulk_move_rejects_shelf_names(client):
+    select_first(client, book_shelf=2)
+    book_id = stored_books(client)[0]["_id"]
+    for shelf in ("abc", True, 2.5, "2.5", -2):
+        assert client.post("/bulk_move", json={"_ids": [book_id], "to_shelf": shelf}).status_code == 400
+    assert client.post("/bulk_move", json={"_ids": [book_id], "to_shelf": 3, "from_shelf": 2.5}).status_code == 400
+    assert stored_books(client)[0]["book_shelf"] == 2
+    assert client.post("/bulk_move", json={"_ids": [book_id], "to_shelf": "3"}).status_code == 200
+    assert client.post("/bulk_move", json={"_ids": [book_id], "to_shelf": 4.0}).status_code == 200
+    assert stored_books(client)[0]["book_shelf"] == 4
+
+
+def test_profile_covers_streamed_body(client, monkeypatch, tmp_path):
+    import pstats
+    monkeypatch.setattr("profiling.PROFILE_TOKEN", "secret")
+    monkeypatch.setattr("profiling.PROFILE_DIR", str(tmp_path))
+    select_first(client, book_shelf=2)
+    response = client.post("/search_books_in_mongo", json={"intitle": "Momo"}, headers={"X-Profile": "secret"})
+    assert len(response.get_json()) == 1
+    response.close()
+    stats = pstats.Stats(str(tmp_path / (response.headers["X-Profile-ID"] + ".pstats")))
+    assert any(function == "stream_mongo_json" for _, _, function in stats.stats)
+
+
+def test_request_duration_covers_streamed_body(client):
+    import metrics
+    select_first(client)
+    client.get("/get_selected_books").close()
+    assert 'gb4f_http_request_duration_seconds_count{endpoint="get_selected_books",library="default"' \
+           in metrics.render_prometheus()
+
+
+def hybrid_select(client, selection, **search):
+    response = client.post("/search_books", json={"intitle": "Ende", "hybrid": True, **search})
+    return client.post("/select_book", json={"search_id": response.headers["X-Search-Id"], **selection})
+
+
+def test_hybrid_select_without_shelf_keeps_the_stored_book(client, mongo):
+    select_first(client, book_shelf=3)
+    hybrid_select(client, {"selection_id": 1})
+    shelves = sorted(book["book_shelf"] for book in mongo["test"]["stored_books"].find())
+    assert shelves == [-1, 3]  # stored as a new row, the shelf-3 copy is untouched
+
+
+def test_hybrid_select_restores_removed_and_moves_only_on_request(client, mongo):
+    select_first(client, book_shelf=3)
+    book_id = stored_books(client)[0]["_id"]
+    books = mongo["test"]["stored_books"]
+
+    client.post("/bulk_move", json={"_ids": [book_id], "to_shelf": -1})
+    assert hybrid_select(client, {"selection_id": 1}, book_shelf=4).get_json()["_id"] == book_id
+    assert books.find_one({"_id": ObjectId(book_id)})["book_shelf"] == 4
+
+    hybrid_select(client, {"selection_id": 1, "move": True}, book_shelf=6)
+    assert [book["book_shelf"] for book in books.find()] == [6]
+
+    hybrid_select(client, {"selection_id": 1}, book_shelf=5)  # on shelf 6: a second copy on shelf 5
+    assert sorted(book["book_shelf"] for book in books.find()) == [5, 6]
+
+
+def test_plain_search_select_stores_a_new_copy(client, mongo):
+    select_first(client, book_shelf=3)
+    assert client.post("/search_books", json={"intitle": "Ende"}).get_json()[0]["shelf_status"] == "on_shelf"
+    client.post("/select_book", json={"selection_id": 1})
+    assert sorted(book["book_shelf"] for book in mongo["test"]["stored_books"].find()) == [-1, 3]
+    assert all("shelf_status" not in book for book in mongo["test"]["stored_books"].find())
+
+
+def test_stream_search_select_stores_a_new_copy(client, mongo):
+    select_first(client, book_shelf=3)
+    client.post("/bulk_move", json={"from_shelf": 3, "to_shelf": -1})
+    client.get("/search_books_stream?intitle=Ende&book_shelf=5").get_data()
+    client.post("/select_book", json={"selection_id": 1})  # not a hybrid search: the removed book stays removed
+    assert sorted(book["book_shelf"] for book in mongo["test"]["stored_books"].find()) == [-1, 5]
+
+
+def test_searches_answer_while_mongo_is_down(client, monkeypatch):
+    def unreachable(*args, **kwargs):
+        raise ServerSelectionTimeoutError("no servers")
+
+    monkeypatch.setattr(mongomock.collection.Collection, "find", unreachable)
+    for search in ({"intitle": "Ende"}, {"intitle": "Ende", "hybrid": True}):
+        response = client.post("/search_books", json=search, headers=NORD)
+        assert response.status_code == 200
+        assert [book["shelf_status"] for book in response.get_json()] == ["unknown", "unknown"]
+
+    response = client.get("/search_books_stream?intitle=Ende", headers=NORD)
+    assert response.status_code == 200
+    books = json.loads(response.get_data(as_text=True).split("\n\n")[0].split("data: ", 1)[1])
+    assert [book["shelf_status"] for book in books] == ["unknown", "unknown"]
@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from bson import ObjectId
+
+import shelf_changes
+from shelf_changes import list_changes
+
+
+@pytest.fixture
+def changes(mongo, monkeypatch):
+    """Seven books, five of them moved in one bulk change (same change_seq), one of those archived."""
+    monkeypatch.setattr(shelf_changes, "CHANGES_SETTLE_SECONDS", 0)
+    updated = datetime.now(timezone.utc) - timedelta(minutes=1)
+    ids = [ObjectId() for _ in range(7)]
+    seqs = [1, 2, 2, 2, 2, 2, 3]
+    docs = [{"_id": _id, "Title": f"Book {n}", "book_shelf": 1, "change_seq": seq, "created_seq": 1,
+             "updated_at": updated} for n, (_id, seq) in enumerate(zip(ids, seqs))]
+    docs[3]["book_shelf"] = -1
+    mongo["test"]["stored_books"].insert_many(docs[:3] + docs[4:])
+    mongo["test"]["stored_books_archive"].insert_one(docs[3])
+    return ids
+
+
+def read_all(limit):
+    since, after_id, pages = 0, None, []
+    while True:
+        page = list_changes(since=since, after_id=after_id, limit=limit)
+        pages.append(page)
+        since, after_id = page["since"], page["after_id"]
+        if not page["has_more"]:
+            return pages
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 10])
+def test_pages_continue_inside_a_bulk_change(changes, limit):
+    pages = read_all(limit)
+    seen = [change["book"]["_id"] for page in pages for change in page["changes"]]
+    assert seen == [str(_id) for _id in changes]  # ordered by (change_seq, _id), nothing twice or lost
+    assert all(len(page["changes"]) <= limit for page in pages)
+
+
+def test_ops_and_archived_removals(changes):
+    page = list_changes(since=1)
+    ops = {change["book"]["_id"]: change["op"] for change in page["changes"]}
+    assert ops[str(changes[3])] == "remove"  # read from the archive collection
+    assert ops[str(changes[2])] == "update"
+    assert page["since"] == 3 and not page["has_more"]
+
+
+def test_unsettled_changes_wait_for_the_next_page(changes, mongo, monkeypatch):
+    mongo["test"]["stored_books"].update_one({"_id": changes[6]},
+                                             {"$set": {"updated_at": datetime.now(timezone.utc)}})
+    monkeypatch.setattr(shelf_changes, "CHANGES_SETTLE_SECONDS", 30)
+    page = list_changes(since=0)
+    assert len(page["changes"]) == 6 and page["has_more"]
+
+
+def test_invalid_arguments(changes):
+    with pytest.raises(ValueError):
+        list_changes(since="x")
+    with pytest.raises(ValueError):
+        list_changes(since=2, after_id="not-an-id")
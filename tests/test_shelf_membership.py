@@ -0,0 +1,77 @@
+import mongomock
+import pandas as pd
+import pytest
+from pymongo.errors import ServerSelectionTimeoutError
+
+import shelf_changes
+import shelf_membership
+from functions_flask import store_books
+from shelf_membership import BloomFilter, annotate_shelf_membership
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(1000)
+    keys = [f"ISBN_13:978{n:010d}" for n in range(1000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+
+    others = [f"ISBN_13:979{n:010d}" for n in range(10000)]
+    false_positives = sum(key in bloom for key in others)
+    assert false_positives < 3 * shelf_membership.SHELF_BLOOM_ERROR_RATE * len(others)
+
+
+def test_bloom_filter_past_its_capacity_still_finds_every_key():
+    bloom = BloomFilter(100)
+    keys = [f"ID:volume{n}" for n in range(1000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+
+
+@pytest.fixture(params=[False, True], ids=["mongo", "bloom"])
+def shelf(request, mongo, monkeypatch):
+    monkeypatch.setattr(shelf_membership, "SHELF_BLOOM", request.param)
+    monkeypatch.setattr(shelf_membership, "_stored", {})
+    monkeypatch.setattr(shelf_membership, "CHANGES_SETTLE_SECONDS", 0)
+    monkeypatch.setattr(shelf_changes, "CHANGES_SETTLE_SECONDS", 0)
+    store_books([
+        {"Title": "Momo", "ISBN_13": "9783522202602", "ID": "momo", "book_shelf": 2},
+        {"Title": "Weg", "ISBN_13": "9783000000001", "ID": "weg", "book_shelf": -1},
+    ])
+    mongo["test"]["stored_books_archive"].insert_one({"Title": "Alt", "ID": "alt", "book_shelf": -1})
+    return mongo
+
+
+def search_rows():
+    return pd.DataFrame([
+        {"Title": "Momo", "ISBN_13": "9783522202602", "ID": "other-volume"},
+        {"Title": "Weg", "ISBN_13": "9783000000001", "ID": "weg"},
+        {"Title": "Alt", "ISBN_13": None, "ID": "alt"},
+        {"Title": "Neu", "ISBN_13": "9781111111111", "ID": "neu"},
+        {"Title": "No identifiers", "ISBN_13": None, "ID": None},
+    ])
+
+
+def test_rows_get_their_shelf_status(shelf):
+    books_df = annotate_shelf_membership(search_rows())
+    assert list(books_df["shelf_status"]) == ["on_shelf", "removed", "archived", "new", "new"]
+    assert books_df["stored_shelf"].iloc[0] == 2
+    assert books_df["_id"].notna().tolist() == [True, True, True, False, False]
+
+
+def test_books_stored_after_the_first_search_are_found(shelf):
+    annotate_shelf_membership(search_rows())
+    store_books([{"Title": "Neu", "ISBN_13": "9781111111111", "ID": "neu", "book_shelf": 0}])
+    books_df = annotate_shelf_membership(search_rows())
+    assert books_df["shelf_status"].iloc[3] == "on_shelf"
+
+
+def test_mongo_outage_leaves_the_status_unknown(shelf, monkeypatch):
+    def unreachable(*args, **kwargs):
+        raise ServerSelectionTimeoutError("no servers")
+
+    monkeypatch.setattr(mongomock.collection.Collection, "find", unreachable)
+    books_df = annotate_shelf_membership(search_rows())
+    assert set(books_df["shelf_status"]) == {"unknown"}
+    assert books_df["_id"].isna().all()
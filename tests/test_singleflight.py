@@ -0,0 +1,53 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def run_concurrently(monkeypatch, flight, key, fn, callers=5):
+    """Starts callers threads on flight.do while fn blocks, releases it once all of them joined the call."""
+    release = threading.Event()
+    started = threading.Event()
+    joined = threading.Semaphore(0)
+    monkeypatch.setattr("singleflight.metrics.inc", lambda *args, **labels: joined.release())
+
+    def blocking():
+        started.set()
+        release.wait(5)
+        return fn()
+
+    with ThreadPoolExecutor(callers) as pool:
+        leader = pool.submit(flight.do, key, blocking)
+        started.wait(5)
+        followers = [pool.submit(flight.do, key, blocking) for _ in range(callers - 1)]
+        for _ in followers:
+            assert joined.acquire(timeout=5)  # every follower found the leader's call in flight
+        release.set()
+        return [leader] + followers
+
+
+def test_concurrent_callers_share_one_result(monkeypatch):
+    calls = []
+    futures = run_concurrently(monkeypatch, SingleFlight("test"), "momo", lambda: calls.append(1) or {"items": []})
+    results = [future.result() for future in futures]
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+
+
+def test_errors_reach_every_caller(monkeypatch):
+    def fail():
+        raise ConnectionError("upstream down")
+
+    flight = SingleFlight("test")
+    for future in run_concurrently(monkeypatch, flight, "momo", fail):
+        with pytest.raises(ConnectionError):
+            future.result()
+    assert flight._calls == {}
+    assert flight.do("momo", lambda: "again") == "again"  # nothing is kept after the call
+
+
+def test_different_keys_do_not_share():
+    flight = SingleFlight("test")
+    assert [flight.do(key, lambda key=key: key.upper()) for key in ("a", "b")] == ["A", "B"]
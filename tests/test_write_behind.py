@@ -0,0 +1,48 @@
+import pytest
+
+import write_behind
+
+
+@pytest.fixture
+def journal(tmp_path, monkeypatch, mongo):
+    monkeypatch.setattr(write_behind, "WRITE_BEHIND_DB", str(tmp_path / "write_behind.db"))
+    write_behind.init_journal()
+    return mongo["test"]["stored_books"]
+
+
+def test_flush_writes_journaled_books_with_their_ids(journal):
+    ids = write_behind.enqueue_books([{"Title": "Momo", "book_shelf": 0}, {"Title": "Ende", "book_shelf": 1}])
+    assert write_behind.pending_count() == 2
+
+    assert write_behind.flush_all() == 2
+    assert write_behind.pending_count() == 0
+    assert sorted(str(doc["_id"]) for doc in journal.find()) == sorted(ids)
+
+
+def test_replayed_batch_skips_stored_ids(journal, monkeypatch):
+    ids = write_behind.enqueue_books([{"Title": "Momo", "book_shelf": 0}, {"Title": "Ende", "book_shelf": 1}])
+    store_books = write_behind.store_books
+
+    def store_then_die(*args, **kwargs):
+        store_books(*args, **kwargs)
+        raise ConnectionError("process died before the journal was cleared")
+
+    monkeypatch.setattr(write_behind, "store_books", store_then_die)
+    with pytest.raises(ConnectionError):
+        write_behind.flush_batch()
+    assert write_behind.pending_count() == 2  # handed back for a replay
+
+    monkeypatch.setattr(write_behind, "store_books", store_books)
+    write_behind.enqueue_books([{"Title": "Rose", "book_shelf": 2}])
+    assert write_behind.flush_all() == 3
+    assert write_behind.pending_count() == 0
+    titles = sorted(doc["Title"] for doc in journal.find())
+    assert titles == ["Ende", "Momo", "Rose"]  # Momo and Ende once, not twice
+    assert {str(doc["_id"]) for doc in journal.find()} >= set(ids)
+
+
+def test_full_journal_refuses_new_books(journal, monkeypatch):
+    monkeypatch.setattr(write_behind, "WRITE_BEHIND_MAX_PENDING", 2)
+    assert write_behind.enqueue_books([{"Title": "Momo"}, {"Title": "Ende"}]) is not None
+    assert write_behind.enqueue_books([{"Title": "Rose"}]) is None
+    assert write_behind.pending_count() == 2
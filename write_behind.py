@@ -0,0 +1,204 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from bson import ObjectId
+from dotenv import load_dotenv
+
+from functions_flask import store_books
+from libraries import mongo_uri_for
+import metrics
+
+
+#Write-behind for /select_book
+#With WRITE_BEHIND=1 a selected book is not inserted into Mongo inside the request. It is appended to a
+#journal (a small SQLite file, synchronous=FULL, so an acknowledged selection survives a crash) and the
+#request returns at once. A flusher thread writes the journal to Mongo with one insert_many per batch,
+#as soon as WRITE_BEHIND_BATCH_SIZE selections are waiting or every WRITE_BEHIND_INTERVAL seconds.
+#
+#Every book gets its _id when it is journaled, so /select_book can return it right away and a batch that is
+#replayed (the process died between insert_many and clearing the journal) does not store books twice.
+#Entries left in the journal are flushed after a restart. When more than WRITE_BEHIND_MAX_PENDING selections
+#are waiting (Mongo is down or slow), enqueue_books refuses new ones and /select_book answers 503.
+#
+#Selected books show up in /get_selected_books once their batch is flushed, not immediately.
+#
+#Drain the journal by hand:   python write_behind.py --flush
+
+load_dotenv(".env")
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "0").lower() in ("1", "true", "yes")
+WRITE_BEHIND_DB = os.getenv("WRITE_BEHIND_DB", "write_behind.db")
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "100"))
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", "1"))  # seconds
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "10000"))
+WRITE_BEHIND_LEASE = 120  # seconds before a batch of a dead flusher is handed out again
+
+_flusher = []
+_wake_up = threading.Event()
+
+
+@contextmanager
+def _connect():
+    conn = sqlite3.connect(WRITE_BEHIND_DB, timeout=30, isolation_level=None)  # autocommit, explicit BEGIN below
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA synchronous=FULL")  # a journaled selection has to be on disk before it is acknowledged
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def init_journal():
+    """Creates the journal table if needed."""
+    with _connect() as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at REAL NOT NULL,
+                db_name TEXT NOT NULL,
+                collection_name TEXT NOT NULL,
+                book_id TEXT NOT NULL,
+                book TEXT NOT NULL,
+                locked_at REAL
+            );
+        """)
+
+
+def pending_count():
+    with _connect() as conn:
+        return conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+
+def enqueue_books(books_list, db_name="test", collection_name="stored_books"):
+    """
+    Journals book dicts from prepare_books for the flusher, giving every book its _id.
+
+    :return: The _ids as strings, or None if the journal is full (WRITE_BEHIND_MAX_PENDING).
+    """
+    now = time.time()
+    rows = []
+    for record in books_list:
+        book_id = ObjectId()
+        rows.append((now, db_name, collection_name, str(book_id), json.dumps(record, default=str)))
+
+    with _connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        waiting = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        if waiting + len(rows) > WRITE_BEHIND_MAX_PENDING:
+            conn.execute("ROLLBACK")
+            _wake_up.set()
+            return None
+        conn.executemany(
+            "INSERT INTO entries (created_at, db_name, collection_name, book_id, book) VALUES (?, ?, ?, ?, ?)", rows
+        )
+        conn.execute("COMMIT")
+
+    if waiting + len(rows) >= WRITE_BEHIND_BATCH_SIZE:
+        _wake_up.set()
+    return [row[3] for row in rows]
+
+
+def claim_batch(batch_size=WRITE_BEHIND_BATCH_SIZE):
+    """Leases the oldest journal entries of one collection (or those of a dead flusher) for a flush."""
+    now = time.time()
+    with _connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")  # write lock, so two processes never flush the same entries
+        first = conn.execute(
+            "SELECT db_name, collection_name FROM entries WHERE locked_at IS NULL OR locked_at < ? "
+            "ORDER BY entry_id LIMIT 1", (now - WRITE_BEHIND_LEASE,)
+        ).fetchone()
+        entries = []
+        if first is not None:
+            entries = conn.execute(
+                "SELECT * FROM entries WHERE db_name = ? AND collection_name = ? "
+                "AND (locked_at IS NULL OR locked_at < ?) ORDER BY entry_id LIMIT ?",
+                (first["db_name"], first["collection_name"], now - WRITE_BEHIND_LEASE, batch_size),
+            ).fetchall()
+            conn.executemany("UPDATE entries SET locked_at = ? WHERE entry_id = ?",
+                             [(now, entry["entry_id"]) for entry in entries])
+        conn.execute("COMMIT")
+    return [dict(entry) for entry in entries]
+
+
+def flush_batch(mongo_uri=None, batch_size=WRITE_BEHIND_BATCH_SIZE):
+    """
+    Writes one batch of journaled books to Mongo and removes it from the journal.
+
+    :return: Number of journal entries flushed (0 when the journal is empty).
+    """
+    entries = claim_batch(batch_size)
+    if not entries:
+        return 0
+
+    books_list = []
+    for entry in entries:
+        record = json.loads(entry["book"])
+        record["_id"] = ObjectId(entry["book_id"])
+        books_list.append(record)
+
+    try:
+        with metrics.timed("write_behind_flush"):
+            db_name, collection_name = entries[0]["db_name"], entries[0]["collection_name"]
+            # every library may live on a cluster of its own (MONGO_URI_<NAME>)
+            store_books(books_list, mongo_uri or mongo_uri_for(db_name, collection_name), db_name, collection_name)
+    except Exception:
+        # hand the entries back right away instead of waiting for the lease
+        with _connect() as conn:
+            conn.executemany("UPDATE entries SET locked_at = NULL WHERE entry_id = ?",
+                             [(entry["entry_id"],) for entry in entries])
+        raise
+
+    with _connect() as conn:
+        conn.executemany("DELETE FROM entries WHERE entry_id = ?", [(entry["entry_id"],) for entry in entries])
+    metrics.inc("gb4f_write_behind_flushed_total", len(entries))
+    return len(entries)
+
+
+def flush_all(mongo_uri=None):
+    """Flushes the journal until it is empty. Returns the number of entries written."""
+    flushed = 0
+    while True:
+        count = flush_batch(mongo_uri)
+        if not count:
+            return flushed
+        flushed += count
+
+
+def _flusher_loop(stop_event, mongo_uri):
+    while not stop_event.is_set():
+        try:
+            flush_all(mongo_uri)
+        except Exception as e:
+            print(f"Write-behind flush failed: {e}")
+        _wake_up.wait(timeout=WRITE_BEHIND_INTERVAL)
+        _wake_up.clear()
+
+
+def start_flusher(mongo_uri=None):
+    """Starts the flusher thread once per process (its first round replays what is left in the journal)."""
+    if _flusher and _flusher[0][0].is_alive():
+        return _flusher[0][1]
+    _flusher.clear()  # a thread inherited through a fork is dead in the child
+
+    init_journal()
+    stop_event = threading.Event()
+    flusher = threading.Thread(target=_flusher_loop, args=(stop_event, mongo_uri), name="write-behind", daemon=True)
+    flusher.start()
+    _flusher.append((flusher, stop_event))
+    return stop_event
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write the journaled selections to Mongo.")
+    parser.add_argument("--flush", action="store_true", help="flush the whole journal now")
+    args = parser.parse_args()
+
+    init_journal()
+    if args.flush:
+        print(f"{flush_all()} journaled book(s) written to Mongo.")
+    print(f"{pending_count()} book(s) waiting in {WRITE_BEHIND_DB}.")